@@ -0,0 +1,360 @@
+"""ETL benchmark
+
+This script measures the throughput of a whole batch, end to end, without
+calling live apis or Azure:
+
+  * the apis are emulated by mock_api.py, run in its own process so its
+    memory and cpu do not count against the batch
+  * blob storage is Azurite (the Azure Storage emulator), given by the
+    ETL_BLOB_CONNECTION_STRING environment variable (default: Azurite's
+    development storage account on 127.0.0.1:10000)
+  * batch logging goes to a local SQL Server given by the
+    ETL_SQL_CONNECTION_STRING environment variable. --deploy-sql creates the
+    METADATA objects of sql-ddl/ in an empty database first.
+
+A config file with endpoints_per_type rows of every api_type is written to
+<data_lake_schema_name>/<data_lake_folder_name>/api_config.csv and loaded
+with etl_orchestrator.main(). The run reports pages/s, MB/s, p50/p99 request
+latency (measured by the mock api, from request to response written), the
+429 responses sent, the peak RSS of the process and the SQL round trips per
+endpoint. Results are appended as one json line to --results (default
+benchmark_results.jsonl) together with the git commit, and compared with the
+last earlier result of the same settings: changes worse than
+REGRESSION_TOLERANCE are flagged.
+
+    azurite --silent &
+    export ETL_SQL_CONNECTION_STRING='DRIVER={ODBC Driver 17 for SQL Server};SERVER=localhost;DATABASE=etl;UID=sa;PWD=...'
+    python ./benchmark.py --deploy-sql
+    python ./benchmark.py --engine async --max-workers 20 --pages 50 --latency-ms 40
+
+Peak RSS is the peak of the whole process, so run one benchmark per process.
+
+Python Module Requirements:
+
+ * argparse
+ * csv
+ * io
+ * json
+ * multiprocessing
+ * os
+ * resource
+ * statistics
+ * subprocess
+ * time
+ * urllib.request
+ * datetime
+ * pyodbc
+ * azure.core
+
+Custom Module Requirements:
+
+ * mock_api.py
+ * connections.py
+ * blob_functions.py
+ * process_logging.py
+ * etl_orchestrator.py
+"""
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import time
+import urllib.request
+from datetime import datetime
+
+from mock_api import MockApiSettings, serve
+
+# Azurite's well-known development storage account.
+AZURITE_CONNECTION_STRING = (
+    'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+    'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq'
+    '/K1SZFPTOtr/KBHBeksoGMGw==;'
+    'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;')
+
+# Relative change of a metric, against the last result of the same
+# settings, reported as a regression.
+REGRESSION_TOLERANCE = 0.10
+# Metrics compared between runs, and whether higher is better.
+COMPARED_METRICS = {
+    'pages_per_second': True,
+    'megabytes_per_second': True,
+    'latency_p50_ms': False,
+    'latency_p99_ms': False,
+    'peak_rss_megabytes': False,
+    'sql_round_trips_per_endpoint': False}
+
+# sql-ddl files in deployment order.
+SQL_DDL_FILES = [
+    'batch_tables.sql',
+    's_BatchStepLogging.sql',
+    's_BatchStepLoggingBulk.sql',
+    'batch_watermark.sql',
+    'f_GetBatchStepStartDateTimeFromLastSuccessfulBatch.sql',
+    's_BatchLogging.sql',
+    's_GetStepDurations.sql',
+    'batch_shard_lease.sql']
+# Objects the sql-ddl scripts expect to exist already.
+SQL_DDL_PREREQUISITES = [
+    "IF SCHEMA_ID('METADATA') IS NULL EXEC('CREATE SCHEMA METADATA')",
+    "IF OBJECT_ID('dbo.getdate') IS NULL EXEC('CREATE FUNCTION dbo.getdate() "
+    "RETURNS datetime AS BEGIN RETURN GETDATE() END')"]
+
+# Secret names used by the benchmark config, with their local values.
+BENCHMARK_SECRETS = {
+    'benchmark-password': 'mock-password',
+    'benchmark-token-request': json.dumps({'grant_type': 'client_credentials'})}
+
+# Config file columns, as in api_config.csv.
+CONFIG_COLUMNS = [
+    'user', 'keyvault_secret_password_name',
+    'keyvault_secret_get_access_token_name', 'project', 'source_name',
+    'token_url', 'base_url', 'endpoint_name', 'endpoint_url',
+    'additional_url_string', 'use_params', 'response_format',
+    'is_paged_endpoint', 'first_page_number', 'total_pages_key_name',
+    'api_type', 'auth_type', 'source_records_per_page',
+    'target_update_strategy', 'target_system', 'target_file_system',
+    'target_data_source', 'page_workers']
+
+# (api_type, auth_type, mock api route, response format, paged) of each
+# configuration the benchmark loads.
+API_TYPES = [
+    ('json_token_paged_count', 'token', 'secure', 'json', 'yes'),
+    ('json_user_pass_paged_count', 'user-pass', 'count', 'json', 'yes'),
+    ('json_user_pass_paged_next', 'user-pass', 'next', 'json', 'yes'),
+    ('json_user_pass_not_paged', 'user-pass', 'json', 'json', 'no'),
+    ('json_api_key_not_paged', 'api-key', 'json', 'json', 'no'),
+    ('xml_user_pass_not_paged', 'user-pass', 'xml', 'xml', 'no')]
+
+# Config rows for the mock api at base_url: endpoints_per_type rows of every
+# api type.
+def benchmark_config(
+        base_url, data_lake_folder_name, endpoints_per_type, page_workers):
+    rows = []
+    for api_type, auth_type, route, response_format, paged in API_TYPES:
+        for number in range(endpoints_per_type):
+            endpoint_name = api_type + '_' + str(number)
+            rows.append({
+                'user': 'benchmark',
+                'keyvault_secret_password_name': 'benchmark-password',
+                'keyvault_secret_get_access_token_name':
+                    'benchmark-token-request' if auth_type == 'token'
+                    else 'none',
+                'project': 'Benchmark',
+                'source_name': 'Benchmark',
+                'token_url': base_url + 'token',
+                'base_url': base_url + route + '/',
+                'endpoint_name': endpoint_name,
+                'endpoint_url': endpoint_name,
+                'additional_url_string': '{}',
+                'use_params': 'TRUE' if route != 'next' else 'FALSE',
+                'response_format': response_format,
+                'is_paged_endpoint': paged,
+                'first_page_number': 0,
+                'total_pages_key_name': 'total_pages',
+                'api_type': api_type,
+                'auth_type': auth_type,
+                'source_records_per_page': 0,
+                'target_update_strategy': 'full',
+                'target_system': 'Data Lake',
+                'target_file_system': 'benchmark',
+                'target_data_source': data_lake_folder_name,
+                'page_workers': page_workers})
+    return rows
+
+# Config rows as csv bytes.
+def config_csv(rows):
+    with io.StringIO() as buf:
+        writer = csv.DictWriter(buf, fieldnames=CONFIG_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+        return buf.getvalue().encode('utf-8')
+
+# Run the statements of the sql-ddl scripts (split on their GO lines) in an
+# empty database.
+def deploy_sql_ddl(connection_string):
+    import pyodbc
+    cnxn = pyodbc.connect(connection_string, autocommit=True)
+    cursor = cnxn.cursor()
+    for statement in SQL_DDL_PREREQUISITES:
+        cursor.execute(statement)
+    ddl_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'sql-ddl')
+    for file_name in SQL_DDL_FILES:
+        with open(os.path.join(ddl_folder, file_name), encoding='utf-8') as file:
+            statement = []
+            for line in file:
+                if line.strip().upper() == 'GO':
+                    if ''.join(statement).strip():
+                        cursor.execute(''.join(statement))
+                    statement = []
+                else:
+                    statement.append(line)
+            if ''.join(statement).strip():
+                cursor.execute(''.join(statement))
+        print('Deployed ' + file_name)
+    cnxn.close()
+
+# Value at percentile (0-100) of a list of numbers, None when it is empty.
+def percentile(values, percent):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[
+        min(98, max(0, int(percent) - 1))]
+
+# Commit of the working tree, to tell results of different versions apart.
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Post to or get a mock api control path, returning the parsed json.
+def mock_api_call(base_url, path, post = False):
+    request = urllib.request.Request(
+        base_url + path, data=b'' if post else None,
+        method='POST' if post else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+# Run one benchmark and return its result.
+def run_benchmark(
+        settings, engine = 'threads', max_workers = 4, page_workers = 1,
+        endpoints_per_type = 2, data_lake_schema_name = 'benchmark',
+        data_lake_folder_name = 'mockapi'):
+    os.environ.setdefault(
+        'ETL_BLOB_CONNECTION_STRING', AZURITE_CONNECTION_STRING)
+    # Imported here, after the connection strings are set.
+    import connections as cn
+    import process_logging
+    from blob_functions import blob_write, get_container_client
+    from azure.core.exceptions import ResourceExistsError
+    import etl_orchestrator
+
+    for name, value in BENCHMARK_SECRETS.items():
+        cn.cache_secret(name, value)
+
+    # The mock api runs in its own process.
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(settings, 0, ready), daemon=True)
+    server.start()
+    base_url = 'http://127.0.0.1:' + str(ready.get(timeout=30)) + '/'
+    try:
+        try:
+            get_container_client(data_lake_schema_name).create_container()
+        except ResourceExistsError:
+            pass
+        config_rows = benchmark_config(
+            base_url, data_lake_folder_name, endpoints_per_type, page_workers)
+        blob_write(
+            'text/csv', data_lake_schema_name + '/' + data_lake_folder_name,
+            'api_config.csv', config_csv(config_rows))
+
+        mock_api_call(base_url, '_reset', post=True)
+        sql_round_trips = process_logging.sql_round_trips
+        started = time.perf_counter()
+        etl_orchestrator.main(
+            data_lake_schema_name, data_lake_folder_name, max_workers,
+            None, False, engine)
+        seconds = time.perf_counter() - started
+        sql_round_trips = process_logging.sql_round_trips - sql_round_trips
+        stats = mock_api_call(base_url, '_stats')
+    finally:
+        server.terminate()
+        server.join()
+
+    megabytes = stats['bytes'] / (1024 * 1024)
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'settings': {
+            **settings.to_dict(), 'engine': engine,
+            'max_workers': max_workers, 'page_workers': page_workers,
+            'endpoints_per_type': endpoints_per_type},
+        'endpoints': len(config_rows),
+        'seconds': round(seconds, 3),
+        'requests': stats['requests'],
+        'pages': stats['pages'],
+        'throttled_responses': stats['throttled'],
+        'pages_per_second': round(stats['pages'] / seconds, 2),
+        'megabytes': round(megabytes, 3),
+        'megabytes_per_second': round(megabytes / seconds, 3),
+        'latency_p50_ms': percentile(stats['latencies_ms'], 50),
+        'latency_p99_ms': percentile(stats['latencies_ms'], 99),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_megabytes': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'sql_round_trips': sql_round_trips,
+        'sql_round_trips_per_endpoint': round(
+            sql_round_trips / len(config_rows), 2)}
+
+# Read the results saved by earlier runs.
+def read_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+# Metrics of result that are more than REGRESSION_TOLERANCE worse than in
+# baseline: a list of (metric, baseline value, value).
+def regressions(result, baseline):
+    found = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        before, after = baseline.get(metric), result.get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        if (higher_is_better and change < -REGRESSION_TOLERANCE) \
+                or (not higher_is_better and change > REGRESSION_TOLERANCE):
+            found.append((metric, before, after))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['threads', 'async'],
+        default='threads')
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--page-workers', type=int, default=1)
+    parser.add_argument('--endpoints-per-type', type=int, default=2)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--records-per-page', type=int, default=100)
+    parser.add_argument('--record-bytes', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--throttle-every', type=int, default=0)
+    parser.add_argument('--retry-after', type=float, default=1)
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--deploy-sql', action='store_true')
+    args = parser.parse_args()
+
+    if args.deploy_sql:
+        deploy_sql_ddl(os.environ['ETL_SQL_CONNECTION_STRING'])
+
+    settings = MockApiSettings(
+        args.pages, args.records_per_page, args.record_bytes,
+        args.latency_ms, args.throttle_every, args.retry_after)
+    result = run_benchmark(
+        settings, args.engine, args.max_workers, args.page_workers,
+        args.endpoints_per_type)
+    print(json.dumps(result, indent=2))
+
+    earlier = [
+        earlier_result for earlier_result in read_results(args.results)
+        if earlier_result['settings'] == result['settings']]
+    if earlier:
+        baseline = earlier[-1]
+        for metric, before, after in regressions(result, baseline):
+            print('Regression in ' + metric + ': ' + str(before) + ' ('
+                + str(baseline['commit']) + ') -> ' + str(after))
+    with open(args.results, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(result) + '\n')
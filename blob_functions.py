@@ -4,63 +4,424 @@ This script is utilized by other scripts in this program to interact with
 the Azure Data Lake Gen2, including reading & writing files and getting file
 counts.
 
+All functions go through one cached BlobServiceClient and one ContainerClient
+per container (see get_container_client()). The clients share a pooled HTTP
+transport and are safe to use from parallel writers. BLOB_POOL_SIZE,
+BLOB_MAX_CONCURRENCY, BLOB_MAX_BLOCK_SIZE and BLOB_MAX_SINGLE_PUT_SIZE tune
+the connection pool and uploads.
+
+Large or streamed bodies are written with BlobBlockWriter (or
+blob_write_stream()), which stages BLOB_MAX_BLOCK_SIZE blocks as data arrives
+and commits the block list at the end, so at most one block is held in
+memory.
+
+Every write function takes an optional compression ('gzip' or 'zstd'). The
+body is compressed on the fly, '.gz'/'.zst' is added to the file name and the
+blob's content_encoding is set to the compression. Streamed bodies are read
+on a separate thread from the one compressing and uploading them, so
+compression does not slow down the network reads.
+
+Every write is timed as a blob.upload span (see instrumentation.py) counting
+the bytes of the body before compression.
+
 Python Module Requirements:
 
- * functools
+ * asyncio
  * io
+ * base64
+ * queue
+ * threading
+ * zlib
+ * zstandard (optional, for zstd compression)
  * pandas
+ * requests
+ * aiohttp
+ * azure.core
  * azure.storage.blob
+ * azure.storage.blob.aio (with aiohttp, for blob_write_async)
 
 Custom Module Requirements:
 
  * connections.py
+ * instrumentation.py
 """
 
-from functools import wraps # for debugging decorator function
-
+import asyncio # compression off the event loop in the async functions
 import io as io # used to process csv files
+import base64 # block ids of staged uploads
+import queue # hands streamed chunks to the compressing thread
+import threading # guards the client cache
+import zlib # gzip compression
 import pandas as pd # used to process csv files
 
-from azure.storage.blob import BlobClient, ContentSettings, BlobServiceClient
+import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+from azure.core.pipeline.transport import RequestsTransport, AioHttpTransport
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings, BlobServiceClient, BlobBlock
+# async client used by the asyncio extraction engine (request_api_async.py)
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+
+try:
+    import zstandard # optional, only needed for zstd compression
+except ImportError:
+    zstandard = None
 
 # Connections module contains code to generate connection strings.
 import connections as cn
 cn.init()
 
-# Set DEBUG to true to return function arguments and return values
-DEBUG = False
-
-# Print the argument names and values and return values for debugging
-def debug_log(function):
-    @wraps(function)
-    def wrapper(*args, **kwargs):
-        if DEBUG:
-            print(">> Called", function.__name__, "\n",
-                {**dict(zip(function.__code__.co_varnames, args)), **kwargs})
-        result = function(*args, **kwargs)
-        if DEBUG:
-            print(">>", function.__name__, "return:\n", result)
-        return result
-    return wrapper
+from instrumentation import instrumented, span
+
+# Connection pool and upload settings shared by every blob client.
+BLOB_POOL_SIZE = 50 # max open connections to the storage account
+BLOB_MAX_CONCURRENCY = 4 # parallel block uploads/downloads per blob
+BLOB_MAX_BLOCK_SIZE = 4 * 1024 * 1024 # block size of chunked uploads
+BLOB_MAX_SINGLE_PUT_SIZE = 64 * 1024 * 1024 # larger bodies upload in blocks
+
+# Compression settings. The compression name is also the blob's 
+# content_encoding.
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSION_QUEUE_SIZE = 8 # chunks read ahead of the compressing thread
+
+# Client cache. RLock because get_container_client() calls 
+# get_blob_service_client() while holding it.
+blob_clients_lock = threading.RLock()
+blob_service_client = None
+container_clients = {}
+async_blob_service_client = None
+async_container_clients = {}
+async_transport_session = None
+
+# Split a folder path such as 'raw/source/endpoint' into the container name 
+# ('raw') and the blob name prefix inside it ('source/endpoint/').
+def split_container_name(container_name):
+    container, _, folder = container_name.partition('/')
+    if folder:
+        folder = folder.rstrip('/') + '/'
+    return container, folder
+
+# Get (or create) the BlobServiceClient shared by all blob functions.
+def get_blob_service_client():
+    global blob_service_client
+    with blob_clients_lock:
+        if blob_service_client is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=BLOB_POOL_SIZE, pool_maxsize=BLOB_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            transport = RequestsTransport(session=session, session_owner=False)
+            blob_service_client = BlobServiceClient.from_connection_string(
+                cn.blob_connection_string, transport=transport, 
+                max_block_size=BLOB_MAX_BLOCK_SIZE, 
+                max_single_put_size=BLOB_MAX_SINGLE_PUT_SIZE)
+    return blob_service_client
+
+# Get (or create) the cached ContainerClient for a container.
+def get_container_client(container):
+    with blob_clients_lock:
+        container_client = container_clients.get(container)
+        if container_client is None:
+            container_client = \
+                get_blob_service_client().get_container_client(container)
+            container_clients[container] = container_client
+    return container_client
+
+# Get a BlobClient for a file in a folder path ('raw/source/endpoint').
+def get_blob_client(container_name, file_name):
+    container, folder = split_container_name(container_name)
+    return get_container_client(container).get_blob_client(folder + file_name)
+
+# Get (or create) the cached async ContainerClient for a container. Async 
+# clients belong to the running event loop, close them with 
+# close_async_blob_clients() before the loop ends.
+def get_async_container_client(container):
+    global async_blob_service_client, async_transport_session
+    if async_blob_service_client is None:
+        async_transport_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=BLOB_POOL_SIZE))
+        transport = AioHttpTransport(
+            session=async_transport_session, session_owner=False)
+        async_blob_service_client = \
+            AsyncBlobServiceClient.from_connection_string(
+                cn.blob_connection_string, transport=transport, 
+                max_block_size=BLOB_MAX_BLOCK_SIZE, 
+                max_single_put_size=BLOB_MAX_SINGLE_PUT_SIZE)
+    container_client = async_container_clients.get(container)
+    if container_client is None:
+        container_client = \
+            async_blob_service_client.get_container_client(container)
+        async_container_clients[container] = container_client
+    return container_client
+
+# Close the cached async clients and their transport.
+async def close_async_blob_clients():
+    global async_blob_service_client, async_transport_session
+    for container_client in async_container_clients.values():
+        await container_client.close()
+    async_container_clients.clear()
+    if async_blob_service_client is not None:
+        await async_blob_service_client.close()
+        async_blob_service_client = None
+    if async_transport_session is not None:
+        await async_transport_session.close()
+        async_transport_session = None
+
+# Blob file name with the extension of the compression, if any.
+def compressed_file_name(file_name, compression):
+    if compression is None:
+        return file_name
+    return file_name + COMPRESSION_EXTENSIONS[compression]
+
+# New streaming compressor object (compress() / flush()) for a compression.
+def new_compressor(compression):
+    if compression == 'gzip':
+        # wbits 31: deflate with a gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard module')
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        raise ValueError('unknown compression: ' + str(compression))
+
+# Compress a whole body held in memory.
+def compress_body(body, compression):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    compressor = new_compressor(compression)
+    return compressor.compress(body) + compressor.flush()
+
+# Put an item on a queue unless stopped is set first.
+def put_unless_stopped(item_queue, item, stopped):
+    while not stopped.is_set():
+        try:
+            item_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Read an iterable of chunks on a background thread, up to maxsize chunks 
+# ahead of the consumer. Errors raised by the iterable are re-raised to the 
+# consumer.
+def threaded_chunks(chunks, maxsize = COMPRESSION_QUEUE_SIZE):
+    chunk_queue = queue.Queue(maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def read_chunks():
+        try:
+            for chunk in chunks:
+                if not put_unless_stopped(chunk_queue, chunk, stopped):
+                    return
+            item = done
+        except Exception as err:
+            item = err
+        put_unless_stopped(chunk_queue, item, stopped)
+
+    threading.Thread(target=read_chunks, daemon=True).start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
 
 # Writing content to blob storage
-@debug_log
-def blob_write(content_type, container_name, file_name, body):
-    file_content_settings = ContentSettings(content_type=content_type)
-    blob_service_client  = BlobServiceClient.from_connection_string(
-        cn.blob_connection_string)
-    blob_client = blob_service_client.get_blob_client(
-        container_name,blob=file_name)
-    blob_client.upload_blob(
-        body, overwrite=True, content_settings=file_content_settings)    
+def blob_write(
+        content_type, container_name, file_name, body, compression = None):
+    with span('blob.upload', container=container_name) as upload:
+        file_content_settings = ContentSettings(
+            content_type=content_type, content_encoding=compression)
+        upload.add('bytes', len(body))
+        if compression is not None:
+            body = compress_body(body, compression)
+            file_name = compressed_file_name(file_name, compression)
+        blob_client = get_blob_client(container_name, file_name)
+        blob_client.upload_blob(
+            body, overwrite=True, content_settings=file_content_settings, 
+            max_concurrency=BLOB_MAX_CONCURRENCY)
+
+# Writing content to blob storage from a coroutine
+async def blob_write_async(
+        content_type, container_name, file_name, body, compression = None):
+    with span('blob.upload', container=container_name) as upload:
+        file_content_settings = ContentSettings(
+            content_type=content_type, content_encoding=compression)
+        upload.add('bytes', len(body))
+        if compression is not None:
+            # compress in a worker thread to keep the event loop free
+            body = await asyncio.to_thread(compress_body, body, compression)
+            file_name = compressed_file_name(file_name, compression)
+        container, folder = split_container_name(container_name)
+        blob_client = get_async_container_client(container).get_blob_client(
+            folder + file_name)
+        await blob_client.upload_blob(
+            body, overwrite=True, content_settings=file_content_settings, 
+            max_concurrency=BLOB_MAX_CONCURRENCY)
  
+# Block id for the n-th staged block. All ids of a blob must have the same 
+# length.
+def block_id(block_number):
+    return base64.b64encode(
+        '{:08d}'.format(block_number).encode()).decode()
+
+# File-like writer that uploads a block blob in staged blocks while data is 
+# written to it, holding at most one block in memory. Written data is 
+# compressed on the fly when a compression is given (tell() still counts 
+# uncompressed bytes). close() commits the block list; leaving a "with" block 
+# on an exception does not commit, so a failed upload never replaces an 
+# existing blob.
+class BlobBlockWriter:
+    def __init__(
+            self, content_type, container_name, file_name, 
+            block_size = BLOB_MAX_BLOCK_SIZE, compression = None):
+        self.blob_client = get_blob_client(
+            container_name, compressed_file_name(file_name, compression))
+        self.content_settings = ContentSettings(
+            content_type=content_type, content_encoding=compression)
+        self.compressor = None
+        if compression is not None:
+            self.compressor = new_compressor(compression)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.block_ids = []
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit = exc_type is None)
+
+    def write(self, data):
+        self.position += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.stage_block(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def stage_block(self, data):
+        new_block_id = block_id(len(self.block_ids))
+        self.blob_client.stage_block(new_block_id, bytes(data))
+        self.block_ids.append(new_block_id)
+
+    def close(self, commit = True):
+        if self.closed:
+            return
+        self.closed = True
+        if not commit:
+            return
+        if self.compressor is not None:
+            self.buffer.extend(self.compressor.flush())
+        if self.buffer:
+            self.stage_block(self.buffer)
+            self.buffer = bytearray()
+        self.blob_client.commit_block_list(
+            [BlobBlock(block_id=block) for block in self.block_ids], 
+            content_settings=self.content_settings)
+
+# Writing an iterable of byte chunks to blob storage without holding the 
+# whole body in memory. With compression the chunks are read on a separate 
+# thread so compressing does not hold up the network reads.
+def blob_write_stream(
+        content_type, container_name, file_name, chunks, compression = None):
+    with span('blob.upload', container=container_name) as upload:
+        if compression is not None:
+            chunks = threaded_chunks(chunks)
+        with BlobBlockWriter(
+                content_type, container_name, file_name, 
+                compression = compression) as writer:
+            for chunk in chunks:
+                upload.add('bytes', len(chunk))
+                writer.write(chunk)
+        
+# Writing an async iterable of byte chunks to blob storage from a coroutine, 
+# staging BLOB_MAX_BLOCK_SIZE blocks as they fill.
+async def blob_write_stream_async(
+        content_type, container_name, file_name, chunks, compression = None):
+    with span('blob.upload', container=container_name) as upload:
+        container, folder = split_container_name(container_name)
+        blob_client = get_async_container_client(container).get_blob_client(
+            folder + compressed_file_name(file_name, compression))
+        compressor = None
+        if compression is not None:
+            compressor = new_compressor(compression)
+        buffer = bytearray()
+        block_ids = []
+        async for chunk in chunks:
+            upload.add('bytes', len(chunk))
+            if compressor is not None:
+                # compress in a worker thread to keep the event loop free
+                chunk = await asyncio.to_thread(compressor.compress, chunk)
+            buffer.extend(chunk)
+            while len(buffer) >= BLOB_MAX_BLOCK_SIZE:
+                block_ids.append(block_id(len(block_ids)))
+                await blob_client.stage_block(
+                    block_ids[-1], bytes(buffer[:BLOB_MAX_BLOCK_SIZE]))
+                del buffer[:BLOB_MAX_BLOCK_SIZE]
+        if compressor is not None:
+            buffer.extend(compressor.flush())
+        if buffer:
+            block_ids.append(block_id(len(block_ids)))
+            await blob_client.stage_block(block_ids[-1], bytes(buffer))
+        await blob_client.commit_block_list(
+            [BlobBlock(block_id=block) for block in block_ids], 
+            content_settings=ContentSettings(
+                content_type=content_type, content_encoding=compression))
+
+# Read a blob's content (bytes), None when the blob does not exist.
+@instrumented
+def blob_read(container_name, file_name):
+    blob = get_blob_client(container_name, file_name)
+    try:
+        return blob.download_blob(
+            max_concurrency=BLOB_MAX_CONCURRENCY).readall()
+    except ResourceNotFoundError:
+        return None
+
+# Delete a blob, if it exists.
+@instrumented
+def blob_delete(container_name, file_name):
+    blob = get_blob_client(container_name, file_name)
+    try:
+        blob.delete_blob()
+    except ResourceNotFoundError:
+        pass
+
 # Reading csv files (config files, etc.)
-@debug_log
+@instrumented
 def blob_read_csv(config_file, root_folder_name):
-    blob = BlobClient.from_connection_string(
-        conn_str=cn.blob_connection_string, container_name=root_folder_name, 
-        blob_name=config_file)
-    config = blob.download_blob()
+    blob = get_blob_client(root_folder_name, config_file)
+    config = blob.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY)
     with io.BytesIO() as buf:
         config.readinto(buf)
         # needed to reset the buffer, otherwise, panda won't read from the start
@@ -69,14 +430,12 @@ def blob_read_csv(config_file, root_folder_name):
         config_data_list = config_data.to_dict('records')
     return config_data_list
 
-# Getting file count for blob storage folder
-@debug_log
+# Getting file count for blob storage folder. Compressed files keep the 
+# endpoint-date name prefix, so they are counted the same way.
+@instrumented
 def blob_file_count(
         data_lake_schema_name, no_schema_folder_name_value, file_name_start):
-    blob_service_client  = BlobServiceClient.from_connection_string(
-        cn.blob_connection_string)    
-    container_client = blob_service_client.get_container_client(
-        data_lake_schema_name)
+    container_client = get_container_client(data_lake_schema_name)
     file_count = 0
     for file in container_client.walk_blobs(
             no_schema_folder_name_value + '/' + file_name_start, delimiter='/'):
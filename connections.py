@@ -4,40 +4,163 @@ This script is utilized by other scripts in this program to connect to Azure
 Key vault to retrieve required credentials and connection strings.
 
 The URLs and resource names in this file assume that multiple environments
-are utilized and are identified by 'development', 'testing', 'production', 
+are utilized and are identified by 'development', 'testing', 'production',
 etc. It is likely your naming convention is different. Adjust the variables
 and URL strings accordingly.
 
+Nothing is fetched from Key vault until it is first used: the credential and
+SecretClient are created once, on first use, and secrets are cached by name
+for SECRET_TTL_SECONDS. secret_client, sql_connection_string and
+blob_connection_string are still read as module attributes (cn.
+sql_connection_string) and resolve lazily. prefetch_secrets() fetches many
+secrets concurrently, e.g. all secret names of a config file at batch start.
+
+For local runs (e.g. benchmark.py against Azurite and a local SQL Server) the
+ETL_SQL_CONNECTION_STRING and ETL_BLOB_CONNECTION_STRING environment
+variables, when set, are used instead of the Key vault connection strings,
+and cache_secret() puts local secret values in the cache.
+
 Python Module Requirements:
 
+ * os
+ * threading
+ * time
+ * concurrent.futures
  * azure.identity
  * azure.keyvault.secrets
+
+Custom Module Requirements:
+
+ * instrumentation.py
 """
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-def init():    
+from instrumentation import span
+
+# Secrets are fetched again once they are older than this.
+SECRET_TTL_SECONDS = 3600
+# Concurrent Key vault requests made by prefetch_secrets().
+SECRET_PREFETCH_WORKERS = 8
+# Environment variables overriding the Key vault connection strings.
+SQL_CONNECTION_STRING_VARIABLE = 'ETL_SQL_CONNECTION_STRING'
+BLOB_CONNECTION_STRING_VARIABLE = 'ETL_BLOB_CONNECTION_STRING'
+
+bi_environment = 'dev'
+
+clients = {} # the SecretClient, created on first use
+clients_lock = threading.Lock()
+secret_cache = {} # secret name: (value, expiry time)
+secret_locks = {} # secret name: lock, so a secret is only fetched once
+secret_cache_lock = threading.Lock()
+
+# Kept for the modules that call it at import; it no longer connects to
+# anything, connections are made lazily on first use.
+def init():
     global bi_environment
     bi_environment = 'dev'
-    
-    global secret_client
-    credential = DefaultAzureCredential()
-    secret_client = SecretClient(
-        vault_url='https://<initial keyvault url segment>' + bi_environment 
-        + '<final keyvault url segment>', credential=credential)
-    
-    global sql_connection_string
-    # Get sql connection string to pass to process_logging.py (so environment can 
-    # be set here rather than the module)
-    sql_kv_secret = secret_client.get_secret(
-        '<Keyvault secret name for Azure sql connection string>').value
+
+# Get (or create) the SecretClient for the environment's Key vault.
+def get_secret_client():
+    with clients_lock:
+        if 'secret_client' not in clients:
+            credential = DefaultAzureCredential()
+            clients['secret_client'] = SecretClient(
+                vault_url='https://<initial keyvault url segment>'
+                + bi_environment + '<final keyvault url segment>',
+                credential=credential)
+    return clients['secret_client']
+
+# Get a secret value by name, from the cache while it is younger than
+# SECRET_TTL_SECONDS. Concurrent callers asking for the same secret share
+# one Key vault request.
+def get_secret(name):
+    with secret_cache_lock:
+        cached = secret_cache.get(name)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        secret_lock = secret_locks.setdefault(name, threading.Lock())
+    with secret_lock:
+        # another caller may have fetched it while we waited for the lock
+        with secret_cache_lock:
+            cached = secret_cache.get(name)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+        with span('secret.fetch'):
+            value = get_secret_client().get_secret(name).value
+        with secret_cache_lock:
+            evict_expired_secrets()
+            secret_cache[name] = (value, time.monotonic() + SECRET_TTL_SECONDS)
+    return value
+
+# Put a secret value in the cache, so Key vault is not asked for it (local 
+# test values). It is kept for ttl seconds, for the whole run by default.
+def cache_secret(name, value, ttl = None):
+    expires = float('inf') if ttl is None else time.monotonic() + ttl
+    with secret_cache_lock:
+        secret_cache[name] = (value, expires)
+
+# Drop cached secrets past their TTL. Call with secret_cache_lock held.
+def evict_expired_secrets():
+    now = time.monotonic()
+    for name in [
+            name for name, (value, expires) in secret_cache.items()
+            if expires <= now]:
+        del secret_cache[name]
+
+# Fetch many secrets concurrently into the cache. Names that are blank or
+# 'none' are skipped; failures are ignored here and raised again when the
+# secret is asked for with get_secret().
+def prefetch_secrets(names):
+    names = {
+        name for name in names
+        if isinstance(name, str) and name and name.lower() != 'none'}
+    if not names:
+        return
+
+    def prefetch(name):
+        try:
+            get_secret(name)
+        except Exception:
+            pass
+
+    with ThreadPoolExecutor(
+            max_workers=min(SECRET_PREFETCH_WORKERS, len(names))) as executor:
+        list(executor.map(prefetch, names))
+
+# Sql connection string to pass to process_logging.py (so environment can
+# be set here rather than the module)
+def get_sql_connection_string():
+    if os.environ.get(SQL_CONNECTION_STRING_VARIABLE):
+        return os.environ[SQL_CONNECTION_STRING_VARIABLE]
+    sql_kv_secret = get_secret(
+        '<Keyvault secret name for Azure sql connection string>')
     driver= '{ODBC Driver 17 for SQL Server}'
-    sql_connection_string = 'DRIVER=' + driver + ';' + sql_kv_secret
-    global blob_connection_string
-    
-    # get data lake key to pass to blob_functions.py
-    blob_kv_secret = secret_client.get_secret(
-        '<Keyvault secret name for blob storage secret>').value
-    blob_connection_string = 'DefaultEndpointsProtocol=https; \
+    return 'DRIVER=' + driver + ';' + sql_kv_secret
+
+# Data lake connection string to pass to blob_functions.py
+def get_blob_connection_string():
+    if os.environ.get(BLOB_CONNECTION_STRING_VARIABLE):
+        return os.environ[BLOB_CONNECTION_STRING_VARIABLE]
+    blob_kv_secret = get_secret(
+        '<Keyvault secret name for blob storage secret>')
+    return 'DefaultEndpointsProtocol=https; \
         AccountName=<initial blob account name string>' + bi_environment \
-        + '<final blob account name string>;AccountKey=' + blob_kv_secret
\ No newline at end of file
+        + '<final blob account name string>;AccountKey=' + blob_kv_secret
+
+# Lazy module attributes, so cn.secret_client, cn.sql_connection_string and
+# cn.blob_connection_string keep working without connecting at import.
+def __getattr__(name):
+    if name == 'secret_client':
+        return get_secret_client()
+    elif name == 'sql_connection_string':
+        return get_sql_connection_string()
+    elif name == 'blob_connection_string':
+        return get_blob_connection_string()
+    raise AttributeError(
+        "module 'connections' has no attribute '" + name + "'")
@@ -35,6 +35,13 @@ Azure Service Requirements:
 
 Python Module Requirements:
 
+ * argparse
+ * asyncio
+ * aiohttp
+ * concurrent.futures
+ * contextlib
+ * threading
+ * urllib.parse
  * requests
  * json
  * xml.etree.ElementTree
@@ -50,145 +57,662 @@ Custom Module Requirements:
  * process_logging.py
  * blob_functions.py
  * request_api.py
+ * request_api_async.py
+ * lease_store.py
+ * instrumentation.py
 
 Syntax: python ./etl_orchestrator.py raw bureauoflaborstatistics
+
+Optional arguments:
+
+    --max-workers N           number of config rows loaded concurrently 
+                              (default 1, i.e. one row at a time)
+    --max-workers-per-host N  cap on concurrent rows calling the same api host
+    --run-all                 keep loading the remaining rows after a failure 
+                              instead of stopping at the first failed row
+    --engine threads|async    'threads' (default) calls the apis with 
+                              request_api.ApiCall, 'async' with 
+                              request_api_async.AsyncApiCall on one event loop
+    --sync-logging            write batch step log records as they happen 
+                              instead of queueing them for a background writer
+    --full-reload             request the full history of every row, ignoring 
+                              the last successful load of Delta rows
+    --resume BATCH_ID         finish a failed batch under the same BatchID: 
+                              rows it loaded are skipped and paged loads 
+                              continue from their page checkpoint
+    --distributed             begin a batch whose rows are shared out, 
+                              through leases, to this process and to 
+                              workers started with --join
+    --join BATCH_ID           load rows of a distributed batch begun by 
+                              another process, on this or another node
+    --lease-store STORE       where leases are kept: 'sql' (default, the 
+                              logging database) or 'sqlite:<path>' for 
+                              workers on one machine
+    --lease-seconds N         seconds a lease lasts without a heartbeat
+    --metrics EXPORTER        record step spans (see instrumentation.py) to 
+                              'jsonl:<path>', 'prometheus:<path>' or 'otel'; 
+                              may be given more than once
 """
 
-import sys
+import argparse
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from urllib.parse import urlparse
 
-from process_logging import log_batch, log_batch_step, get_last_batch_run
-from blob_functions import blob_read_csv, blob_file_count
+from process_logging import log_batch, log_batch_step, get_last_batch_runs, \
+    get_batch_steps, flush_step_log_writer, \
+    start_step_log_writer, stop_step_log_writer, close_connection_pool
+from blob_functions import blob_read_csv, blob_file_count, \
+    close_async_blob_clients
 import request_api as ra
+from request_api_async import AsyncApiCall, close_client_session
+from lease_store import get_lease_store, worker_name, LeaseHeartbeat, \
+    LEASE_SECONDS, CLAIM_POLL_SECONDS
+import instrumentation
+from instrumentation import span
 
 # Connections module contains code to generate connection strings.
 import connections as cn
 cn.init()
 
-def main(data_lake_schema_name, data_lake_folder_name):
-    # Define the source to be processed.
+# Endpoint results that do not fail the batch. 'Unchanged' endpoints had the 
+# same response as the last run and wrote nothing (see response_cache).
+SUCCESS_RESPONSES = ('Success', 'Unchanged')
+# Batch and batch step statuses are varchar(25) in the logging database.
+STATUS_MAX_LENGTH = 25
+
+# Status of a failed batch or batch step. reason (an error such as an 
+# exception name, or an endpoint name) is cut to STATUS_MAX_LENGTH, so a 
+# long name cannot make the log record itself fail to write.
+def failure_status(reason):
+    return ('Failure: ' + reason)[:STATUS_MAX_LENGTH]
+
+# Batch step name of a config row.
+def endpoint_step_name(config):
+    return 'Load File ' + config['endpoint_name']
+
+# Status of a config row already loaded by the batch being resumed, None 
+# when the row still has to be loaded.
+def completed_status(config, resume_statuses):
+    status = (resume_statuses or {}).get(endpoint_step_name(config))
+    if status in SUCCESS_RESPONSES:
+        return status
+    return None
+
+# Write the batch step log record for a config row. target_row_count is the
+# number of records written, None when it is unknown.
+def log_endpoint_step(
+        config, batch_id, root_folder_name, status, target_file_count, 
+        target_row_count = None):
     source_schema = 'API'
-    init_pipeline_name = 'python_test'
-    orchestration_tool = 'python'
-    do_not_include_today_flag = 0
-    config_file = 'api_config.csv'
-    date_string = datetime.now().strftime("%Y%m%d")
-    date_folder_name = datetime.now().strftime("/%Y/%m/%d")  # ("/%Y/%m")
-    root_folder_name = data_lake_schema_name + '/' + data_lake_folder_name
-    
-    # 00 - Initialize:
-    # Retrive the api endpoint configuration.
-    config_data_list = blob_read_csv(config_file, root_folder_name)
-    full_folder_name = root_folder_name + '/' \
-        + config_data_list[0]['endpoint_name']
-
-    # Define the batch logging constant variables.
-    project = config_data_list[0]['project']
-    source_name = config_data_list[0]['source_name']
-    target_system = config_data_list[0]['target_system']
-    target_data_source = config_data_list[0]['target_data_source']
-
-    # Begin batch logging.
-    need_return_value = True
-    batch_id = None
-    status = 'Begin'
-    return_value = log_batch(
-        batch_id, init_pipeline_name, need_return_value, orchestration_tool, 
-        project, source_name, status, target_system)
-    # Save returned batch logging variables to update audit record at batch 
-    # completion.
-    batch_id = return_value[0]
-
-    # 01 - Main
-    # Loop through each of the endpoints.
-    for config in config_data_list:
-        target_file_count = None
-        step_name = 'Load File ' + config['endpoint_name']
-
-        target_object = config['endpoint_name']
-        print('Starting load: ' + source_name + ': ' + target_object)
-        target_schema = root_folder_name + '/' + target_object
-        full_folder_name = root_folder_name + '/' \
-            + config['endpoint_name'] # + date_folder_name
-        target_update_strategy = config['target_update_strategy']
-        no_schema_folder_name = data_lake_folder_name + '/' \
-            + target_object  # + date_folder_name
-
-        # 02 - Monitor Loads
-        # Begin batch step logging.
-        step_status = 'Begin'
-        log_batch_step(
-            batch_id, step_name, step_status, source_schema, root_folder_name, 
-            target_update_strategy, target_schema, target_object, 
-            target_file_count)
-
-        # Get password and/or token keyvault secret names from the config file.
+    target_object = config['endpoint_name']
+    step_name = endpoint_step_name(config)
+    target_schema = root_folder_name + '/' + target_object
+    target_update_strategy = config['target_update_strategy']
+    log_batch_step(
+        batch_id, step_name, status, source_schema, root_folder_name, 
+        target_update_strategy, target_schema, target_object, 
+        target_file_count, target_row_count)
+
+# Get password and/or token keyvault secret names from the config file.
+# Secrets come from the connections module cache, so rows sharing a secret
+# name share one Key vault call.
+def get_endpoint_credentials(config):
+    try:
+        password = cn.get_secret(config['keyvault_secret_password_name'])
+    except ValueError:
+        password = 'none'
+    if config['keyvault_secret_get_access_token_name'] != 'none':
         try:
-            password = cn.secret_client.get_secret(
-                config['keyvault_secret_password_name']).value
+            access_token = cn.get_secret(
+                config['keyvault_secret_get_access_token_name'])
         except ValueError:
-            password = 'none'
-        if config['keyvault_secret_get_access_token_name'] != 'none':
-            try:
-                access_token = cn.secret_client.get_secret(
-                    config['keyvault_secret_get_access_token_name']
-                    ).value
-            except ValueError:
-                access_token = ''
-        else:
             access_token = ''
-
-        aip_config_row = config
-
-        # For future dev
-        date_last_run = get_last_batch_run(
-            target_system, full_folder_name, target_object, 
-            do_not_include_today_flag) 
-
-        # 03 - Source to Data Lake
-        # Call the api.
-        step = ra.ApiCall(
-            aip_config_row, full_folder_name, access_token, password)
-
-        # Count the number of files copied to blob storage for batch step log.
-        if step.success_response == 'Success':
-            status = step.success_response
+    else:
+        access_token = ''
+    return password, access_token
+
+# Complete the batch step for a config row: count the number of files copied 
+# to blob storage and write the final batch step log record, with the 
+# number of records the api call wrote (target_row_count, None when 
+# unknown).
+def finish_endpoint(
+        config, batch_id, data_lake_schema_name, data_lake_folder_name, 
+        source_name, date_string, success_response, target_row_count = None):
+    root_folder_name = data_lake_schema_name + '/' + data_lake_folder_name
+    target_object = config['endpoint_name']
+    no_schema_folder_name = data_lake_folder_name + '/' \
+        + target_object  # + date_folder_name
+    target_file_count = None
+    # Nothing was written: the response is the same as the last run's.
+    if success_response == 'Unchanged':
+        status = success_response
+        target_file_count = 0
+        target_row_count = 0
+    elif success_response == 'Success':
+        try:
+            status = success_response
             target_file_count = blob_file_count(
                 data_lake_schema_name, no_schema_folder_name, target_object 
                 + '-' + date_string)
-        else:
-            status = 'Failure: ' + step.success_response  
+        except Exception as err:
+            success_response = type(err).__name__
+    if success_response not in SUCCESS_RESPONSES:
+        status = failure_status(success_response)
+
+    # Complete batch step logging for the current endpoint.
+    log_endpoint_step(
+        config, batch_id, root_folder_name, status, target_file_count, 
+        target_row_count)
+    print('Finished load: ' + source_name + ': ' + target_object)
+    return success_response
+
+# Add the status and the counters of a config row's api call (pages, 
+# records, bytes, retries) to its step span.
+def end_step_span(step_span, success_response, counters):
+    step_span.set('status', success_response)
+    for counter, amount in counters.items():
+        step_span.add(counter, amount)
+
+# 02 - Monitor Loads & 03 - Source to Data Lake for a single config row.
+# Returns the success response of the api call, or None when the row was 
+# skipped because another row already failed in fail-fast mode. 
+# resume_statuses holds the step statuses of the batch being resumed (None 
+# for a new batch): rows it already loaded are not loaded again and paged 
+# loads continue from their checkpoint.
+def load_endpoint(
+        config, batch_id, data_lake_schema_name, data_lake_folder_name, 
+        source_name, target_system, date_string, fail_fast, stop_event, 
+        host_semaphore, date_last_run, request_batch, resume_statuses):
+    root_folder_name = data_lake_schema_name + '/' + data_lake_folder_name
+    target_object = config['endpoint_name']
+    full_folder_name = root_folder_name + '/' \
+        + config['endpoint_name'] # + date_folder_name
+
+    status = completed_status(config, resume_statuses)
+    if status is not None:
+        print('Already loaded: ' + source_name + ': ' + target_object)
+        return status
+
+    with host_semaphore:
+        # Do not start new rows once a row has failed in fail-fast mode.
+        if stop_event.is_set():
+            print('Skipped load: ' + source_name + ': ' + target_object)
+            return None
+        print('Starting load: ' + source_name + ': ' + target_object)
+
+        with span('step', source=source_name, endpoint=target_object) \
+                as step_span:
+            # 02 - Monitor Loads
+            # Begin batch step logging.
+            log_endpoint_step(
+                config, batch_id, root_folder_name, 'Begin', None)
+
+            counters = {}
+            try:
+                password, access_token = get_endpoint_credentials(config)
+
+                aip_config_row = config
+                checkpoint = ra.PageCheckpoint(
+                    full_folder_name, target_object, batch_id, date_string, 
+                    resume_statuses is not None)
+
+                # 03 - Source to Data Lake
+                # Call the api.
+                step = ra.ApiCall(
+                    aip_config_row, full_folder_name, access_token, password, 
+                    date_last_run, request_batch, checkpoint)
+                success_response = step.success_response
+                counters = step.counters.to_dict()
+            # An unexpected error in one row must not leave its step log 
+            # open or take down the rows running next to it.
+            except Exception as err:
+                success_response = type(err).__name__
+
+            success_response = finish_endpoint(
+                config, batch_id, data_lake_schema_name, 
+                data_lake_folder_name, source_name, date_string, 
+                success_response, counters.get('records'))
+            end_step_span(step_span, success_response, counters)
+
+    if fail_fast and success_response not in SUCCESS_RESPONSES:
+        stop_event.set()
+    return success_response
+
+# Asyncio version of load_endpoint(): the api call runs on the event loop, 
+# the blocking logging, Key Vault and file count calls run in worker threads.
+async def load_endpoint_async(
+        config, batch_id, data_lake_schema_name, data_lake_folder_name, 
+        source_name, target_system, date_string, fail_fast, stop_event, 
+        row_semaphore, host_semaphore, date_last_run, request_batch, 
+        resume_statuses):
+    root_folder_name = data_lake_schema_name + '/' + data_lake_folder_name
+    target_object = config['endpoint_name']
+    full_folder_name = root_folder_name + '/' + target_object
+
+    status = completed_status(config, resume_statuses)
+    if status is not None:
+        print('Already loaded: ' + source_name + ': ' + target_object)
+        return status
+
+    async with row_semaphore, host_semaphore:
+        # Do not start new rows once a row has failed in fail-fast mode.
+        if stop_event.is_set():
+            print('Skipped load: ' + source_name + ': ' + target_object)
+            return None
+        print('Starting load: ' + source_name + ': ' + target_object)
 
-        # Complete batch step logging for the current endpoint.
-        log_batch_step(
-            batch_id, step_name, status, source_schema, root_folder_name, 
-            target_update_strategy, target_schema, target_object, 
-            target_file_count)
-        print('Finished load: ' + source_name + ': ' + target_object)
+        with span('step', source=source_name, endpoint=target_object) \
+                as step_span:
+            # 02 - Monitor Loads
+            await asyncio.to_thread(
+                log_endpoint_step, config, batch_id, root_folder_name, 
+                'Begin', None)
 
-        if step.success_response == 'Success':
-            pass
+            counters = {}
+            try:
+                password, access_token = await asyncio.to_thread(
+                    get_endpoint_credentials, config)
+
+                checkpoint = ra.PageCheckpoint(
+                    full_folder_name, target_object, batch_id, date_string, 
+                    resume_statuses is not None)
+
+                # 03 - Source to Data Lake
+                step = AsyncApiCall(
+                    config, full_folder_name, access_token, password, 
+                    date_last_run, request_batch, checkpoint)
+                success_response = await step.run()
+                counters = step.counters.to_dict()
+            except Exception as err:
+                success_response = type(err).__name__
+
+            success_response = await asyncio.to_thread(
+                finish_endpoint, config, batch_id, data_lake_schema_name, 
+                data_lake_folder_name, source_name, date_string, 
+                success_response, counters.get('records'))
+            end_step_span(step_span, success_response, counters)
+
+    if fail_fast and success_response not in SUCCESS_RESPONSES:
+        stop_event.set()
+    return success_response
+
+# 01 - Main for the asyncio engine: load every config row on one event loop, 
+# up to max_workers rows at a time.
+async def load_endpoints_async(
+        config_data_list, batch_id, data_lake_schema_name, 
+        data_lake_folder_name, source_name, target_system, date_string, 
+        max_workers, max_workers_per_host, fail_fast, stop_event, 
+        dates_last_run, request_batches, resume_statuses):
+    row_semaphore = asyncio.Semaphore(max_workers)
+    host_semaphores = {}
+    for config in config_data_list:
+        host = urlparse(config['base_url']).netloc
+        if host not in host_semaphores:
+            host_semaphores[host] = asyncio.Semaphore(
+                max_workers_per_host or max_workers)
+    try:
+        success_responses = await asyncio.gather(*(
+            load_endpoint_async(
+                config, batch_id, data_lake_schema_name, 
+                data_lake_folder_name, source_name, target_system, 
+                date_string, fail_fast, stop_event, row_semaphore, 
+                host_semaphores[urlparse(config['base_url']).netloc], 
+                date_last_run, request_batch, resume_statuses)
+            for config, date_last_run, request_batch in zip(
+                config_data_list, dates_last_run, request_batches)))
+    finally:
+        await close_client_session()
+        await close_async_blob_clients()
+    return list(success_responses)
+
+# The batch of one source (a data lake folder with its config file): the 
+# config rows, the batch log record and what each row needs to load. 
+# Creating it begins the batch; finish() completes it. Used by main() and 
+# by etl_scheduler.py, which loads many sources on one worker pool. With 
+# join_batch_id the batch was begun by another process (a distributed 
+# batch) and is only joined.
+class SourceBatch:
+    def __init__(
+            self, data_lake_schema_name, data_lake_folder_name, 
+            full_reload=False, resume_batch_id=None, join_batch_id=None):
+        # Define the source to be processed.
+        self.init_pipeline_name = 'python_test'
+        self.orchestration_tool = 'python'
+        config_file = 'api_config.csv'
+        self.data_lake_schema_name = data_lake_schema_name
+        self.data_lake_folder_name = data_lake_folder_name
+        self.date_string = datetime.now().strftime("%Y%m%d")
+        date_folder_name = datetime.now().strftime("/%Y/%m/%d")  # ("/%Y/%m")
+        self.root_folder_name = data_lake_schema_name + '/' \
+            + data_lake_folder_name
+
+        # 00 - Initialize:
+        # Retrive the api endpoint configuration.
+        self.config_data_list = blob_read_csv(
+            config_file, self.root_folder_name)
+        config_data_list = self.config_data_list
+
+        # Define the batch logging constant variables.
+        self.project = config_data_list[0]['project']
+        self.source_name = config_data_list[0]['source_name']
+        self.target_system = config_data_list[0]['target_system']
+        self.target_data_source = config_data_list[0]['target_data_source']
+
+        # Fetch every distinct keyvault secret named in the config 
+        # concurrently, so the rows read their credentials from the cache.
+        cn.prefetch_secrets(
+            [config['keyvault_secret_password_name'] 
+                for config in config_data_list]
+            + [config['keyvault_secret_get_access_token_name'] 
+                for config in config_data_list])
+
+        # Resuming a failed batch: keep its BatchID and date (file names use 
+        # the date), and get the rows it already loaded.
+        self.resume_statuses = None
+        if resume_batch_id is not None:
+            start_datetime, self.resume_statuses = get_batch_steps(
+                resume_batch_id)
+            if start_datetime is None:
+                raise ValueError(
+                    'unknown batch to resume: ' + str(resume_batch_id))
+            self.date_string = start_datetime.strftime("%Y%m%d")
+
+        if join_batch_id is not None:
+            # Joining a distributed batch: use its BatchID and date.
+            start_datetime = get_batch_steps(join_batch_id)[0]
+            if start_datetime is None:
+                raise ValueError('unknown batch to join: ' + str(join_batch_id))
+            self.date_string = start_datetime.strftime("%Y%m%d")
+            self.batch_id = join_batch_id
         else:
-            # Complete the batch logging if current step failed.
-            status = 'Failure: ' + target_object
-            need_return_value = False
-            log_batch(
-                batch_id, init_pipeline_name, need_return_value, 
-                orchestration_tool, project, source_name, status, target_system)
-            break
-
-    # Complete batch logging for a successful load.
-    if step.success_response == 'Success':
-        need_return_value = False
+            # Begin batch logging.
+            need_return_value = True
+            batch_id = resume_batch_id
+            status = 'Begin'
+            return_value = log_batch(
+                batch_id, self.init_pipeline_name, need_return_value, 
+                self.orchestration_tool, self.project, self.source_name, 
+                status, self.target_system)
+            # Save returned batch logging variables to update audit record 
+            # at batch completion.
+            self.batch_id = return_value[0]
+
+        # Get the date of the last successful load of every endpoint with one 
+        # call. Delta rows only request what changed since then; a full 
+        # reload requests every row's full history.
+        if full_reload:
+            last_batch_runs = {}
+        else:
+            do_not_include_today_flag = 0
+            last_batch_runs = get_last_batch_runs(
+                self.target_system, self.endpoints(), 
+                do_not_include_today_flag)
+        self.dates_last_run = [
+            last_batch_runs.get(endpoint) for endpoint in self.endpoints()]
+
+        # Rows of apis that accept many ids per request (coalesce_batch_size) 
+        # share batched requests.
+        self.request_batches = ra.coalesce_requests(
+            config_data_list, self.dates_last_run)
+
+        # Rows stop being started once this is set (fail-fast mode only).
+        self.stop_event = threading.Event()
+
+    # (target schema, target object) of each config row, as logged in the 
+    # batch step log.
+    def endpoints(self):
+        return [
+            (self.root_folder_name + '/' + config['endpoint_name'], 
+                config['endpoint_name']) 
+            for config in self.config_data_list]
+
+    # load_endpoint() for the config row at index. resume_statuses 
+    # defaults to those of the batch being resumed.
+    def load_row(
+            self, index, fail_fast, host_semaphore, resume_statuses=None):
+        return load_endpoint(
+            self.config_data_list[index], self.batch_id, 
+            self.data_lake_schema_name, self.data_lake_folder_name, 
+            self.source_name, self.target_system, self.date_string, 
+            fail_fast, self.stop_event, host_semaphore, 
+            self.dates_last_run[index], self.request_batches[index], 
+            self.resume_statuses if resume_statuses is None 
+                else resume_statuses)
+
+    # Config rows loaded together by one worker of a distributed batch: 
+    # rows sharing a batched request (coalesce_batch_size) form one shard, 
+    # every other row is a shard of its own. Returns {shard key (the 
+    # endpoint_name of its first row): [row indexes]} in config order.
+    def shards(self):
+        shards = {}
+        shard_keys = {} # id of a RequestBatch: its shard key
+        for index, (config, request_batch) in enumerate(
+                zip(self.config_data_list, self.request_batches)):
+            shard_key = config['endpoint_name']
+            if request_batch is not None:
+                shard_key = shard_keys.setdefault(id(request_batch), shard_key)
+            shards.setdefault(shard_key, []).append(index)
+        return shards
+
+    # Complete batch logging with the success response of every row (None 
+    # for skipped rows). The batch fails on the first failed row in config 
+    # file order. Returns the batch status.
+    def finish(self, success_responses, logging_error = None):
         status = 'Success'
+        for config, success_response in zip(
+                self.config_data_list, success_responses):
+            if success_response is not None \
+                    and success_response not in SUCCESS_RESPONSES:
+                status = failure_status(config['endpoint_name'])
+                break
+        # Step records were lost: the step log does not show the batch.
+        if logging_error is not None:
+            status = 'Failure: step logging'
+        need_return_value = False
         log_batch(
-            batch_id, init_pipeline_name, need_return_value, orchestration_tool, 
-            project, source_name, status, target_system)
-    else:
-        pass
-    print(step.success_response)
+            self.batch_id, self.init_pipeline_name, need_return_value, 
+            self.orchestration_tool, self.project, self.source_name, status, 
+            self.target_system)
+        print(status)
+        return status
+
+# Stop the background step log writer once its queue is written. The error 
+# of records that could not be written is returned (None when all were) 
+# instead of raised, so the batch record can still be completed first.
+def stop_step_logging():
+    try:
+        stop_step_log_writer()
+    except Exception as err:
+        return err
+    return None
+
+# 01 - Main for a worker of a distributed batch: claim shards of the batch 
+# from the lease store and load their rows, on max_workers threads, until 
+# every shard is done. A shard whose worker stopped heartbeating is claimed 
+# again, and its paged loads continue from their checkpoints. Step log 
+# records are written before a shard is marked done, so the worker that 
+# completes the batch sees them all. Every worker registers the shards 
+# (registering is idempotent) before it claims any: a worker joining before 
+# the batch starter registered them would otherwise find no shard left and 
+# complete the batch empty. Returns True when this worker claimed the 
+# completion of the batch.
+def load_shards(source, lease_store, max_workers, fail_fast, lease_seconds):
+    owner = worker_name()
+    shards = source.shards()
+    lease_store.register_shards(source.batch_id, list(shards))
+    heartbeat = LeaseHeartbeat(
+        lease_store, source.batch_id, owner, lease_seconds)
+
+    def work():
+        while True:
+            claimed = lease_store.claim(source.batch_id, owner, lease_seconds)
+            if claimed is None:
+                # Other workers still hold shards: wait for them, claiming 
+                # a shard again should their lease expire.
+                if lease_store.unfinished_count(source.batch_id) == 0:
+                    return
+                time.sleep(CLAIM_POLL_SECONDS)
+                continue
+            shard_key, attempts = claimed
+            results = {}
+            for index in shards[shard_key]:
+                results[source.config_data_list[index]['endpoint_name']] = \
+                    source.load_row(
+                        index, fail_fast, contextlib.nullcontext(), 
+                        {} if attempts > 1 else None)
+            failed = any(
+                result is not None and result not in SUCCESS_RESPONSES 
+                for result in results.values())
+            flush_step_log_writer()
+            if not lease_store.complete(
+                    source.batch_id, shard_key, owner, results, 
+                    fail_fast and failed):
+                print('Lease lost, shard loaded again elsewhere: ' + shard_key)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(work) for worker in range(max_workers)]
+            for future in futures:
+                future.result()
+    finally:
+        heartbeat.stop()
+    return lease_store.claim_finish(source.batch_id, owner)
+
+# 01 - Main for the threads engine: load the config rows of a source on 
+# max_workers threads, started in config file order. A row whose api host 
+# already has max_workers_per_host rows running waits without holding a 
+# thread, and the rows behind it for other hosts start first: host caps are 
+# checked when a row is handed to the pool, as in etl_scheduler.run_rows(). 
+# Returns the success response of every row.
+def load_rows(source, max_workers, max_workers_per_host, fail_fast):
+    hosts = [
+        urlparse(config['base_url']).netloc 
+        for config in source.config_data_list]
+    pending = list(range(len(hosts)))
+    success_responses = [None] * len(hosts)
+    running = {} # future: row index
+    running_by_host = collections.Counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for index in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if max_workers_per_host \
+                        and running_by_host[hosts[index]] >= max_workers_per_host:
+                    continue
+                pending.remove(index)
+                future = executor.submit(
+                    source.load_row, index, fail_fast, 
+                    contextlib.nullcontext())
+                running[future] = index
+                running_by_host[hosts[index]] += 1
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                running_by_host[hosts[index]] -= 1
+                success_responses[index] = future.result()
+    return success_responses
+
+def main(
+        data_lake_schema_name, data_lake_folder_name, max_workers=1, 
+        max_workers_per_host=None, fail_fast=True, engine='threads', 
+        background_logging=True, full_reload=False, resume_batch_id=None, 
+        distributed=False, join_batch_id=None, lease_store='sql', 
+        lease_seconds=LEASE_SECONDS):
+    # 00 - Initialize: read the config file and begin (or join) the batch.
+    source = SourceBatch(
+        data_lake_schema_name, data_lake_folder_name, full_reload, 
+        resume_batch_id, join_batch_id)
+    config_data_list = source.config_data_list
+
+    if distributed or join_batch_id is not None:
+        lease_store = get_lease_store(lease_store)
+        if join_batch_id is None:
+            print('Distributed batch: ' + str(source.batch_id))
+        if background_logging:
+            start_step_log_writer()
+        try:
+            finishing = load_shards(
+                source, lease_store, max_workers, fail_fast, lease_seconds)
+        finally:
+            logging_error = stop_step_logging()
+        # Exactly one worker completes the batch, with every shard's results.
+        if finishing:
+            results = lease_store.results(source.batch_id)
+            source.finish([
+                results.get(config['endpoint_name']) 
+                for config in config_data_list], logging_error)
+        else:
+            print('Shards done, batch completed by another worker')
+        close_connection_pool()
+        if logging_error is not None:
+            raise logging_error
+        return
+
+    # Batch step log records are written by a background thread; they are 
+    # all written before the batch record is completed.
+    if background_logging:
+        start_step_log_writer()
+
+    # 01 - Main
+    # Load each of the endpoints, up to max_workers at a time.
+    try:
+        if engine == 'async':
+            success_responses = asyncio.run(load_endpoints_async(
+                config_data_list, source.batch_id, data_lake_schema_name, 
+                data_lake_folder_name, source.source_name, 
+                source.target_system, source.date_string, max_workers, 
+                max_workers_per_host, fail_fast, source.stop_event, 
+                source.dates_last_run, source.request_batches, 
+                source.resume_statuses))
+        else:
+            success_responses = load_rows(
+                source, max_workers, max_workers_per_host, fail_fast)
+    finally:
+        logging_error = stop_step_logging()
+
+    # Complete batch logging, as a failure when step records could not be 
+    # written, before the logging error is raised.
+    source.finish(success_responses, logging_error)
+    close_connection_pool()
+    if logging_error is not None:
+        raise logging_error
     
 if __name__ == '__main__':
-    data_lake_schema_name = sys.argv[1]
-    data_lake_folder_name = sys.argv[2]
-    main(data_lake_schema_name, data_lake_folder_name)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_lake_schema_name')
+    parser.add_argument('data_lake_folder_name')
+    parser.add_argument('--max-workers', type=int, default=1)
+    parser.add_argument('--max-workers-per-host', type=int, default=None)
+    parser.add_argument('--run-all', action='store_true')
+    parser.add_argument(
+        '--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--sync-logging', action='store_true')
+    parser.add_argument('--full-reload', action='store_true')
+    parser.add_argument('--resume', type=int, default=None, metavar='BATCH_ID')
+    parser.add_argument('--distributed', action='store_true')
+    parser.add_argument('--join', type=int, default=None, metavar='BATCH_ID')
+    parser.add_argument('--lease-store', default='sql')
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS)
+    parser.add_argument('--metrics', action='append', default=[])
+    args = parser.parse_args()
+    if (args.distributed or args.join is not None) \
+            and (args.engine != 'threads' or args.resume is not None):
+        parser.error('worker mode runs with --engine threads, without --resume')
+    instrumentation.start(args.metrics)
+    try:
+        main(
+            args.data_lake_schema_name, args.data_lake_folder_name, 
+            args.max_workers, args.max_workers_per_host, not args.run_all, 
+            args.engine, not args.sync_logging, args.full_reload, 
+            args.resume, args.distributed, args.join, args.lease_store, 
+            args.lease_seconds)
+    finally:
+        instrumentation.stop()
@@ -0,0 +1,249 @@
+"""ETL Scheduler
+
+This script loads many sources (data lake folders, each with its own
+api_config.csv) in one process, on one shared pool of worker threads, instead
+of one etl_orchestrator.py process per source. Key vault secrets, token
+caches, http sessions, blob clients and SQL connections are set up once and
+shared by every source.
+
+Each source still gets its own batch (see etl_orchestrator.SourceBatch), so
+batch logging, watermarks and fail-fast behave as with etl_orchestrator.py.
+
+Rows are started longest first: the expected duration of each row is the
+average of its last successful loads in METADATA.BatchStepLog (see
+process_logging.get_step_durations()); rows without history are expected to
+take as long as the average row of their source. Starting the longest rows
+first keeps one long row from being left to run alone at the end, which
+shortens the overall run.
+
+So one large source cannot starve the others, a free worker takes the
+longest waiting row of the source with the fewest rows running, and no
+source runs more than its max_workers rows (--max-workers-per-source, or the
+manifest's max_workers column) at the same time.
+
+Python Module Requirements:
+
+ * argparse
+ * collections
+ * concurrent.futures
+ * contextlib
+ * csv
+
+Custom Module Requirements:
+
+ * etl_orchestrator.py
+ * process_logging.py
+ * instrumentation.py
+
+Syntax: python ./etl_scheduler.py raw bureauoflaborstatistics othersource
+        python ./etl_scheduler.py --manifest sources.csv
+
+The manifest is a csv file with the columns data_lake_schema_name,
+data_lake_folder_name and, optionally, max_workers (per-source cap).
+
+Optional arguments:
+
+    --max-workers N             number of rows loaded concurrently across all
+                                sources (default 4)
+    --max-workers-per-source N  cap on concurrent rows of one source
+    --max-workers-per-host N    cap on concurrent rows calling the same api
+                                host, across sources
+    --run-all                   keep loading the remaining rows of a source
+                                after one of its rows fails
+    --sync-logging              write batch step log records as they happen
+    --full-reload               request the full history of every row
+    --metrics EXPORTER          record step spans (see instrumentation.py) to
+                                'jsonl:<path>', 'prometheus:<path>' or 'otel';
+                                may be given more than once
+"""
+
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
+import csv
+from urllib.parse import urlparse
+
+from etl_orchestrator import SourceBatch, stop_step_logging
+import instrumentation
+from process_logging import get_step_durations, start_step_log_writer, \
+    close_connection_pool
+
+# Sources whose config files are read and batches begun at the same time.
+SOURCE_SETUP_WORKERS = 8
+
+# A config row waiting to be loaded, with its expected duration in seconds.
+ScheduledRow = collections.namedtuple(
+    'ScheduledRow', ['source', 'index', 'host', 'duration'])
+
+# Read the sources of a manifest csv file: a list of (data_lake_schema_name,
+# data_lake_folder_name, max_workers or None).
+def read_manifest(manifest_file):
+    with open(manifest_file, newline='', encoding='utf-8-sig') as file:
+        return [
+            (row['data_lake_schema_name'], row['data_lake_folder_name'],
+                int(row['max_workers']) if row.get('max_workers') else None)
+            for row in csv.DictReader(file)]
+
+# The rows of a source with their expected durations. Rows that never loaded
+# successfully get the average of the source's other rows (0 without any).
+def scheduled_rows(source):
+    durations = get_step_durations(source.target_system, source.endpoints())
+    known_durations = [
+        durations[endpoint] for endpoint in source.endpoints()
+        if durations.get(endpoint) is not None]
+    default_duration = sum(known_durations) / len(known_durations) \
+        if known_durations else 0
+    return [
+        ScheduledRow(
+            source, index, urlparse(config['base_url']).netloc,
+            durations.get(endpoint) or default_duration)
+        for index, (config, endpoint) in enumerate(
+            zip(source.config_data_list, source.endpoints()))]
+
+# The next row to start, or None while every waiting row is held back by
+# its source or host cap. pending is ordered longest first, so the longest
+# row of the source with the fewest running rows is taken.
+def next_row(
+        pending, running_by_source, running_by_host, source_caps,
+        max_workers_per_host):
+    best = None
+    for row in pending:
+        if running_by_source[row.source] >= source_caps[row.source]:
+            continue
+        if max_workers_per_host \
+                and running_by_host[row.host] >= max_workers_per_host:
+            continue
+        if best is None \
+                or running_by_source[row.source] \
+                < running_by_source[best.source]:
+            best = row
+    return best
+
+# Load the rows of every source on one pool of max_workers threads. Returns
+# a dictionary of each source to the success responses of its rows.
+def run_rows(
+        sources, source_caps, max_workers, max_workers_per_host, fail_fast):
+    pending = []
+    for source in sources:
+        pending.extend(scheduled_rows(source))
+    pending.sort(key=lambda row: row.duration, reverse=True)
+    success_responses = {
+        source: [None] * len(source.config_data_list) for source in sources}
+    running = {} # future: row
+    running_by_source = collections.Counter()
+    running_by_host = collections.Counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            while len(running) < max_workers:
+                row = next_row(
+                    pending, running_by_source, running_by_host,
+                    source_caps, max_workers_per_host)
+                if row is None:
+                    break
+                pending.remove(row)
+                # Host caps are enforced here, so the row never waits on a
+                # semaphore while holding a worker.
+                future = executor.submit(
+                    row.source.load_row, row.index, fail_fast,
+                    contextlib.nullcontext())
+                running[future] = row
+                running_by_source[row.source] += 1
+                running_by_host[row.host] += 1
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                row = running.pop(future)
+                running_by_source[row.source] -= 1
+                running_by_host[row.host] -= 1
+                success_responses[row.source][row.index] = future.result()
+    return success_responses
+
+# Begin a batch for every source, load all their rows on one shared worker
+# pool and complete each batch. sources is a list of (data_lake_schema_name,
+# data_lake_folder_name, max_workers or None).
+def main(
+        sources, max_workers=4, max_workers_per_source=None,
+        max_workers_per_host=None, fail_fast=True, background_logging=True,
+        full_reload=False):
+
+    # A source whose config cannot be read or batch begun is reported and
+    # left out; the other sources still load.
+    def begin_source(source):
+        data_lake_schema_name, data_lake_folder_name, source_max_workers = \
+            source
+        try:
+            return SourceBatch(
+                data_lake_schema_name, data_lake_folder_name, full_reload)
+        except Exception as err:
+            print('Could not start: ' + data_lake_schema_name + '/'
+                + data_lake_folder_name + ': ' + repr(err))
+            return None
+
+    # 00 - Initialize: read every config file and begin every batch.
+    with ThreadPoolExecutor(
+            max_workers=min(SOURCE_SETUP_WORKERS, len(sources))) as executor:
+        source_batches = list(executor.map(begin_source, sources))
+    source_caps = {}
+    for source_batch, (schema_name, folder_name, source_max_workers) in zip(
+            source_batches, sources):
+        if source_batch is not None:
+            source_caps[source_batch] = min(
+                source_max_workers or max_workers_per_source or max_workers,
+                max_workers)
+    source_batches = list(source_caps)
+
+    if background_logging:
+        start_step_log_writer()
+
+    # 01 - Main
+    try:
+        success_responses = run_rows(
+            source_batches, source_caps, max_workers, max_workers_per_host,
+            fail_fast)
+    finally:
+        logging_error = stop_step_logging()
+
+    # Complete batch logging, once every step record is written. Every 
+    # batch is completed (as a failure when step records could not be 
+    # written) before a logging error is raised.
+    statuses = {}
+    for source_batch in source_batches:
+        statuses[(
+            source_batch.data_lake_schema_name,
+            source_batch.data_lake_folder_name)] = source_batch.finish(
+                success_responses[source_batch], logging_error)
+    close_connection_pool()
+    if logging_error is not None:
+        raise logging_error
+    return statuses
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_lake_schema_name', nargs='?')
+    parser.add_argument('data_lake_folder_names', nargs='*')
+    parser.add_argument('--manifest', default=None)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--max-workers-per-source', type=int, default=None)
+    parser.add_argument('--max-workers-per-host', type=int, default=None)
+    parser.add_argument('--run-all', action='store_true')
+    parser.add_argument('--sync-logging', action='store_true')
+    parser.add_argument('--full-reload', action='store_true')
+    parser.add_argument('--metrics', action='append', default=[])
+    args = parser.parse_args()
+    if args.manifest is not None:
+        sources = read_manifest(args.manifest)
+    else:
+        sources = [
+            (args.data_lake_schema_name, folder_name, None)
+            for folder_name in args.data_lake_folder_names]
+    if not sources:
+        parser.error('give data lake folder names or a --manifest')
+    instrumentation.start(args.metrics)
+    try:
+        main(
+            sources, args.max_workers, args.max_workers_per_source,
+            args.max_workers_per_host, not args.run_all,
+            not args.sync_logging, args.full_reload)
+    finally:
+        instrumentation.stop()
@@ -0,0 +1,347 @@
+"""Instrumentation
+
+This script is utilized by the other scripts in this program to time the
+steps of a load and count what they move, in place of the debug_log
+decorator each module used to define. Nothing is recorded until start() is
+called (the --metrics option of etl_orchestrator.py and etl_scheduler.py);
+until then span() returns a shared no-op span and @instrumented functions
+are called straight through, so the cost is one flag check per call.
+
+    start(['jsonl:/tmp/etl_spans.jsonl', 'prometheus:/tmp/etl.prom'])
+    with span('blob.upload', container=container_name) as upload:
+        ...
+        upload.add('bytes', len(body))
+    stop() # flushes and closes the exporters
+
+Spans are named after the step they time:
+
+  * secret.fetch: a Key vault secret read (cache misses only)
+  * token.request: an api access token request
+  * http.request: one attempt of an api request (status, attempt)
+  * json.parse: parsing a json response (bytes)
+  * blob.upload: a blob write (bytes, where the size is known up front)
+  * sql.call: one statement sent to the logging database
+  * step: a whole config row, with the pages, records, bytes and retries
+    of its load (see StepCounters)
+  * the qualified name of an @instrumented function, for everything else
+
+A span's parent is the span open around it in the same thread or asyncio
+task. Unlike debug_log, spans never hold function arguments or return
+values, so secrets cannot end up in the output.
+
+Finished spans go to every started exporter:
+
+  * jsonl:<path>: one json line per span
+  * prometheus:<path>: span counts, errors, duration histograms and counter
+    totals per span name, written in the Prometheus text format when
+    stopped (e.g. for the node_exporter textfile collector)
+  * otel: spans handed to the OpenTelemetry tracer provider configured for
+    the process (needs the opentelemetry-api module)
+
+StepCounters are kept whether or not spans are recorded: the records count
+of a row is written to the TargetRows column of METADATA.BatchStepLog.
+
+Python Module Requirements:
+
+ * contextvars
+ * functools
+ * inspect
+ * itertools
+ * json
+ * threading
+ * time
+ * opentelemetry-api (optional, for the otel exporter)
+"""
+
+import contextvars
+from functools import wraps
+import inspect
+import itertools
+import json
+import threading
+import time
+
+try:
+    from opentelemetry import trace as otel_trace # optional, otel exporter
+except ImportError:
+    otel_trace = None
+
+# Upper bounds (seconds) of the span duration histogram buckets.
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Prefix of the Prometheus metric names.
+METRIC_PREFIX = 'etl'
+
+ENABLED = False # set by start(), checked before anything is recorded
+exporters = []
+exporters_lock = threading.Lock()
+span_ids = itertools.count(1)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+# Span returned while instrumentation is off: every method does nothing.
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, counter, amount = 1):
+        pass
+
+    def set(self, attribute, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+# A timed step. Use as a context manager; add() counts bytes, pages, ...
+# and set() adds attributes while it runs. An exception leaving the block
+# is recorded as the span's error (its type name) and raised on.
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.error = None
+
+    def __enter__(self):
+        parent = current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.span_id = next(span_ids)
+        self.context_token = current_span.set(self)
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.started
+        current_span.reset(self.context_token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        export_span(self)
+        return False
+
+    def add(self, counter, amount = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, attribute, value):
+        self.attributes[attribute] = value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration_ms': round(self.seconds * 1000, 3),
+            'thread': threading.current_thread().name,
+            'error': self.error,
+            'attributes': self.attributes,
+            'counters': self.counters}
+
+# Span around a step: a Span while instrumentation is on, NULL_SPAN when it
+# is off.
+def span(name, **attributes):
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, attributes)
+
+# Decorator timing every call of a function (or coroutine function) as a
+# span named after it. Replaces the debug_log decorator.
+def instrumented(function):
+    name = function.__qualname__
+    if inspect.iscoroutinefunction(function):
+        @wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            if not ENABLED:
+                return await function(*args, **kwargs)
+            with Span(name, {}):
+                return await function(*args, **kwargs)
+        return async_wrapper
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        with Span(name, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+# Totals of one config row's load (pages, records, bytes, retries), added
+# to by every page worker of the row. Always kept, also while spans are not
+# recorded.
+class StepCounters:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, counter, amount = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def get(self, counter):
+        with self.lock:
+            return self.counters.get(counter)
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.counters)
+
+# Hand a finished span to every exporter. An exporter that fails is
+# reported and the load goes on.
+def export_span(finished_span):
+    for exporter in exporters:
+        try:
+            exporter.export(finished_span)
+        except Exception as err:
+            print('Span export failed:', type(exporter).__name__, repr(err))
+
+# Writes every span as a json line.
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def export(self, finished_span):
+        line = json.dumps(finished_span.to_dict(), default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# Totals of one span name for PrometheusExporter.
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.counters = {}
+
+# Aggregates spans by name and writes them in the Prometheus text format
+# when closed.
+class PrometheusExporter:
+    def __init__(self, path):
+        self.path = path
+        self.stats = {} # span name: SpanStats
+        self.lock = threading.Lock()
+
+    def export(self, finished_span):
+        with self.lock:
+            stats = self.stats.get(finished_span.name)
+            if stats is None:
+                stats = self.stats[finished_span.name] = SpanStats()
+            stats.count += 1
+            stats.seconds += finished_span.seconds
+            if finished_span.error is not None:
+                stats.errors += 1
+            for number, bound in enumerate(DURATION_BUCKETS):
+                if finished_span.seconds <= bound:
+                    stats.buckets[number] += 1
+            for counter, amount in finished_span.counters.items():
+                stats.counters[counter] = \
+                    stats.counters.get(counter, 0) + amount
+
+    # The aggregated metrics in the Prometheus text exposition format. The
+    # samples of each metric family are written together, after its HELP
+    # and TYPE lines.
+    def render(self):
+        seconds = METRIC_PREFIX + '_span_duration_seconds'
+        errors = METRIC_PREFIX + '_span_errors_total'
+        histogram_lines = []
+        error_lines = []
+        counter_lines = {} # counter: sample lines
+        with self.lock:
+            for name, stats in sorted(self.stats.items()):
+                label = '{span="' + name + '"'
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    histogram_lines.append(
+                        seconds + '_bucket' + label + ',le="' + str(bound)
+                        + '"} ' + str(count))
+                histogram_lines.append(
+                    seconds + '_bucket' + label + ',le="+Inf"} '
+                    + str(stats.count))
+                histogram_lines.append(seconds + '_sum' + label + '} '
+                    + str(round(stats.seconds, 6)))
+                histogram_lines.append(
+                    seconds + '_count' + label + '} ' + str(stats.count))
+                error_lines.append(errors + label + '} ' + str(stats.errors))
+                for counter, amount in sorted(stats.counters.items()):
+                    counter_lines.setdefault(counter, []).append(
+                        METRIC_PREFIX + '_' + counter + '_total' + label
+                        + '} ' + str(amount))
+        lines = [
+            '# HELP ' + seconds + ' Duration of the spans of each step.',
+            '# TYPE ' + seconds + ' histogram']
+        lines.extend(histogram_lines)
+        lines.append('# HELP ' + errors + ' Spans that ended with an error.')
+        lines.append('# TYPE ' + errors + ' counter')
+        lines.extend(error_lines)
+        for counter, metric_lines in sorted(counter_lines.items()):
+            total = METRIC_PREFIX + '_' + counter + '_total'
+            lines.append(
+                '# HELP ' + total + ' ' + counter.capitalize()
+                + ' counted by the spans of each step.')
+            lines.append('# TYPE ' + total + ' counter')
+            lines.extend(metric_lines)
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write(self.render())
+
+# Hands spans to the OpenTelemetry tracer provider of the process, with
+# their recorded start and end times. Counters become span attributes.
+class OpenTelemetryExporter:
+    def __init__(self):
+        if otel_trace is None:
+            raise ValueError('the otel exporter needs opentelemetry-api')
+        self.tracer = otel_trace.get_tracer('config-driven-etl')
+
+    def export(self, finished_span):
+        attributes = {
+            key: value if isinstance(value, (bool, int, float, str))
+            else str(value)
+            for key, value in finished_span.attributes.items()}
+        attributes.update(finished_span.counters)
+        start_ns = int(finished_span.start_time * 1e9)
+        otel_span = self.tracer.start_span(
+            finished_span.name, start_time=start_ns, attributes=attributes)
+        if finished_span.error is not None:
+            otel_span.set_status(otel_trace.Status(
+                otel_trace.StatusCode.ERROR, finished_span.error))
+        otel_span.end(end_time=start_ns + int(finished_span.seconds * 1e9))
+
+    def close(self):
+        pass
+
+# Exporter for a command line value: 'jsonl:<path>', 'prometheus:<path>'
+# or 'otel'.
+def get_exporter(exporter):
+    if exporter.startswith('jsonl:'):
+        return JsonLinesExporter(exporter[len('jsonl:'):])
+    elif exporter.startswith('prometheus:'):
+        return PrometheusExporter(exporter[len('prometheus:'):])
+    elif exporter == 'otel':
+        return OpenTelemetryExporter()
+    raise ValueError('unknown metrics exporter: ' + exporter)
+
+# Start recording spans to the exporters (command line values, see
+# get_exporter()). Does nothing without exporters.
+def start(exporter_names):
+    global ENABLED
+    if not exporter_names:
+        return
+    with exporters_lock:
+        exporters.extend(get_exporter(name) for name in exporter_names)
+        ENABLED = True
+
+# Stop recording spans, and flush and close the exporters.
+def stop():
+    global ENABLED
+    with exporters_lock:
+        ENABLED = False
+        while exporters:
+            exporters.pop().close()
@@ -0,0 +1,315 @@
+"""Shard leases
+
+This script is utilized by etl_orchestrator.py to share the config rows of
+one batch out to several worker processes, on one or many nodes. The rows
+are grouped into shards (see SourceBatch.shards() in etl_orchestrator.py); a
+worker claims a shard by taking a lease on it, keeps the lease alive with
+heartbeats while it loads the shard's rows, and marks the shard done with
+its rows' results. A lease that is not renewed within its lease time (the
+worker died) expires and the shard is claimed by another worker. Once every
+shard is done exactly one worker claims the completion of the batch. Every
+worker registers the batch's shards before claiming, so a worker that joins
+before the batch starter registered them still waits for all of them.
+
+Two stores keep the leases:
+
+  * SqlLeaseStore: the METADATA.BatchShardLease and BatchShardFinish tables
+    of the logging database (sql-ddl/batch_shard_lease.sql), for workers on
+    different nodes
+  * SqliteLeaseStore: a local SQLite file, for several worker processes on
+    one machine, e.g. to test worker mode locally
+
+get_lease_store() picks one from a command line value: 'sql' or
+'sqlite:<path>'.
+
+Python Module Requirements:
+
+ * json
+ * os
+ * socket
+ * sqlite3
+ * threading
+ * time
+ * uuid
+
+Custom Module Requirements:
+
+ * process_logging.py
+ * instrumentation.py
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from process_logging import pooled_cursor
+from instrumentation import instrumented
+
+# Seconds a lease lasts without a heartbeat.
+LEASE_SECONDS = 300
+# Heartbeats are sent this many times per lease time.
+HEARTBEATS_PER_LEASE = 3
+# Seconds a worker with nothing to claim waits before it looks again for
+# expired leases, while other workers still hold shards.
+CLAIM_POLL_SECONDS = 10
+
+# Name of this worker in the lease tables: host, process and a random part,
+# so restarted processes do not inherit leases.
+def worker_name():
+    return socket.gethostname() + ':' + str(os.getpid()) + ':' \
+        + uuid.uuid4().hex[:8]
+
+# Leases kept in the logging database, for workers on different nodes.
+class SqlLeaseStore:
+    # Add the shards of a batch (a list of shard keys, in claim order). 
+    # Shards already added are left as they are, so every worker of the 
+    # batch can register them before it claims.
+    @instrumented
+    def register_shards(self, batch_id, shard_keys):
+        sql = """\
+        SET NOCOUNT ON
+        EXEC [METADATA].[s_BatchShardRegister] ?, ?;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id, json.dumps(list(shard_keys))])
+
+    # Lease the next pending or expired shard to owner. Returns (shard key,
+    # attempts) or None when nothing can be claimed.
+    @instrumented
+    def claim(self, batch_id, owner, lease_seconds):
+        sql = """\
+        SET NOCOUNT ON
+        EXEC [METADATA].[s_BatchShardClaim] ?, ?, ?;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id, owner, lease_seconds])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row.ShardKey, row.Attempts
+
+    # Extend every lease owner holds on the batch.
+    def heartbeat(self, batch_id, owner, lease_seconds):
+        sql = """\
+        SET NOCOUNT ON
+        EXEC [METADATA].[s_BatchShardHeartbeat] ?, ?, ?;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id, owner, lease_seconds])
+
+    # Mark a shard done with its results ({endpoint name: success
+    # response}). cancel_pending also marks the unclaimed shards done, for
+    # fail-fast. Returns False when owner lost the lease.
+    @instrumented
+    def complete(
+            self, batch_id, shard_key, owner, results, cancel_pending = False):
+        sql = """\
+        SET NOCOUNT ON
+        EXEC [METADATA].[s_BatchShardComplete] ?, ?, ?, ?, ?;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [
+                batch_id, shard_key, owner, json.dumps(results),
+                int(cancel_pending)])
+            return bool(cursor.fetchval())
+
+    # Number of shards of the batch that are not done.
+    def unfinished_count(self, batch_id):
+        sql = """\
+        SET NOCOUNT ON
+        SELECT COUNT(*) FROM METADATA.BatchShardLease
+        WHERE BatchID = ? AND Status != 'Done';
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id])
+            return cursor.fetchval()
+
+    # Claim the completion of the batch. True for exactly one caller, once
+    # every shard is done.
+    @instrumented
+    def claim_finish(self, batch_id, owner):
+        sql = """\
+        SET NOCOUNT ON
+        EXEC [METADATA].[s_BatchShardFinish] ?, ?;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id, owner])
+            return bool(cursor.fetchval())
+
+    # The results of every done shard, merged: {endpoint name: success
+    # response}. Rows of skipped shards are missing.
+    def results(self, batch_id):
+        sql = """\
+        SET NOCOUNT ON
+        SELECT Result FROM METADATA.BatchShardLease
+        WHERE BatchID = ? AND Result IS NOT NULL;
+        """
+        with pooled_cursor() as cursor:
+            cursor.execute(sql, [batch_id])
+            rows = cursor.fetchall()
+        results = {}
+        for row in rows:
+            results.update(json.loads(row.Result))
+        return results
+
+# Leases kept in a local SQLite file, shared by worker processes on one
+# machine. Each call opens its own connection, and claims take the database
+# write lock (BEGIN IMMEDIATE) so two processes never claim the same shard.
+class SqliteLeaseStore:
+    def __init__(self, path):
+        self.path = path
+        with self.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS BatchShardLease (
+                    BatchID INTEGER NOT NULL,
+                    ShardKey TEXT NOT NULL,
+                    ShardNumber INTEGER NOT NULL,
+                    Status TEXT NOT NULL,
+                    Owner TEXT,
+                    LeaseExpires REAL,
+                    Attempts INTEGER NOT NULL,
+                    Result TEXT,
+                    PRIMARY KEY (BatchID, ShardKey))""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS BatchShardFinish (
+                    BatchID INTEGER PRIMARY KEY,
+                    Owner TEXT NOT NULL,
+                    FinishTime REAL NOT NULL)""")
+
+    # Connection with an immediate (write locked) transaction, committed
+    # when the block ends and rolled back on an error.
+    def transaction(self):
+        connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None)
+        return SqliteTransaction(connection)
+
+    def register_shards(self, batch_id, shard_keys):
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO BatchShardLease VALUES "
+                "(?, ?, ?, 'Pending', NULL, NULL, 0, NULL)",
+                [(batch_id, shard_key, shard_number)
+                    for shard_number, shard_key in enumerate(shard_keys)])
+
+    def claim(self, batch_id, owner, lease_seconds):
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT ShardKey, Attempts FROM BatchShardLease "
+                "WHERE BatchID = ? AND (Status = 'Pending' "
+                "OR (Status = 'Leased' AND LeaseExpires < ?)) "
+                "ORDER BY ShardNumber LIMIT 1",
+                (batch_id, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE BatchShardLease SET Status = 'Leased', Owner = ?, "
+                "LeaseExpires = ?, Attempts = Attempts + 1 "
+                "WHERE BatchID = ? AND ShardKey = ?",
+                (owner, now + lease_seconds, batch_id, row[0]))
+        return row[0], row[1] + 1
+
+    def heartbeat(self, batch_id, owner, lease_seconds):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE BatchShardLease SET LeaseExpires = ? "
+                "WHERE BatchID = ? AND Owner = ? AND Status = 'Leased'",
+                (time.time() + lease_seconds, batch_id, owner))
+
+    def complete(
+            self, batch_id, shard_key, owner, results, cancel_pending = False):
+        with self.transaction() as connection:
+            completed = connection.execute(
+                "UPDATE BatchShardLease SET Status = 'Done', "
+                "LeaseExpires = NULL, Result = ? "
+                "WHERE BatchID = ? AND ShardKey = ? AND Owner = ? "
+                "AND Status = 'Leased'",
+                (json.dumps(results), batch_id, shard_key, owner)).rowcount
+            if cancel_pending:
+                connection.execute(
+                    "UPDATE BatchShardLease SET Status = 'Done' "
+                    "WHERE BatchID = ? AND Status = 'Pending'", (batch_id,))
+        return completed == 1
+
+    def unfinished_count(self, batch_id):
+        with self.transaction() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM BatchShardLease "
+                "WHERE BatchID = ? AND Status != 'Done'",
+                (batch_id,)).fetchone()[0]
+
+    def claim_finish(self, batch_id, owner):
+        with self.transaction() as connection:
+            return connection.execute(
+                "INSERT OR IGNORE INTO BatchShardFinish "
+                "SELECT ?, ?, ? WHERE NOT EXISTS ("
+                "SELECT 1 FROM BatchShardLease "
+                "WHERE BatchID = ? AND Status != 'Done')",
+                (batch_id, owner, time.time(), batch_id)).rowcount == 1
+
+    def results(self, batch_id):
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT Result FROM BatchShardLease "
+                "WHERE BatchID = ? AND Result IS NOT NULL",
+                (batch_id,)).fetchall()
+        results = {}
+        for (result,) in rows:
+            results.update(json.loads(result))
+        return results
+
+# Context manager for SqliteLeaseStore.transaction().
+class SqliteTransaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.execute('COMMIT')
+            else:
+                self.connection.execute('ROLLBACK')
+        finally:
+            self.connection.close()
+
+# Lease store for a command line value: 'sql' or 'sqlite:<path>'.
+def get_lease_store(lease_store):
+    if lease_store == 'sql':
+        return SqlLeaseStore()
+    elif lease_store.startswith('sqlite:'):
+        return SqliteLeaseStore(lease_store[len('sqlite:'):])
+    raise ValueError('unknown lease store: ' + lease_store)
+
+# Background thread that renews the leases of a worker every lease_seconds
+# / HEARTBEATS_PER_LEASE seconds until stop() is called. A failed heartbeat
+# is printed and tried again at the next interval.
+class LeaseHeartbeat:
+    def __init__(self, lease_store, batch_id, owner, lease_seconds):
+        self.lease_store = lease_store
+        self.batch_id = batch_id
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / HEARTBEATS_PER_LEASE):
+            try:
+                self.lease_store.heartbeat(
+                    self.batch_id, self.owner, self.lease_seconds)
+            except Exception as err:
+                print('Lease heartbeat failed:', repr(err))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
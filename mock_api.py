@@ -0,0 +1,223 @@
+"""Mock api server
+
+This script serves a local http api that emulates each api_type of
+request_api.py, for benchmark.py and for trying config files without calling
+live apis. Every path is /<route>/<endpoint name>:
+
+  * POST /token: an access token ({"access_token", "expires_in"})
+  * GET /count/<name>?page=N: page N of a page count paged endpoint, with
+    "total_pages" (json_user_pass_paged_count)
+  * GET /secure/<name>?page=N: as /count, but answers 401 without a Bearer
+    token (json_token_paged_count)
+  * GET /next/<name>?page=N: an OData style page with a "__next" link to
+    the following page (json_user_pass_paged_next)
+  * GET /json/<name>: a non-paged BLS style response (json_*_not_paged)
+  * GET /xml/<name>: a non-paged xml response (xml_user_pass_not_paged)
+  * GET /_stats: the requests, pages, bytes and latencies served since the
+    last POST /_reset
+
+MockApiSettings sets the pages per endpoint, records per page and record
+size, the latency added to every response, and throttling: every
+throttle_every-th request is answered 429 with a Retry-After of
+retry_after seconds.
+
+Syntax: python ./mock_api.py --port 8400 --pages 20 --latency-ms 50
+
+Python Module Requirements:
+
+ * argparse
+ * http.server
+ * json
+ * threading
+ * time
+ * urllib.parse
+"""
+
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+# What the mock api serves.
+class MockApiSettings:
+    def __init__(
+            self, pages = 10, records_per_page = 100, record_bytes = 200,
+            latency_ms = 0, throttle_every = 0, retry_after = 1):
+        self.pages = pages
+        self.records_per_page = records_per_page
+        self.record_bytes = record_bytes
+        self.latency_ms = latency_ms
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return dict(vars(self))
+
+# Records of one page: ids and a filler field padding each record to about
+# record_bytes of json.
+def page_records(settings, endpoint_name, page):
+    filler = 'x' * max(0, settings.record_bytes - 60)
+    first = page * settings.records_per_page
+    return [
+        {'id': endpoint_name + '-' + str(first + record), 'value': first
+            + record, 'filler': filler}
+        for record in range(settings.records_per_page)]
+
+# Threaded http server keeping the settings and the served statistics.
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, MockApiHandler)
+        self.settings = settings
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.request_count = 0
+            self.page_count = 0
+            self.byte_count = 0
+            self.throttled_count = 0
+            self.latencies = []
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'requests': self.request_count,
+                'pages': self.page_count,
+                'bytes': self.byte_count,
+                'throttled': self.throttled_count,
+                'latencies_ms': list(self.latencies)}
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real apis
+
+    # Requests are not logged to stderr.
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers = {}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, value, headers = {}):
+        self.send_body(
+            status, json.dumps(value).encode('utf-8'), 'application/json',
+            headers)
+
+    # Count the request and answer 429 when it is a throttled one. Returns
+    # True when the request was throttled.
+    def throttled(self):
+        server = self.server
+        with server.stats_lock:
+            server.request_count += 1
+            throttled = server.settings.throttle_every > 0 \
+                and server.request_count % server.settings.throttle_every == 0
+            if throttled:
+                server.throttled_count += 1
+        if throttled:
+            self.send_json(
+                429, {'error': 'throttled'},
+                {'Retry-After': str(server.settings.retry_after)})
+        return throttled
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path == '/_reset':
+            self.server.reset_stats()
+            self.send_json(200, {})
+        elif path == '/token':
+            self.send_json(
+                200, {'access_token': 'mock-token', 'expires_in': 3600})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_GET(self):
+        started = time.perf_counter()
+        parsed_url = urlparse(self.path)
+        if parsed_url.path == '/_stats':
+            self.send_json(200, self.server.stats())
+            return
+        if self.throttled():
+            return
+        settings = self.server.settings
+        if settings.latency_ms:
+            time.sleep(settings.latency_ms / 1000)
+        route, _, endpoint_name = parsed_url.path.strip('/').partition('/')
+        params = parse_qs(parsed_url.query)
+        page = int(params.get('page', ['0'])[0])
+
+        if route in ('count', 'secure'):
+            if route == 'secure' and not self.headers.get(
+                    'Authorization', '').startswith('Bearer '):
+                self.send_json(401, {'error': 'no token'})
+                return
+            body = json.dumps({
+                'total_pages': settings.pages, 'page': page,
+                'd': {'results': page_records(settings, endpoint_name, page)}
+                }).encode('utf-8')
+            content_type = 'application/json'
+        elif route == 'next':
+            page = max(page, 1)
+            response = {'d': {'results': page_records(
+                settings, endpoint_name, page - 1)}}
+            if page < settings.pages:
+                response['d']['__next'] = 'http://' + self.headers['Host'] \
+                    + parsed_url.path + '?page=' + str(page + 1)
+            body = json.dumps(response).encode('utf-8')
+            content_type = 'application/json'
+        elif route == 'json':
+            body = json.dumps({'status': 'REQUEST_SUCCEEDED', 'Results': {
+                'series': [{'seriesID': endpoint_name, 'data': page_records(
+                    settings, endpoint_name, 0)}]}}).encode('utf-8')
+            content_type = 'application/json'
+        elif route == 'xml':
+            body = ('<?xml version="1.0"?><channel>' + ''.join(
+                '<item id="' + record['id'] + '"><value>'
+                + str(record['value']) + '</value><filler>'
+                + record['filler'] + '</filler></item>'
+                for record in page_records(settings, endpoint_name, 0))
+                + '</channel>').encode('utf-8')
+            content_type = 'application/xml'
+        else:
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        self.send_body(200, body, content_type)
+        latency = (time.perf_counter() - started) * 1000
+        with self.server.stats_lock:
+            self.server.page_count += 1
+            self.server.byte_count += len(body)
+            self.server.latencies.append(latency)
+
+# Serve the mock api until the process ends. port 0 picks a free port;
+# ready, when given, is a queue that gets the port once the server listens.
+def serve(settings, port = 0, ready = None):
+    server = MockApiServer(('127.0.0.1', port), settings)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8400)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--records-per-page', type=int, default=100)
+    parser.add_argument('--record-bytes', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--throttle-every', type=int, default=0)
+    parser.add_argument('--retry-after', type=float, default=1)
+    args = parser.parse_args()
+    serve(MockApiSettings(
+        args.pages, args.records_per_page, args.record_bytes,
+        args.latency_ms, args.throttle_every, args.retry_after), args.port)
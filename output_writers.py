@@ -0,0 +1,329 @@
+"""Output writers
+
+This script is utilized by request_api.py to write api responses in formats
+other than one blob per response/page. Current output formats include:
+
+  * json: one blob per response or page, as returned by the api (default,
+    handled by request_api.py itself)
+  * ndjson: the records of successive pages are compacted into
+    newline-delimited json part files of about part_size_mb each
+  * parquet: the records are flattened into Arrow record batches and
+    written to Parquet part files of about part_size_mb each. The schema is
+    inferred from the first rows and kept for every later page and part;
+    a new field or a value that no longer fits its column fails the load
+    with SchemaDriftError.
+
+The records of a page are found with the records_path config column, a
+dotted path into the parsed response (e.g. 'd.results'). Lists met along the
+path are flattened, so 'Results.series.data' returns the data records of
+every series.
+
+For xml responses (response_format xml) records_path is an ElementTree path
+(e.g. 'channel/item') and each matching element becomes a record of its
+attributes and child elements.
+
+Parquet records are flattened: nested objects become 'parent.child' columns,
+lists are stored as json strings, and the scalar fields of the objects along
+records_path are copied into every record (e.g. 'series.seriesID' on each BLS
+data record), so the records keep the keys they belong to.
+
+Part files are streamed to blob storage in staged blocks, so memory stays
+bounded by one block no matter how large a part gets.
+
+Python Module Requirements:
+
+ * json
+ * xml.etree.ElementTree
+ * pyarrow (optional, for parquet output)
+
+Custom Module Requirements:
+
+ * blob_functions.py
+"""
+
+import json
+import xml.etree.ElementTree as ET # for processing xml responses
+
+try:
+    import pyarrow as pa # optional, only needed for parquet output
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from blob_functions import BlobBlockWriter
+
+# Rows buffered before they are written to a parquet file as one row group.
+PARQUET_ROW_GROUP_ROWS = 100000
+
+# Records of a parsed response at a dotted records path. Without a path the
+# whole response is a single record. With include_parent_fields the scalar
+# fields of the objects passed on the way down are copied into each record,
+# prefixed with the key the object was found under.
+def extract_records(
+        response, records_path = None, include_parent_fields = False):
+    if records_path is None:
+        return [response]
+    records = [(None, {}, response)] # (found under key, parent fields, value)
+    for key in records_path.split('.'):
+        next_records = []
+        for found_under, parent_fields, record in records:
+            if not isinstance(record, dict) or record.get(key) is None:
+                continue
+            if include_parent_fields and found_under is not None:
+                parent_fields = dict(parent_fields)
+                for field, value in record.items():
+                    if field != key and not isinstance(value, (dict, list)):
+                        parent_fields[found_under + '.' + field] = value
+            value = record[key]
+            if not isinstance(value, list):
+                value = [value]
+            for child in value:
+                next_records.append((key, parent_fields, child))
+        records = next_records
+    if not include_parent_fields:
+        return [record for found_under, parent_fields, record in records]
+    return [
+        {**parent_fields, **record} if isinstance(record, dict) else record
+        for found_under, parent_fields, record in records]
+
+# Tag name without its {namespace}.
+def xml_tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+# Record (dict) for an xml element: its attributes, the text of its leaf
+# children and a nested record for every child that has children or
+# attributes of its own. Repeated child tags become lists.
+def xml_element_record(element):
+    record = dict(element.attrib)
+    for child in element:
+        if len(child) or child.attrib:
+            value = xml_element_record(child)
+        else:
+            value = child.text
+        tag = xml_tag(child)
+        if tag not in record:
+            record[tag] = value
+        elif isinstance(record[tag], list):
+            record[tag].append(value)
+        else:
+            record[tag] = [record[tag], value]
+    if not len(element) and element.text and element.text.strip():
+        record[xml_tag(element)] = element.text
+    return record
+
+# Records of an xml response: the elements matching the ElementTree records
+# path, or the root element without a path.
+def extract_xml_records(content, records_path = None):
+    root = ET.fromstring(content)
+    if records_path is None:
+        elements = [root]
+    else:
+        elements = root.iterfind(records_path)
+    return [xml_element_record(element) for element in elements]
+
+# Flatten a record into one level of columns: nested objects become
+# 'parent.child' columns and lists are stored as json strings.
+def flatten_record(record, prefix = ''):
+    if not isinstance(record, dict):
+        return {'value': record}
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            row.update(flatten_record(value, prefix + key + '.'))
+        elif isinstance(value, list):
+            row[prefix + key] = json.dumps(value)
+        else:
+            row[prefix + key] = value
+    return row
+
+# Compacts records into newline-delimited json part files named
+# <file_name_prefix>-part-0001.ndjson, -part-0002.ndjson, ... A new part is
+# started once the current one reaches part_size bytes (uncompressed).
+# Records must be written in order from one thread at a time.
+class NdjsonPartWriter:
+    include_parent_fields = False
+
+    def __init__(
+            self, container_name, file_name_prefix, part_size,
+            compression = None):
+        self.container_name = container_name
+        self.file_name_prefix = file_name_prefix
+        self.part_size = part_size
+        self.compression = compression
+        self.part_count = 0
+        self.part = None
+
+    def part_file_name(self):
+        return self.file_name_prefix + '-part-' \
+            + str(self.part_count).rjust(4, '0') + '.ndjson'
+
+    def write_records(self, records):
+        for record in records:
+            if self.part is None:
+                self.part_count += 1
+                self.part = BlobBlockWriter(
+                    'application/x-ndjson', self.container_name,
+                    self.part_file_name(), compression = self.compression)
+            self.part.write(
+                json.dumps(record, separators=(',', ':')).encode('utf-8')
+                + b'\n')
+            if self.part.tell() >= self.part_size:
+                self.part.close()
+                self.part = None
+
+    # Commit the last part. With commit = False (failed load) the open part
+    # is dropped; parts already completed stay in blob storage.
+    def close(self, commit = True):
+        if self.part is not None:
+            self.part.close(commit)
+            self.part = None
+        return self.part_count
+
+# Raised when the records of a parquet load stop fitting the schema of 
+# their dataset: a field that was not in the first rows, or values that no 
+# longer fit the type of their column.
+class SchemaDriftError(ValueError):
+    pass
+
+# Arrow array of the values of a parquet column, in column_type (inferred 
+# from the values when None). Inferred columns that are only null, or mix 
+# values arrow cannot hold in one type (e.g. numbers and text), become 
+# strings. Later values are only converted to column_type without a loss: 
+# any value to text in string columns (other values as json), whole floats 
+# to integers and integers to floats. Anything else raises 
+# SchemaDriftError naming the column.
+def column_array(name, values, column_type = None):
+    if column_type is None:
+        try:
+            array = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            return string_array(values)
+        if pa.types.is_null(array.type):
+            return string_array(values)
+        return array
+    if pa.types.is_string(column_type):
+        return string_array(values)
+    for value in values:
+        if value is not None and not fits_column(value, column_type):
+            raise SchemaDriftError(
+                'parquet column ' + name + ' is ' + str(column_type) 
+                + ', got ' + type(value).__name__ + ' ' + repr(value))
+    try:
+        return pa.array(values, type=column_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as err:
+        raise SchemaDriftError(
+            'parquet column ' + name + ' is ' + str(column_type) + ', ' 
+            + str(err)) from None
+
+# True when value converts to column_type without a loss (arrow itself 
+# truncates fractional floats to integers and reads booleans as numbers).
+def fits_column(value, column_type):
+    if pa.types.is_boolean(column_type):
+        return isinstance(value, bool)
+    if isinstance(value, bool):
+        return False
+    if pa.types.is_integer(column_type):
+        return isinstance(value, int) \
+            or isinstance(value, float) and value.is_integer()
+    if pa.types.is_floating(column_type):
+        return isinstance(value, (int, float))
+    return True
+
+# Arrow string array of the values of a parquet column.
+def string_array(values):
+    return pa.array([
+        value if value is None or isinstance(value, str) 
+        else json.dumps(value) 
+        for value in values], type=pa.string())
+
+# Writes records to Parquet part files named <file_name_prefix>-part-0001.
+# parquet, ... The schema is inferred from the first rows written and kept 
+# for every later page and part, so all parts of a dataset share one 
+# schema. Fields missing from a record are null; a field that is not in 
+# the schema, or values that no longer fit their column (see 
+# column_array()), fail the load with SchemaDriftError. Rows are 
+# buffered into row groups of PARQUET_ROW_GROUP_ROWS, and a new part is 
+# started once the current one reaches part_size bytes. compression is used as the parquet 
+# column codec (default snappy), the files themselves are not compressed 
+# again. Records must be written in order from one thread at a time.
+class ParquetPartWriter:
+    include_parent_fields = True
+
+    def __init__(
+            self, container_name, file_name_prefix, part_size,
+            compression = None):
+        if pa is None:
+            raise ValueError('parquet output requires the pyarrow module')
+        self.container_name = container_name
+        self.file_name_prefix = file_name_prefix
+        self.part_size = part_size
+        self.codec = compression or 'snappy'
+        self.schema = None
+        self.rows = []
+        self.part_count = 0
+        self.part = None
+        self.parquet_writer = None
+
+    def part_file_name(self):
+        return self.file_name_prefix + '-part-' \
+            + str(self.part_count).rjust(4, '0') + '.parquet'
+
+    def write_records(self, records):
+        self.rows.extend(flatten_record(record) for record in records)
+        if len(self.rows) >= PARQUET_ROW_GROUP_ROWS:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        if self.schema is None:
+            names = list({name: None for row in rows for name in row})
+            arrays = [
+                column_array(name, [row.get(name) for row in rows]) 
+                for name in names]
+            self.schema = pa.schema([
+                pa.field(name, array.type) 
+                for name, array in zip(names, arrays)])
+        else:
+            for row in rows:
+                for name in row:
+                    if self.schema.get_field_index(name) == -1:
+                        raise SchemaDriftError(
+                            'parquet field ' + name 
+                            + ' is not in the schema of the first rows')
+            arrays = [
+                column_array(
+                    field.name, [row.get(field.name) for row in rows], 
+                    field.type) 
+                for field in self.schema]
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        if self.part is None:
+            self.part_count += 1
+            self.part = BlobBlockWriter(
+                'application/vnd.apache.parquet', self.container_name,
+                self.part_file_name())
+            self.parquet_writer = pq.ParquetWriter(
+                self.part, self.schema, compression=self.codec)
+        self.parquet_writer.write_table(table)
+        if self.part.tell() >= self.part_size:
+            self.close_part()
+
+    def close_part(self, commit = True):
+        if commit:
+            self.parquet_writer.close()
+        self.part.close(commit)
+        self.part = None
+        self.parquet_writer = None
+
+    # Write the buffered rows and commit the last part. With commit = False
+    # (failed load) the buffered rows and open part are dropped; parts
+    # already completed stay in blob storage.
+    def close(self, commit = True):
+        if commit:
+            self.write_row_group()
+        else:
+            self.rows = []
+        if self.part is not None:
+            self.close_part(commit)
+        return self.part_count
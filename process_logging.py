@@ -3,54 +3,110 @@
 This script is utilized by other scripts in this program to log load
 progress and statuses to the Azure SQL server.
 
+Connections are pooled: each call borrows an open connection from the pool
+(up to SQL_POOL_SIZE are kept) instead of logging in to the server again. A
+connection that raises an error is closed rather than returned to the pool.
+
+Batch step log records can be written by a background thread so logging is
+not on the critical path of every endpoint:
+
+    start_step_log_writer()
+    try:
+        ... log_batch_step(...) calls only queue the record ...
+    finally:
+        stop_step_log_writer() # writes the queued records, in order
+
+The writer is also stopped (and its queue written) when the interpreter
+exits, e.g. after an unhandled exception. It sends the queued records in
+bulk with log_batch_steps() (METADATA.s_BatchStepLoggingBulk), which locks
+per BatchID rather than the global lock of s_BatchStepLogging.
+
 Python Module Requirements:
 
- * functools
+ * atexit
+ * json
+ * datetime
+ * contextlib
+ * queue
+ * threading
  * pyodbc
 
 Custom Module Requirements:
 
  * connections.py
+ * instrumentation.py
 """
 
-from functools import wraps # for debugging function
+import atexit
+import json
+from datetime import datetime # event time of queued step records
+import contextlib
+import queue
+import threading
+
 import pyodbc
 
 from blob_functions import blob_write, blob_read_csv, blob_file_count
+from instrumentation import instrumented, span
 
 # connections module contains code to generate connection strings
 import connections as cn
 cn.init()
 
-# Set DEBUG to true to return function arguments and return values
-DEBUG = False
-
-# Print the argument names and values and return values for debugging
-def debug_log(function):
-    @wraps(function)
-    def wrapper(*args, **kwargs):
-        if DEBUG:
-            print(">> Called", function.__name__, "\n",
-                {**dict(zip(function.__code__.co_varnames, args)), **kwargs})
-        result = function(*args, **kwargs)
-        if DEBUG:
-            print(">>", function.__name__, "return:\n", result)
-        return result
-    return wrapper
-
-@debug_log
-def create_cursor(connection_string):
+# Open connections kept for reuse.
+SQL_POOL_SIZE = 8
+
+connection_pool = queue.LifoQueue(maxsize=SQL_POOL_SIZE)
+
+# Statements sent to the SQL server (one per pooled_cursor() block), read by 
+# benchmark.py.
+sql_round_trips = 0
+sql_round_trips_lock = threading.Lock()
+
+@instrumented
+def create_connection(connection_string):
     cnxn = pyodbc.connect(connection_string)
     cnxn.autocommit = True
-    cursor = cnxn.cursor()
-    return cursor
+    return cnxn
+
+# Borrow a cursor on a pooled connection. The connection goes back to the 
+# pool afterwards, or is closed if the pool is full or the block raised. 
+# The block is timed as a sql.call span.
+@contextlib.contextmanager
+def pooled_cursor():
+    global sql_round_trips
+    with sql_round_trips_lock:
+        sql_round_trips += 1
+    with span('sql.call'):
+        try:
+            cnxn = connection_pool.get_nowait()
+        except queue.Empty:
+            cnxn = create_connection(cn.sql_connection_string)
+        try:
+            cursor = cnxn.cursor()
+            yield cursor
+            cursor.close()
+        except BaseException:
+            cnxn.close()
+            raise
+        try:
+            connection_pool.put_nowait(cnxn)
+        except queue.Full:
+            cnxn.close()
+
+# Close the pooled connections.
+def close_connection_pool():
+    while True:
+        try:
+            connection_pool.get_nowait().close()
+        except queue.Empty:
+            break
 
 # Manage the batch logging process.
-@debug_log
+@instrumented
 def log_batch(
         batch_id, init_pipeline_name, need_return_value, orchestration_tool, 
         project, source_name, status, target_system):
-    cursor = create_cursor(cn.sql_connection_string)
     sql_proc_variables = [
         status, orchestration_tool, project, init_pipeline_name, source_name, 
         target_system, batch_id]
@@ -61,34 +117,162 @@ def log_batch(
     EXEC @rv = METADATA.s_BatchLogging ?, ?, ?, ?, ?, ?, ?;
     SELECT @rv AS return_value;
     """
-    cursor.execute(sql, sql_proc_variables)
-    if need_return_value:
-        return_value = cursor.fetchval()
-        return [return_value]
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, sql_proc_variables)
+        if need_return_value:
+            return_value = cursor.fetchval()
+            return [return_value]
 
-# Managethe batch step logging process.
-@debug_log
+# Managethe batch step logging process. While the background writer is 
+# running the record is queued for it instead of written here. 
+# target_row_count (records written) goes to TargetRows; None leaves it as 
+# it is. The record carries the time it was logged, so the step's start and 
+# end times do not depend on when the writer sends it.
+@instrumented
 def log_batch_step(
         batch_id, step_name, step_status, source_schema, root_folder_name, 
-        target_update_strategy, target_schema, target_object, target_file_count):
-    cursor = create_cursor(cn.sql_connection_string)
+        target_update_strategy, target_schema, target_object, target_file_count,
+        target_row_count = None):
     sql_proc_variables = [
         batch_id, step_name, step_status, source_schema, root_folder_name, 
-        target_update_strategy, target_schema, target_object, target_file_count]
+        target_update_strategy, target_schema, target_object, target_file_count,
+        target_row_count, datetime.now()]
+    writer = step_log_writer
+    if writer is not None:
+        writer.put(sql_proc_variables)
+    else:
+        write_batch_step(sql_proc_variables)
 
+# Write a batch step log record.
+@instrumented
+def write_batch_step(sql_proc_variables):
     sql = """\
     DECLARE @rv int;
     SET NOCOUNT ON
-    EXEC @rv = METADATA.s_BatchStepLogging ?, ?, ?, ?, ?, ?, ?, ?, ?
+    EXEC @rv = METADATA.s_BatchStepLogging ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
     """
-    cursor.execute(sql, sql_proc_variables)
-    
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, sql_proc_variables)
+
+# Fields of a batch step log record, in log_batch_step() argument order 
+# followed by the time it was logged, as named by 
+# METADATA.s_BatchStepLoggingBulk.
+STEP_LOG_FIELDS = [
+    'BatchID', 'StepName', 'Status', 'SourceSchema', 'SourceObject', 
+    'TargetUpdateStrategy', 'TargetSchema', 'TargetObject', 'TargetFiles', 
+    'TargetRows', 'EventDateTime']
+# Most records the background writer sends in one bulk logging call.
+STEP_LOG_BATCH_SIZE = 500
+
+# Write many batch step log records with one call. steps is a list of 
+# records, each a list of log_batch_step() arguments, in the order they 
+# happened. Only the records' own batches are locked, so batches logging at 
+# the same time do not wait for each other.
+@instrumented
+def log_batch_steps(steps):
+    if not steps:
+        return
+    steps_json = json.dumps([
+        dict(zip(STEP_LOG_FIELDS, sql_proc_variables)) 
+        for sql_proc_variables in steps], default=str)
+
+    sql = """\
+    DECLARE @rv int;
+    SET NOCOUNT ON
+    EXEC @rv = METADATA.s_BatchStepLoggingBulk ?
+    """
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, [steps_json])
+
+# Writes queued batch step log records on a background thread, in the order 
+# they were queued. Records queued while a write is running are sent 
+# together with log_batch_steps(). Records that fail to write are reported 
+# and the first error is raised again by stop().
+class StepLogWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name='step-log-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, sql_proc_variables):
+        self.queue.put(sql_proc_variables)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            steps = [self.queue.get()]
+            while len(steps) < STEP_LOG_BATCH_SIZE:
+                try:
+                    steps.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in steps: # queued by stop()
+                stopping = True
+                steps = [step for step in steps if step is not None]
+            flushed = [ # queued by flush()
+                step for step in steps if isinstance(step, threading.Event)]
+            steps = [
+                step for step in steps 
+                if not isinstance(step, threading.Event)]
+            try:
+                if steps:
+                    log_batch_steps(steps)
+            except Exception as err:
+                print('Batch step log records failed:', steps, repr(err))
+                if self.error is None:
+                    self.error = err
+            for event in flushed:
+                event.set()
+
+    # Wait until the records queued so far are written.
+    def flush(self):
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait()
+
+    # Write the queued records and end the thread.
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+step_log_writer = None
+step_log_writer_lock = threading.Lock()
+
+# Start queueing log_batch_step() records for a background writer.
+def start_step_log_writer():
+    global step_log_writer
+    with step_log_writer_lock:
+        if step_log_writer is None:
+            step_log_writer = StepLogWriter()
+
+# Write the queued records and go back to writing records directly.
+def stop_step_log_writer():
+    global step_log_writer
+    with step_log_writer_lock:
+        writer = step_log_writer
+        step_log_writer = None
+    if writer is not None:
+        writer.stop()
+
+# Wait until the queued records are written, e.g. before another process 
+# reads them. Does nothing when records are written directly.
+def flush_step_log_writer():
+    writer = step_log_writer
+    if writer is not None:
+        writer.flush()
+
+# Queued records are written even when the batch ends with an exception.
+atexit.register(stop_step_log_writer)
+
 # Get the date of the latest successful batch run for the endpoint.
-@debug_log
+@instrumented
 def get_last_batch_run(
         target_system, full_folder_name_value, endpoint_name, 
         do_not_include_today_flag):
-    cursor = create_cursor(cn.sql_connection_string)
     sql_proc_variables = [
         target_system, full_folder_name_value, endpoint_name, 
         do_not_include_today_flag]
@@ -99,6 +283,74 @@ def get_last_batch_run(
     EXEC @rv = [METADATA].[f_GetBatchStepStartDateTimeFromLastSuccessfulBatch] ?, ?, ?, ?;
     SELECT @rv AS return_value;
     """
-    cursor.execute(sql, sql_proc_variables)
-    return_value = cursor.fetchval()
-    return [return_value]
\ No newline at end of file
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, sql_proc_variables)
+        return_value = cursor.fetchval()
+    return [return_value]
+
+# Get the date of the latest successful batch run for many endpoints in one 
+# call. endpoints is a list of (full_folder_name_value, endpoint_name); 
+# returns a dictionary of those tuples to the date ('01/01/1900' when the 
+# endpoint never loaded successfully). Reads the watermark table, so the 
+# cost does not grow with the log history.
+@instrumented
+def get_last_batch_runs(target_system, endpoints, do_not_include_today_flag):
+    endpoints_json = json.dumps([
+        {'TargetSchema': full_folder_name_value, 'TargetObject': endpoint_name} 
+        for full_folder_name_value, endpoint_name in endpoints])
+    sql_proc_variables = [
+        target_system, endpoints_json, do_not_include_today_flag]
+
+    sql = """\
+    SET NOCOUNT ON
+    EXEC [METADATA].[s_GetBatchWatermarks] ?, ?, ?;
+    """
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, sql_proc_variables)
+        rows = cursor.fetchall()
+    return {
+        (row.TargetSchema, row.TargetObject): row.StartDateTime 
+        for row in rows}
+
+# Get the average duration in seconds of the last successful loads of many 
+# endpoints in one call, for scheduling the longest loads first. endpoints 
+# is a list of (full_folder_name_value, endpoint_name); endpoints that never 
+# loaded successfully are missing from the returned dictionary.
+@instrumented
+def get_step_durations(target_system, endpoints):
+    endpoints_json = json.dumps([
+        {'TargetSchema': full_folder_name_value, 'TargetObject': endpoint_name} 
+        for full_folder_name_value, endpoint_name in endpoints])
+    sql_proc_variables = [target_system, endpoints_json]
+
+    sql = """\
+    SET NOCOUNT ON
+    EXEC [METADATA].[s_GetStepDurations] ?, ?;
+    """
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, sql_proc_variables)
+        rows = cursor.fetchall()
+    return {
+        (row.TargetSchema, row.TargetObject): row.DurationSeconds 
+        for row in rows}
+
+# Get the start date and time of a batch and the status of each of its 
+# steps, to resume the batch. Returns (start datetime, {step name: status}); 
+# the start datetime is None when the batch does not exist.
+@instrumented
+def get_batch_steps(batch_id):
+    sql = """\
+    SET NOCOUNT ON
+    SELECT b.StartDateTime, bs.StepName, bs.Status
+    FROM METADATA.BatchLog b
+    LEFT JOIN METADATA.BatchStepLog bs
+        ON bs.BatchID = b.BatchID
+    WHERE b.BatchID = ?;
+    """
+    with pooled_cursor() as cursor:
+        cursor.execute(sql, [batch_id])
+        rows = cursor.fetchall()
+    if not rows:
+        return None, {}
+    return rows[0].StartDateTime, {
+        row.StepName: row.Status for row in rows if row.StepName is not None}
@@ -0,0 +1,207 @@
+"""Rate limits and retries
+
+This script is utilized by request_api.py and request_api_async.py to retry
+failed requests and to keep the requests made to a host within its limits.
+
+  * RetryPolicy: how often and after which responses a request is sent
+    again. The wait between attempts grows exponentially with full jitter
+    (a random wait between 0 and backoff * 2 ** attempt, capped at
+    max_backoff), or is the server's Retry-After when the response has one
+    (also capped at max_backoff; values that are not finite are ignored).
+  * HostLimiter: shared by every request to one scheme and host (see
+    get_host_limiter()). A token bucket holds the request rate to
+    rate_limit per second with bursts of up to burst requests, and an
+    adaptive concurrency limit (additive increase, multiplicative decrease)
+    halves the requests in flight after a throttled or failed response and
+    raises it by one again after as many good responses as the limit.
+    A Retry-After pauses every request to the host, not just the one that
+    got it.
+
+Python Module Requirements:
+
+ * asyncio
+ * email.utils
+ * math
+ * random
+ * threading
+ * time
+ * datetime
+ * urllib.parse
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime # Retry-After http dates
+import math
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# Default retry policy, see the retry_* config columns of request_api.py.
+RETRY_ATTEMPTS = 3 # retries after the first attempt
+RETRY_BACKOFF_SECONDS = 1
+RETRY_MAX_BACKOFF_SECONDS = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Longest Retry-After that is honored, so a bad header cannot stall a batch.
+RETRY_AFTER_MAX_SECONDS = 600
+# Responses that mean the host is overloaded (besides any other 5xx).
+THROTTLE_STATUSES = (429, 503)
+# How often a request waiting for a concurrency slot checks again (async).
+SLOT_POLL_SECONDS = 0.05
+
+host_limiters = {} # scheme://host: HostLimiter
+host_limiters_lock = threading.Lock()
+
+# Seconds to wait from a Retry-After header (seconds or an http date), or
+# None when the headers have none or it is not a finite number (nan, inf).
+def retry_after_seconds(headers):
+    if headers is None:
+        return None
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+    if not math.isfinite(seconds):
+        return None
+    return min(max(seconds, 0), RETRY_AFTER_MAX_SECONDS)
+
+# True when a response status (None for a connection error or timeout)
+# means the host is overloaded or failing.
+def is_throttled(status):
+    return status is None or status in THROTTLE_STATUSES or status >= 500
+
+# When and how long to wait before a request is sent again.
+class RetryPolicy:
+    def __init__(
+            self, attempts = RETRY_ATTEMPTS, backoff = RETRY_BACKOFF_SECONDS,
+            max_backoff = RETRY_MAX_BACKOFF_SECONDS,
+            statuses = RETRY_STATUSES):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = tuple(statuses)
+
+    # True when attempt (0 for the first) may be retried after a response
+    # with this status, or after a connection error or timeout (None).
+    def should_retry(self, attempt, status = None):
+        return attempt < self.attempts \
+            and (status is None or status in self.statuses)
+
+    # Seconds to wait from the response's Retry-After, at most max_backoff,
+    # or None when it has none.
+    def retry_after(self, headers):
+        retry_after = retry_after_seconds(headers)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_backoff)
+
+    # Seconds to wait after attempt: the response's Retry-After (see
+    # retry_after()), or an exponential backoff with full jitter.
+    def delay(self, attempt, headers = None):
+        retry_after = self.retry_after(headers)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+# Token bucket and adaptive concurrency limit for one host. rate_limit None
+# sends requests as fast as they come; max_concurrency None leaves the
+# number of requests in flight to the callers.
+class HostLimiter:
+    def __init__(
+            self, rate_limit = None, burst = None, max_concurrency = None):
+        self.rate_limit = rate_limit
+        self.burst = burst or max(1, rate_limit or 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.good_responses = 0
+        self.condition = threading.Condition()
+
+    # Seconds until a request may be sent, 0 when it may be sent now (the
+    # token and slot are then taken), or None while no slot is free. Call
+    # with the condition held.
+    def try_acquire(self):
+        now = time.monotonic()
+        if self.rate_limit:
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate_limit)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.limit is not None and self.in_flight >= self.limit:
+            return None
+        if self.rate_limit and self.tokens < 1:
+            return (1 - self.tokens) / self.rate_limit
+        if self.rate_limit:
+            self.tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    # Wait until a request may be sent to the host.
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.try_acquire()
+                if wait == 0:
+                    return
+                # a released slot wakes the waiters up early
+                self.condition.wait(wait)
+
+    # Async version of acquire(). The event loop is never blocked: the
+    # condition is only held to check, and the task sleeps in between.
+    async def acquire_async(self):
+        while True:
+            with self.condition:
+                wait = self.try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(SLOT_POLL_SECONDS if wait is None else wait)
+
+    # Give back the slot of a finished request. throttled (see is_throttled())
+    # halves the concurrency limit, good responses raise it again; pause is
+    # a Retry-After that holds back every request to the host.
+    def release(self, throttled = False, pause = None):
+        with self.condition:
+            self.in_flight -= 1
+            if self.max_concurrency is not None:
+                if throttled:
+                    self.limit = max(1, self.limit // 2)
+                    self.good_responses = 0
+                else:
+                    self.good_responses += 1
+                    if self.good_responses >= self.limit \
+                            and self.limit < self.max_concurrency:
+                        self.limit += 1
+                        self.good_responses = 0
+            if pause:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + pause)
+            self.condition.notify_all()
+
+# Get (or create) the HostLimiter of the host of a url. The limits of the
+# first row to reach a host apply to every row calling it.
+def get_host_limiter(
+        url, rate_limit = None, burst = None, max_concurrency = None):
+    parsed_url = urlparse(url)
+    host_key = parsed_url.scheme + '://' + parsed_url.netloc
+    with host_limiters_lock:
+        limiter = host_limiters.get(host_key)
+        if limiter is None:
+            limiter = HostLimiter(rate_limit, burst, max_concurrency)
+            host_limiters[host_key] = limiter
+    return limiter
@@ -15,6 +15,82 @@ current auth_type: token, user-pass, pass, api-key
 
 use_params: True or False
 
+HTTP requests go through pooled keep-alive sessions shared per host (see 
+get_session()); SESSION_POOL_SIZE and REQUEST_TIMEOUT tune the pool size and 
+the default (connect, read) timeouts.
+
+page_workers: optional config column, the number of pages fetched at the 
+same time by the *_paged_count configurations (default 1). Where pages must 
+be written in page order (ndjson/parquet output, both engines), at most 
+PAGE_WINDOW_PER_WORKER * page_workers pages are in flight or waiting to be 
+written (see ApiCall.page_window()), so memory stays bounded when writing 
+is slower than fetching.
+
+prefetch_pages: optional config column, the number of pages of a 
+*_paged_next endpoint fetched ahead of the page being written (default 2). 
+The next link is read as soon as a page arrives and the following page is 
+requested while earlier pages are written to blob storage in the 
+background; the fetcher waits once this many pages are queued. 0 fetches 
+and writes one page at a time, streaming raw passthrough pages.
+
+raw_passthrough: optional TRUE/FALSE config column. When TRUE json responses 
+are uploaded byte for byte instead of being parsed and re-serialized; only 
+the first page of *_paged_count endpoints is parsed (for the page count) and 
+the "__next" link of *_paged_next pages is found with a regular expression.
+
+compression: optional config column, 'gzip' or 'zstd' (default none). Blobs 
+are compressed on the fly and get a '.gz'/'.zst' extension and a matching 
+content_encoding.
+
+output_format: optional config column, 'json' (default, one blob per response 
+or page), 'ndjson' (records compacted into newline-delimited json part files) 
+or 'parquet' (records flattened into Parquet part files), see 
+output_writers.py. records_path is the dotted path of the records in a page 
+(e.g. 'd.results'), or an ElementTree path when response_format is xml, and 
+part_size_mb the target part size (default 128).
+
+delta_start_param: optional config column. For Delta rows 
+(target_update_strategy) the date of the last successful load, less 
+delta_lookback_days, is sent in this query parameter, formatted with 
+delta_date_format (default '%Y-%m-%d'). delta_end_param, when set, gets 
+today's date in the same format (e.g. startyear/endyear with '%Y' for BLS). 
+Endpoints that never loaded successfully, or runs with date_last_run None 
+(full reload), request the full history.
+
+response_cache: optional TRUE/FALSE config column for the non-paged 
+configurations. The ETag/Last-Modified of the last written response and a 
+hash of its body are kept in a '_response_cache-<endpoint_name>.json' blob in 
+the endpoint's folder. The request is sent with If-None-Match/
+If-Modified-Since, and a 304 or a body with the same hash is not written 
+again; the endpoint returns 'Unchanged' instead of 'Success'. Responses are 
+read into memory to be hashed, so they are not streamed.
+
+coalesce_batch_size: optional config column. Non-paged json rows with the 
+same api, credentials and parameters are requested together, up to this many 
+ids (endpoint_url) per POST, and the response is split back into one blob 
+per row (see coalesce_requests()). coalesce_id_param, coalesce_results_path 
+and coalesce_id_key default to the BLS v2 api ('seriesid', 'Results.series', 
+'seriesID').
+
+Requests that fail with a connection error, a timeout or one of 
+retry_statuses (default '429,500,502,503,504') are sent again up to 
+retry_attempts times (default 3), after the server's Retry-After or an 
+exponential backoff with jitter from retry_backoff_seconds (default 1), 
+either way at most retry_max_backoff_seconds (default 60). rate_limit_per_second and 
+rate_limit_burst cap the request rate of the row's host, and 
+host_max_concurrency its requests in flight; that limit is halved when the 
+host throttles or fails and grows back as it recovers (see rate_limits.py). 
+All are optional config columns.
+
+Paged loads given a PageCheckpoint record the pages written in a sidecar 
+blob, so a resumed run of a failed batch continues where the load stopped 
+(see PageCheckpoint).
+
+Every ApiCall counts the pages, records, bytes and retries of its load in 
+its counters (instrumentation.StepCounters). Records are only counted where 
+pages are split into records (records_path, or ndjson/parquet output); the 
+orchestrator logs them as the step's TargetRows.
+
 Should a new api not conform to an existing configuration:
 
   1. Add new elif condition to api_by_response_type() function
@@ -27,46 +103,52 @@ Python Module Requirements:
  * urllib3
  * ast
  * json
- * xml.etree.ElementTree
- * functools
+ * re
+ * concurrent.futures
+ * threading
+ * collections
+ * queue
+ * urllib.parse
+ * time
+ * hashlib
 
 Custom Module Requirements:
 
  * blob_functions.py
+ * output_writers.py
+ * rate_limits.py
+ * instrumentation.py
 """
 
-from functools import wraps # for debugging function. Set DEBUG variable = True
-
-from datetime import datetime
+from datetime import datetime, timedelta
+import time # access token expiry
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import collections # window of in-flight pages
+import queue # pages waiting to be written
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter # pooled connections per host
 import ast # used to convert string into dictionary
 import json
-import xml.etree.ElementTree as ET # for processing xml responses
+import re # finds the next page link without parsing the page
+import hashlib # response cache content hashes
 
 import urllib3 # to disable SSL warnings
 urllib3.disable_warnings()
 
-from blob_functions import blob_write
-
-# Set DEBUG to true to return function arguments and return values.
-DEBUG = False
-
-# Print the argument names and values and return values for debugging.
-def debug_log(function):
-    @wraps(function)
-    def wrapper(*args, **kwargs):
-        if DEBUG:
-            print(">> Called", function.__name__, "\n",
-                {**dict(zip(function.__code__.co_varnames, args)), **kwargs})
-        result = function(*args, **kwargs)
-        if DEBUG:
-            print(">>", function.__name__, "return:\n", result)
-        return result
-    return wrapper
+from blob_functions import blob_write, blob_write_stream, blob_read, \
+    blob_delete, COMPRESSION_EXTENSIONS
+from output_writers import NdjsonPartWriter, ParquetPartWriter, \
+    extract_records, extract_xml_records
+from rate_limits import RetryPolicy, get_host_limiter, is_throttled, \
+    RETRY_ATTEMPTS, RETRY_BACKOFF_SECONDS, RETRY_MAX_BACKOFF_SECONDS, \
+    RETRY_STATUSES
+from instrumentation import instrumented, span, StepCounters
 
 # Find a key in a nested dictionary and return value.
-@debug_log
+@instrumented
 def recursive_lookup(k, d):
     if k in d:
         return d[k]
@@ -75,32 +157,583 @@ def recursive_lookup(k, d):
             return recursive_lookup(k, v)
     return None
 
+# Parse a json response body, timed as a json.parse span.
+def parse_json(content):
+    with span('json.parse') as parse:
+        parse.add('bytes', len(content))
+        return json.loads(content)
+
+# Read an optional config file column. Missing columns, blank cells (read as 
+# NaN by pandas) and 'none' fall back to the default.
+def config_value(aip_config_row, key, default):
+    value = aip_config_row.get(key, default)
+    if value is None or value != value or str(value).lower() == 'none':
+        return default
+    return value
+
+# Read an optional TRUE/FALSE config file column (default False).
+def config_flag(aip_config_row, key):
+    value = config_value(aip_config_row, key, False)
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', '1')
+    return bool(value)
+
+# "__next": "<url>" of an OData style page, for raw passthrough mode.
+NEXT_LINK_PATTERN = re.compile(rb'"__next"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# Finds the last "__next" link of a response read in chunks. The tail of the 
+# previous chunk is kept so a link split across two chunks is still found.
+class NextLinkScanner:
+    def __init__(self):
+        self.tail = b''
+        self.next_page = None
+
+    def scan(self, chunk):
+        window = self.tail + chunk
+        matches = NEXT_LINK_PATTERN.findall(window)
+        if matches:
+            self.next_page = json.loads(matches[-1])
+        self.tail = window[-NEXT_LINK_WINDOW:]
+
+PREFETCH_PAGES = 2 # default pages fetched ahead of the page being written
+PAGE_WINDOW_PER_WORKER = 2 # in-order pages in flight per page worker
+NEXT_LINK_WINDOW = 64 * 1024 # longest "__next" link found across chunks
+STREAM_CHUNK_SIZE = 1024 * 1024 # read size of streamed responses
+
+# Shared HTTP sessions, one per scheme and host, reused by every ApiCall in 
+# the process so paged and multi-endpoint loads keep their connections open 
+# (keep-alive) instead of paying a TCP/TLS handshake per request. requests 
+# sessions already ask for and decode gzip/deflate responses.
+SESSION_POOL_SIZE = 20 # max open connections kept per host
+REQUEST_TIMEOUT = (10, 300) # (connect, read) seconds
+
+# Returned by the requests_get() reader for a 401 that may be retried with 
+# a refreshed token.
+UNAUTHORIZED = object()
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Get (or create) the pooled session for the host of a url.
+def get_session(url):
+    parsed_url = urlparse(url)
+    host_key = parsed_url.scheme + '://' + parsed_url.netloc
+    with sessions_lock:
+        session = sessions.get(host_key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=SESSION_POOL_SIZE)
+            session.mount(host_key, adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.headers['Connection'] = 'keep-alive'
+            sessions[host_key] = session
+    return session
+
+# Access tokens shared by every ApiCall in the process, keyed by (token_url, 
+# token request body), so endpoints of one source share a token instead of 
+# posting to token_url once per endpoint. A token is refreshed 
+# TOKEN_REFRESH_MARGIN seconds before it expires; tokens returned without 
+# expires_in are kept for TOKEN_DEFAULT_LIFETIME seconds (a 401 still 
+# refreshes them early).
+TOKEN_REFRESH_MARGIN = 60
+TOKEN_DEFAULT_LIFETIME = 300
+
+access_tokens = {} # key: (token, refresh time)
+access_token_locks = {} # key: lock, so a token is only requested once
+access_tokens_lock = threading.Lock()
+
+# Cached token for key, or None when missing or due for refresh.
+def cached_access_token(key):
+    with access_tokens_lock:
+        cached = access_tokens.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+def store_access_token(key, token, expires_in):
+    try:
+        lifetime = float(expires_in) - TOKEN_REFRESH_MARGIN
+    except (TypeError, ValueError):
+        lifetime = TOKEN_DEFAULT_LIFETIME
+    with access_tokens_lock:
+        access_tokens[key] = (token, time.monotonic() + max(lifetime, 0))
+
+# Drop the cached token for key if it is still the token the api rejected 
+# (another caller may already have refreshed it).
+def invalidate_access_token(key, rejected_token):
+    with access_tokens_lock:
+        cached = access_tokens.get(key)
+        if cached is not None and cached[0] == rejected_token:
+            del access_tokens[key]
+
+def get_access_token_lock(key):
+    with access_tokens_lock:
+        return access_token_locks.setdefault(key, threading.Lock())
+
+# Watermarks at or before this date mean the endpoint never loaded.
+NO_WATERMARK = datetime(1900, 1, 2)
+
+# Query parameters of a delta load for the last successful load date (see 
+# the module docstring). Empty for a full load.
+def delta_url_params(aip_config_row, date_last_run):
+    start_param = config_value(aip_config_row, 'delta_start_param', None)
+    if start_param is None or date_last_run is None \
+            or str(aip_config_row['target_update_strategy']).lower() \
+                != 'delta':
+        return {}
+    if not isinstance(date_last_run, datetime):
+        date_last_run = datetime.combine(date_last_run, datetime.min.time())
+    if date_last_run < NO_WATERMARK:
+        return {}
+    date_format = config_value(aip_config_row, 'delta_date_format', '%Y-%m-%d')
+    lookback_days = int(float(
+        config_value(aip_config_row, 'delta_lookback_days', 0)))
+    params = {
+        start_param: (date_last_run - timedelta(days=lookback_days)
+            ).strftime(date_format)}
+    end_param = config_value(aip_config_row, 'delta_end_param', None)
+    if end_param is not None:
+        params[end_param] = datetime.now().strftime(date_format)
+    return params
+
+# Config file rows of a non-paged api that accepts many ids in one POST (BLS 
+# timeseries: up to 50 series ids) can be coalesced into batched requests 
+# with the coalesce_batch_size column. Defaults fit the BLS v2 api: the ids 
+# (endpoint_url of each row) go in the 'seriesid' field of the json body, 
+# and the per-id results are found at 'Results.series' by their 'seriesID'.
+COALESCE_API_TYPES = ('json_user_pass_not_paged', 'json_api_key_not_paged')
+COALESCE_ID_PARAM = 'seriesid'
+COALESCE_RESULTS_PATH = 'Results.series'
+COALESCE_ID_KEY = 'seriesID'
+
+# Copy of value with the item at the dotted path keys replaced. Only the 
+# dictionaries along the path are copied.
+def replace_at_path(value, keys, replacement):
+    if not keys:
+        return replacement
+    copy = dict(value)
+    copy[keys[0]] = replace_at_path(value[keys[0]], keys[1:], replacement)
+    return copy
+
+# Split a batched response into one response per id, each shaped like the 
+# response to a request for that id alone (the results list at results_path 
+# holds only its own result).
+def split_batch_response(response, results_path, id_key):
+    keys = results_path.split('.')
+    results = response
+    for key in keys:
+        results = results.get(key) if isinstance(results, dict) else None
+    if not isinstance(results, list):
+        return {}
+    return {
+        str(result.get(id_key)): replace_at_path(response, keys, [result])
+        for result in results if isinstance(result, dict)}
+
+# The rows sharing one batched request. The first row to need it sends the 
+# request for every row (concurrent rows wait for it), and each row takes 
+# its own response from the result.
+class RequestBatch:
+    def __init__(self, endpoint_urls):
+        self.endpoint_urls = endpoint_urls
+        self.lock = threading.Lock()
+        self.async_lock = None # created on the event loop, see AsyncApiCall
+        self.responses = None # endpoint_url: response content, or the error
+
+    # Response content (bytes) for the row of api_call, or, as a string, 
+    # the error of the batched request.
+    def content_for(self, api_call):
+        with self.lock:
+            if self.responses is None:
+                self.responses = api_call.request_batch_responses(
+                    self.endpoint_urls)
+        return self.take(api_call.endpoint_url)
+
+    # Take the response of a row out of the batch; 'MissingFromBatch' when 
+    # the batched response had none for it.
+    def take(self, endpoint_url):
+        if isinstance(self.responses, str): # returned string indicates error
+            return self.responses
+        return self.responses.pop(endpoint_url, 'MissingFromBatch')
+
+# Group the config file rows that can share batched requests: rows with 
+# coalesce_batch_size above 1 and the same api, credentials and request 
+# parameters (including their delta parameters) are put in batches of up to 
+# coalesce_batch_size, in config file order. Returns the RequestBatch of 
+# each row, None for rows requested on their own.
+def coalesce_requests(config_data_list, dates_last_run):
+    groups = {}
+    for index, (config, date_last_run) in enumerate(
+            zip(config_data_list, dates_last_run)):
+        batch_size = int(float(config_value(config, 'coalesce_batch_size', 1)))
+        if batch_size < 2 or config['api_type'] not in COALESCE_API_TYPES:
+            continue
+        key = (
+            config['base_url'], config['api_type'], config['auth_type'], 
+            config['user'], config['keyvault_secret_password_name'], 
+            config['additional_url_string'], 
+            tuple(sorted(delta_url_params(config, date_last_run).items())), 
+            config_value(config, 'coalesce_id_param', COALESCE_ID_PARAM), 
+            batch_size)
+        groups.setdefault(key, []).append(index)
+
+    request_batches = [None] * len(config_data_list)
+    for key, indexes in groups.items():
+        batch_size = key[-1]
+        for start in range(0, len(indexes), batch_size):
+            batch_indexes = indexes[start:start + batch_size]
+            if len(batch_indexes) < 2:
+                continue
+            request_batch = RequestBatch([
+                config_data_list[index]['endpoint_url'] 
+                for index in batch_indexes])
+            for index in batch_indexes:
+                request_batches[index] = request_batch
+    return request_batches
+
+# Pages written between checkpoint saves of a paged load.
+CHECKPOINT_INTERVAL = 10
+
+# Progress of a paged load, kept in a '_checkpoint-<endpoint_name>.json' blob 
+# in the endpoint's folder so that a resumed run of the same batch continues 
+# where the load stopped. state['page'] is the next page to load (every page 
+# before it is written); next link loads also keep that page's url 
+# ('next_page') and compacted outputs the number of part files committed 
+# ('part_count'). date_string is the date of the batch, used in the file 
+# names, so a resumed load keeps writing to the same files.
+class PageCheckpoint:
+    def __init__(
+            self, container_name, endpoint_name, batch_id, date_string, 
+            resume = False):
+        self.container_name = container_name
+        self.file_name = '_checkpoint-' + endpoint_name + '.json'
+        self.batch_id = batch_id
+        self.date_string = date_string
+        self.resume = resume
+        self.state = {}
+        self.saved_page = None
+        self.lock = threading.Lock()
+
+    # Read the checkpoint left by an earlier run of the same batch.
+    @instrumented
+    def load(self):
+        if not self.resume:
+            return self.state
+        content = blob_read(self.container_name, self.file_name)
+        if content:
+            state = json.loads(content)
+            if state.get('batch_id') == self.batch_id:
+                self.state = state
+                self.saved_page = state.get('page')
+        return self.state
+
+    # Record that every page before page is written, with any other state 
+    # (next_page). Returns True when CHECKPOINT_INTERVAL pages were written 
+    # since the last save.
+    def advance(self, page, **state):
+        self.state['page'] = page
+        self.state.update(state)
+        return page - (self.saved_page or 0) >= CHECKPOINT_INTERVAL
+
+    @instrumented
+    def save(self):
+        with self.lock:
+            self.state['batch_id'] = self.batch_id
+            self.state['date_string'] = self.date_string
+            blob_write(
+                'application/json', self.container_name, self.file_name, 
+                json.dumps(self.state))
+            self.saved_page = self.state.get('page')
+
+    # Remove the checkpoint once the load completed.
+    @instrumented
+    def clear(self):
+        if self.saved_page is not None:
+            blob_delete(self.container_name, self.file_name)
+            self.saved_page = None
+
 class ApiCall:
-    @debug_log
+    @instrumented
     def __init__(
-            self, aip_config_row, full_folder_name, access_token, password):
+            self, aip_config_row, full_folder_name, access_token, password, 
+            date_last_run = None, request_batch = None, checkpoint = None):
+        self.counters = StepCounters() # pages, records, bytes, retries
+        self.configure(
+            aip_config_row, full_folder_name, access_token, password, 
+            date_last_run, request_batch, checkpoint)
+        
+        self.success_response = self.close_output(self.api_by_response_type())
+
+    # Read the endpoint settings from its config file row. date_last_run is 
+    # the date of the endpoint's last successful load, for delta loads, and 
+    # request_batch the batched request shared with other rows, if any. 
+    # With a PageCheckpoint paged loads record their progress and the 
+    # checkpoint's batch date is used in the file names.
+    @instrumented
+    def configure(
+            self, aip_config_row, full_folder_name, access_token, password, 
+            date_last_run = None, request_batch = None, checkpoint = None):
         self.api_type = aip_config_row['api_type']
         self.auth_type = aip_config_row['auth_type']
         self.use_params = aip_config_row['use_params']
         self.endpoint_name = aip_config_row['endpoint_name']
+        self.base_url = aip_config_row['base_url']
+        self.endpoint_url = aip_config_row['endpoint_url']
         self.full_url = aip_config_row['base_url'] \
             + aip_config_row['endpoint_url']
         self.additional_url_dict = ast.literal_eval(
             aip_config_row['additional_url_string'])  
+        self.delta_params = delta_url_params(aip_config_row, date_last_run)
+        self.additional_url_dict.update(self.delta_params)
+        self.response_cache = config_flag(aip_config_row, 'response_cache')
+        self.cache_entry = None # entry saved by the last run
+        self.new_cache_entry = None # entry of this run's response
+        self.cache_request_key = None
+        self.request_batch = request_batch
+        self.coalesce_id_param = config_value(
+            aip_config_row, 'coalesce_id_param', COALESCE_ID_PARAM)
+        self.coalesce_results_path = config_value(
+            aip_config_row, 'coalesce_results_path', COALESCE_RESULTS_PATH)
+        self.coalesce_id_key = config_value(
+            aip_config_row, 'coalesce_id_key', COALESCE_ID_KEY)
         self.token_url = aip_config_row['token_url']
         self.user = aip_config_row['user']
         self.password = password
         self.access_token = access_token
         self.first_page_number = aip_config_row['first_page_number']
         self.total_pages_key_name = aip_config_row['total_pages_key_name']
-        self.date_string = datetime.now().strftime("%Y%m%d")
+        self.page_workers = int(
+            config_value(aip_config_row, 'page_workers', 1))
+        self.prefetch_pages = int(
+            config_value(aip_config_row, 'prefetch_pages', PREFETCH_PAGES))
+        self.retry_policy = RetryPolicy(
+            int(config_value(
+                aip_config_row, 'retry_attempts', RETRY_ATTEMPTS)), 
+            float(config_value(
+                aip_config_row, 'retry_backoff_seconds', 
+                RETRY_BACKOFF_SECONDS)), 
+            float(config_value(
+                aip_config_row, 'retry_max_backoff_seconds', 
+                RETRY_MAX_BACKOFF_SECONDS)), 
+            [int(status) for status in str(config_value(
+                aip_config_row, 'retry_statuses', 
+                ','.join(str(status) for status in RETRY_STATUSES)
+                )).split(',') if status.strip()])
+        self.rate_limit = config_value(
+            aip_config_row, 'rate_limit_per_second', None)
+        if self.rate_limit is not None:
+            self.rate_limit = float(self.rate_limit)
+        self.rate_limit_burst = config_value(
+            aip_config_row, 'rate_limit_burst', None)
+        if self.rate_limit_burst is not None:
+            self.rate_limit_burst = int(self.rate_limit_burst)
+        self.host_max_concurrency = config_value(
+            aip_config_row, 'host_max_concurrency', None)
+        if self.host_max_concurrency is not None:
+            self.host_max_concurrency = int(self.host_max_concurrency)
+        self.raw_passthrough = config_flag(aip_config_row, 'raw_passthrough')
+        self.compression = config_value(aip_config_row, 'compression', None)
+        if self.compression is not None \
+                and self.compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('unknown compression: ' + str(self.compression))
+        self.checkpoint = checkpoint
+        if checkpoint is not None:
+            self.date_string = checkpoint.date_string
+        else:
+            self.date_string = datetime.now().strftime("%Y%m%d")
         self.full_folder_name_value = full_folder_name
-        
-        self.success_response = self.api_by_response_type()
-        
+        self.response_format = config_value(
+            aip_config_row, 'response_format', 'json')
+        self.output_format = config_value(
+            aip_config_row, 'output_format', 'json')
+        self.records_path = config_value(aip_config_row, 'records_path', None)
+        self.part_writer = None
+        part_size = int(float(config_value(
+            aip_config_row, 'part_size_mb', 128)) * 1024 * 1024)
+        if self.output_format == 'ndjson':
+            self.part_writer = NdjsonPartWriter(
+                self.full_folder_name_value, 
+                self.endpoint_name + '-' + self.date_string, part_size, 
+                self.compression)
+        elif self.output_format == 'parquet':
+            self.part_writer = ParquetPartWriter(
+                self.full_folder_name_value, 
+                self.endpoint_name + '-' + self.date_string, part_size, 
+                self.compression)
+        elif self.output_format != 'json':
+            raise ValueError('unknown output format: ' + self.output_format)
+        if self.part_writer is not None:
+            if self.response_format not in ('json', 'xml'):
+                raise ValueError(
+                    self.output_format + ' output needs a json or xml response')
+            # Records have to be read from every page.
+            self.raw_passthrough = False
+
+    # Blob file name for the endpoint's response, or one page of it.
+    def file_name(self, page = None, extension = '.json'):
+        if page is None:
+            return self.endpoint_name + '-' + self.date_string + extension
+        return self.endpoint_name + '-' + self.date_string + '-page-' \
+            + str(page).rjust(3, '0') + extension
+
+    # Write a response body held in memory to the endpoint's folder.
+    def write_blob(self, content_type, file_name, body):
+        blob_write(
+            content_type, self.full_folder_name_value, file_name, body, 
+            self.compression)
+
+    # Write one json page (page None for a non-paged response) and return the 
+    # parsed response. The page is written as its own blob, or its records go 
+    # to the part writer when the output is compacted. In raw passthrough mode 
+    # the response bytes are uploaded unchanged and not parsed (None is 
+    # returned unless the caller already parsed them).
+    def write_json_page(self, content, page = None, parsed = None):
+        if parsed is None and not self.raw_passthrough:
+            parsed = parse_json(content)
+        self.counters.add('pages')
+        self.counters.add('bytes', len(content))
+        if self.part_writer is not None:
+            records = extract_records(
+                parsed, self.records_path, 
+                self.part_writer.include_parent_fields)
+            self.counters.add('records', len(records))
+            self.part_writer.write_records(records)
+        elif self.raw_passthrough:
+            self.write_blob('application/json', self.file_name(page), content)
+        else:
+            self.count_records(parsed)
+            self.write_blob(
+                'application/json', self.file_name(page), json.dumps(parsed))
+        return parsed
+
+    # Count the records of a parsed page written as a whole. Pages are only 
+    # split into records with a records_path; without one the number of 
+    # records is unknown and not counted.
+    def count_records(self, parsed):
+        if self.records_path is not None:
+            self.counters.add(
+                'records', len(extract_records(parsed, self.records_path)))
+
+    # Write the records of an xml response to the part writer.
+    def write_xml_records(self, content):
+        records = extract_xml_records(content, self.records_path)
+        self.counters.add('pages')
+        self.counters.add('bytes', len(content))
+        self.counters.add('records', len(records))
+        self.part_writer.write_records(records)
+
+    # Commit or drop the open output part, if any, once the load finished.
+    def close_output(self, success_response):
+        resumable = self.checkpoint is not None \
+            and 'page' in self.checkpoint.state
+        part_count = None
+        if self.part_writer is not None:
+            # The records of pages already written are kept when the load 
+            # can be resumed from its checkpoint.
+            part_count = self.part_writer.close(
+                commit = success_response == 'Success' or resumable)
+        if self.checkpoint is not None:
+            if success_response in ('Success', 'Unchanged'):
+                self.checkpoint.clear()
+            elif resumable:
+                if part_count is not None:
+                    self.checkpoint.state['part_count'] = part_count
+                self.checkpoint.save()
+        return success_response
+
+    # Load the checkpoint of an interrupted run of the batch (see 
+    # PageCheckpoint) and return its state, empty when starting afresh.
+    def resume_checkpoint(self):
+        if self.checkpoint is None:
+            return {}
+        state = self.checkpoint.load()
+        if self.part_writer is not None:
+            self.part_writer.part_count = state.get('part_count', 0)
+        return state
+
+    # Record a written page in the checkpoint. Compacted outputs only save 
+    # the checkpoint in close_output(), once their open part is committed.
+    def page_written(self, page, **state):
+        if self.checkpoint is not None \
+                and self.checkpoint.advance(page + 1, **state) \
+                and self.part_writer is None:
+            self.checkpoint.save()
+
+    # Blob (in the endpoint's folder) holding the response cache entry.
+    def response_cache_file_name(self):
+        return '_response_cache-' + self.endpoint_name + '.json'
+
+    # Read the response cache entry saved by the last run.
+    @instrumented
+    def load_response_cache(self):
+        content = blob_read(
+            self.full_folder_name_value, self.response_cache_file_name())
+        self.cache_entry = json.loads(content) if content else {}
+
+    # Save the cache entry of this run's response once it is written (or 
+    # found unchanged with new validators).
+    @instrumented
+    def save_response_cache(self):
+        if self.new_cache_entry is not None \
+                and self.new_cache_entry != self.cache_entry:
+            blob_write(
+                'application/json', self.full_folder_name_value, 
+                self.response_cache_file_name(), 
+                json.dumps(self.new_cache_entry))
+
+    # If-None-Match/If-Modified-Since headers for a request, when the cache 
+    # entry is for the same url and parameters. The entry only stores a hash 
+    # of them, so api keys sent as parameters are not written anywhere.
+    def conditional_headers(self, url, params):
+        self.cache_request_key = hashlib.sha256(json.dumps([
+            url, sorted((str(key), str(value)) 
+                for key, value in (params or {}).items())
+            ]).encode('utf-8')).hexdigest()
+        headers = {}
+        if self.cache_entry \
+                and self.cache_entry.get('request_key') \
+                    == self.cache_request_key:
+            if self.cache_entry.get('etag'):
+                headers['If-None-Match'] = self.cache_entry['etag']
+            if self.cache_entry.get('last_modified'):
+                headers['If-Modified-Since'] = \
+                    self.cache_entry['last_modified']
+        return headers
+
+    # True when a response is the same as the last run's: 304 Not Modified, 
+    # or a body with the same hash. Keeps this response's entry for 
+    # save_response_cache().
+    def is_unchanged(self, status_code, headers, content):
+        if status_code == 304:
+            return True
+        self.new_cache_entry = {
+            'request_key': self.cache_request_key,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'content_hash': hashlib.sha256(content).hexdigest()}
+        return bool(self.cache_entry) \
+            and self.cache_entry.get('request_key') == self.cache_request_key \
+            and self.cache_entry.get('content_hash') \
+                == self.new_cache_entry['content_hash']
+
+    # Get the "__next" link of an OData style response, None on the last page.
+    # Without a parsed response the link is found with a regular expression 
+    # instead of parsing the whole page; the last match is used because the 
+    # top level "__next" is serialized after the "results" array.
+    def next_page_url(self, content, parsed = None):
+        if parsed is None:
+            matches = NEXT_LINK_PATTERN.findall(content)
+            if not matches:
+                return None
+            return json.loads(matches[-1])
+        try:
+            return parsed['d']['__next']
+        except KeyError:
+            return None
+
     # Determines which function to use based on criteria defined in the config 
     # file.
-    @debug_log
+    @instrumented
     def api_by_response_type(self):
         if self.api_type == 'json_token_paged_count':
             success_response = self.json_token_paged_count()
@@ -124,138 +757,400 @@ class ApiCall:
             success_response = self.csv_user_pass_not_paged()
             return success_response        
         
-    # Post to get api access token.
-    @debug_log
+    # Post to get api access token. Returns (token, expires_in); a returned 
+    # string indicates an error.
     def requests_post(self):
         try:
             data = json.loads(self.access_token)
-            response = requests.post(
-                self.token_url, data=data, verify=False, 
-                allow_redirects=False)
+            response = self.send_with_retries(
+                get_session(self.token_url).post, self.token_url, data=data, 
+                verify=False, allow_redirects=False, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            response = response.json()['access_token']
-            return response
-        except requests.exceptions.HTTPError as errh:
+            response = response.json()
+            return response['access_token'], response.get('expires_in')
+        except requests.exceptions.HTTPError:
             success_response = 'HTTPError'
-        except requests.exceptions.ConnectionError as errc:
+        except requests.exceptions.ConnectionError:
             success_response = 'ConnectionError'
-        except requests.exceptions.Timeout as errt:
+        except requests.exceptions.Timeout:
             success_response = 'Timeout'
-        except requests.exceptions.RequestException as err:
+        except requests.exceptions.RequestException:
             success_response = 'RequestException'
         return success_response
 
+    # Key of this endpoint's token in the process-wide token cache.
+    def token_key(self):
+        return self.token_url, self.access_token
+
+    # Get the api access token from the token cache, posting to token_url 
+    # when it is missing or about to expire. Concurrent callers wait for a 
+    # single post. expired_token (a token the api rejected with a 401) is 
+    # dropped from the cache first. Returns ('Success', token); a returned 
+    # string indicates an error.
+    def get_access_token(self, expired_token = None):
+        key = self.token_key()
+        if expired_token is not None:
+            invalidate_access_token(key, expired_token)
+        token = cached_access_token(key)
+        if token is None:
+            with get_access_token_lock(key):
+                token = cached_access_token(key)
+                if token is None:
+                    with span('token.request', host=urlparse(
+                            self.token_url).netloc) as token_request:
+                        response = self.requests_post()
+                    if isinstance(response, str): # string indicates error
+                        token_request.set('status', response)
+                        return response
+                    token, expires_in = response
+                    store_access_token(key, token, expires_in)
+        return 'Success', token
+
+    # After a 401, replace the bearer token in headers (in place, so later 
+    # pages sent with the same headers use it too) with a refreshed one. 
+    # Returns True when the request should be retried.
+    def refresh_authorization(self, headers):
+        authorization = headers.get('Authorization', '')
+        if self.auth_type != 'token' or not authorization.startswith('Bearer '):
+            return False
+        response = self.get_access_token(
+            expired_token = authorization[len('Bearer '):])
+        if isinstance(response, str): # returned string indicates error
+            return False
+        headers['Authorization'] = 'Bearer ' + response[1]
+        return True
+
+    # HostLimiter of a url's host, created with this row's limits when the 
+    # host has none yet.
+    def host_limiter(self, url):
+        return get_host_limiter(
+            url, self.rate_limit, self.rate_limit_burst, 
+            self.host_max_concurrency)
+
+    # Send a request (send is a session method, e.g. get_session(url).get) 
+    # within the host's limits, again after connection errors, timeouts and 
+    # retry statuses as the retry policy allows. Returns the last response, 
+    # or, when a consumer function is given, what the consumer returns for 
+    # it; a response that breaks off while the consumer reads it is 
+    # requested again too. The error of the last attempt is raised.
+    def send_with_retries(self, send, url, consumer = None, **request_kwargs):
+        limiter = self.host_limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            status = None
+            pause = None
+            try:
+                with span(
+                        'http.request', host=urlparse(url).netloc, 
+                        attempt=attempt) as request_span:
+                    response = send(url, **request_kwargs)
+                    request_span.set('status', response.status_code)
+                status = response.status_code
+                if not self.retry_policy.should_retry(attempt, status):
+                    if consumer is None:
+                        return response
+                    try:
+                        return consumer(response)
+                    finally:
+                        response.close()
+                delay = self.retry_policy.delay(attempt, response.headers)
+                pause = self.retry_policy.retry_after(response.headers)
+                response.close()
+            except (requests.exceptions.ConnectionError, 
+                    requests.exceptions.ChunkedEncodingError, 
+                    requests.exceptions.Timeout):
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+            finally:
+                limiter.release(is_throttled(status), pause)
+            self.counters.add('retries')
+            time.sleep(delay)
+            attempt += 1
+
+    # Build the url and request arguments for the configured authentication 
+    # type. Returns None when the auth type is unknown.
+    @instrumented
+    def request_arguments(self, additional_url_dict = {}, headers = {}):
+        url = self.full_url
+        request_kwargs = {}
+        # Api authentication is token.
+        if self.auth_type == 'token':
+            # Api requires additional parameters.
+            if self.use_params == True: 
+                request_kwargs['params'] = additional_url_dict
+                request_kwargs['headers'] = headers
+            # Api requires no additional parameters.
+            else: 
+                request_kwargs['auth'] = (self.user, self.password)
+        # Api authentication is basic user/password.
+        elif self.auth_type == 'user-pass': 
+            if self.use_params == True:
+                request_kwargs['params'] = additional_url_dict
+            request_kwargs['auth'] = (self.user, self.password)
+        # Api authentication is password only
+        # TODO: need to test with api (xml)
+        elif self.auth_type == 'pass':  
+            url = self.full_url + self.password
+            if self.use_params == True:
+                request_kwargs['params'] = additional_url_dict
+        # Api authentication is api key
+        elif self.auth_type == 'api-key':
+            if self.use_params == True:
+                request_kwargs['params'] = additional_url_dict
+        else:
+            return None
+        return url, request_kwargs
+
     # Get api response given different authentication types and page types.
-    @debug_log
-    def requests_get(self, additional_url_dict = {}, headers = {}):
+    # With conditional the request carries the response cache validators. 
+    # A consumer function, when given, reads the open (streamed) response 
+    # instead and its result is returned.
+    @instrumented
+    def requests_get(
+            self, additional_url_dict = {}, headers = {}, consumer = None, 
+            conditional = False):
         try:
-            # Api authentication is token.
-            if self.auth_type == 'token':
-                # Api requires additional parameters.
-                if self.use_params == True: 
-                    response = requests.get(
-                        self.full_url, params=additional_url_dict, 
-                        headers = headers, verify = False)                    
-                    response.raise_for_status()
-                    return response
-                # Api requires no additional parameters.
-                else: 
-                    response = requests.get(
-                        self.full_url, auth=(
-                            self.user, 
-                            self.password), 
-                        verify = False)
-                    response.raise_for_status()
-                    return response
-            # Api authentication is basic user/password.
-            elif self.auth_type == 'user-pass': 
-                if self.use_params == True:
-                    response = requests.get(
-                        self.full_url, params=additional_url_dict, 
-                        auth=(self.user, self.password), verify = False)
-                    response.raise_for_status()
-                    return response
-                else: 
-                    response = requests.get(
-                        self.full_url, auth=(self.user, self.password), 
-                        verify = False)
-                    response.raise_for_status()
-                    return response
-            # Api authentication is password only
-            # TODO: need to test with api (xml)
-            elif self.auth_type == 'pass':  
-                if self.use_params == True:
-                    response = requests.get(
-                        self.full_url + self.password, 
-                        params=additional_url_dict, verify = False)
-                    response.raise_for_status()
-                    return response
-                else:
-                    response = requests.get(
-                        self.full_url + self.password, 
-                        verify = False)
-                    response.raise_for_status()
-                    return response
-            # Api authentication is api key
-            elif self.auth_type == 'api-key':
-                if self.use_params == True:
-                    response = requests.get(
-                        self.full_url, params=additional_url_dict, 
-                        verify = False)
-                    response.raise_for_status()
-                    return response
-                else:
-                    response = requests.get(
-                        self.full_url, verify = False)
-                    response.raise_for_status()
-                    return response
-            else:
+            request_arguments = self.request_arguments(
+                additional_url_dict, headers)
+            if request_arguments is None:
                 print('auth type is unknown')  
                 success_response = 'Success'
+            else:
+                url, request_kwargs = request_arguments
+                if conditional:
+                    request_kwargs['headers'] = {
+                        **request_kwargs.get('headers', {}), 
+                        **self.conditional_headers(
+                            url, request_kwargs.get('params'))}
+                # Expired or revoked token: refresh it and retry once.
+                for attempt in range(2):
+
+                    def read(response):
+                        if response.status_code == 401 and attempt == 0:
+                            return UNAUTHORIZED
+                        response.raise_for_status()
+                        if consumer is None:
+                            return response
+                        return consumer(response)
+
+                    result = self.send_with_retries(
+                        get_session(url).get, url, read, verify = False, 
+                        timeout = REQUEST_TIMEOUT, 
+                        stream = consumer is not None, **request_kwargs)
+                    if result is not UNAUTHORIZED:
+                        return result
+                    if not self.refresh_authorization(headers):
+                        print('An Http Error occurred: 401 Unauthorized')
+                        return 'HTTPError'
+                    if 'headers' in request_kwargs:
+                        request_kwargs['headers'].update(headers)
         except requests.exceptions.HTTPError as errh:
             print("An Http Error occurred:" + repr(errh))
             success_response = 'HTTPError'
-        except requests.exceptions.ConnectionError as errc:
-            #print("An Error Connecting to the API occurred:" + repr(errc))
+        except requests.exceptions.ConnectionError:
             success_response = 'ConnectionError'
-        except requests.exceptions.Timeout as errt:
-            #print("A Timeout Error occurred:" + repr(errt))
+        except requests.exceptions.Timeout:
             success_response = 'Timeout'
-        except requests.exceptions.RequestException as err:
-            #print("An Unknown Error occurred" + repr(err))
+        except requests.exceptions.RequestException:
             success_response = 'RequestException'
         return success_response 
     
+    # Consumer for requests_get() that streams the response straight to blob 
+    # storage in STREAM_CHUNK_SIZE chunks, so memory use does not grow with 
+    # the response size. With find_next_link the "__next" link is picked up 
+    # from the chunks on the way through. The consumer returns ('Success', 
+    # next link or None). A response that breaks off is requested again by 
+    # send_with_retries(); the blocks staged for it are never committed.
+    def stream_to_blob(self, content_type, file_name, find_next_link = False):
+        def consumer(response):
+            scanner = NextLinkScanner()
+            self.counters.add('pages')
+
+            def chunks():
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    if find_next_link:
+                        scanner.scan(chunk)
+                    self.counters.add('bytes', len(chunk))
+                    yield chunk
+
+            blob_write_stream(
+                content_type, self.full_folder_name_value, file_name, 
+                chunks(), self.compression)
+            return 'Success', scanner.next_page
+        return consumer
+
+    # Send the batched request for the ids (endpoint_urls) of a RequestBatch: 
+    # one POST to base_url with the ids in coalesce_id_param and the row's 
+    # request parameters in the json body. Returns a dictionary of each id 
+    # to its own response content (bytes), or, as a string, the error.
+    @instrumented
+    def request_batch_responses(self, endpoint_urls):
+        request_arguments = self.request_arguments()
+        if request_arguments is None:
+            return 'UnknownAuthType'
+        url, request_kwargs = request_arguments
+        body = dict(self.additional_url_dict)
+        body[self.coalesce_id_param] = list(endpoint_urls)
+        try:
+            response = self.send_with_retries(
+                get_session(self.base_url).post, self.base_url, json = body, 
+                verify = False, timeout = REQUEST_TIMEOUT, 
+                auth = request_kwargs.get('auth'))
+            response.raise_for_status()
+            parsed = parse_json(response.content)
+        except requests.exceptions.HTTPError as errh:
+            print("An Http Error occurred:" + repr(errh))
+            return 'HTTPError'
+        except requests.exceptions.ConnectionError:
+            return 'ConnectionError'
+        except requests.exceptions.Timeout:
+            return 'Timeout'
+        except requests.exceptions.RequestException:
+            return 'RequestException'
+        except ValueError: # body is not json
+            return 'JSONDecodeError'
+        return {
+            endpoint_url: json.dumps(split).encode('utf-8')
+            for endpoint_url, split in split_batch_response(
+                parsed, self.coalesce_results_path, 
+                self.coalesce_id_key).items()}
+
+    # Request a non-paged response unless it is unchanged since the last run 
+    # (see the response cache). Returns the response content (bytes), 
+    # 'Unchanged', or, as any other string, the error.
+    @instrumented
+    def get_unless_unchanged(self, additional_url_dict = {}):
+        self.load_response_cache()
+        response = self.requests_get(additional_url_dict, conditional = True)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        if self.is_unchanged(
+                response.status_code, response.headers, response.content):
+            self.save_response_cache()
+            return 'Unchanged'
+        return response.content
+
+    # Request a single page of a paged endpoint and write it to blob storage.
+    @instrumented
+    def get_and_write_page(self, page, headers = {}):
+        additional_url_dict = dict(self.additional_url_dict)
+        additional_url_dict['page'] = str(page)
+        if self.raw_passthrough:
+            streamed = self.requests_get(
+                additional_url_dict, headers, self.stream_to_blob(
+                    'application/json', self.file_name(page)))
+            if isinstance(streamed, str): # returned string indicates error
+                return streamed
+            return 'Success'
+        response = self.requests_get(additional_url_dict, headers)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        self.write_json_page(response.content, page)
+        return 'Success'
+
+    # Request a single page of a paged endpoint. Returns the response content 
+    # or, as a string, the error.
+    @instrumented
+    def get_page_content(self, page, headers = {}):
+        additional_url_dict = dict(self.additional_url_dict)
+        additional_url_dict['page'] = str(page)
+        response = self.requests_get(additional_url_dict, headers)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        return response.content
+
+    # Most pages in flight or waiting to be written in page order.
+    def page_window(self):
+        return PAGE_WINDOW_PER_WORKER * self.page_workers
+
+    # Run function over pages on page_workers threads and yield (page, result) 
+    # in page order, at most page_window() pages ahead of the consumer. Pages 
+    # not yet started are cancelled if the consumer stops.
+    def map_pages(self, function, pages):
+        window = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            try:
+                for page in pages:
+                    window.append((page, executor.submit(function, page)))
+                    if len(window) >= self.page_window():
+                        page, future = window.popleft()
+                        yield page, future.result()
+                while window:
+                    page, future = window.popleft()
+                    yield page, future.result()
+            finally:
+                for page, future in window:
+                    future.cancel()
+
+    # Fetch pages concurrently, page_workers at a time, writing each page as 
+    # it arrives. Once a page fails the pages not yet started are skipped. 
+    # Returns the error of the lowest failed page number. Compacted output 
+    # needs the records in page order, so the pages are then written in order 
+    # as they come back from map_pages().
+    @instrumented
+    def get_and_write_pages(self, pages, headers = {}):
+        if self.part_writer is not None:
+            for page, content in self.map_pages(
+                    lambda page: self.get_page_content(page, headers), pages):
+                if isinstance(content, str): # returned string indicates error
+                    return content
+                self.write_json_page(content, page)
+                self.page_written(page)
+            return 'Success'
+
+        failed = threading.Event()
+
+        def get_and_write(page):
+            if failed.is_set():
+                return None
+            success_response = self.get_and_write_page(page, headers)
+            if success_response != 'Success':
+                failed.set()
+            return success_response
+
+        # Results come back in page order, so the checkpoint advances over 
+        # the pages written without a gap.
+        failed_response = None
+        in_order = True
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            for page, success_response in zip(
+                    pages, executor.map(get_and_write, pages)):
+                if success_response == 'Success':
+                    if in_order:
+                        self.page_written(page)
+                    continue
+                in_order = False
+                if success_response is not None and failed_response is None:
+                    failed_response = success_response
+        return failed_response or 'Success'
+
     # Process paged endpoints with token authentication and json response.
-    @debug_log
+    @instrumented
     def json_token_paged_count(self):
-        access_token_response = self.requests_post()
-        headers = {'Authorization': 'Bearer ' + access_token_response}
+        access_token_response = self.get_access_token()
+        if isinstance(access_token_response, str): # string indicates error
+            return access_token_response
+        headers = {'Authorization': 'Bearer ' + access_token_response[1]}
         first_page_number = self.first_page_number
         response = self.requests_get(self.additional_url_dict, headers)
         if isinstance(response, str): # returned string indicates error
             return response
         else:
             num_pages = recursive_lookup(
-                self.total_pages_key_name, response.json())
-            additional_url_dict = self.additional_url_dict
-            for page in range(int(first_page_number), num_pages):
-                additional_url_dict['page'] = str(page)
-                response = self.requests_get(additional_url_dict, headers)
-                if isinstance(response, str):
-                    return response            
-                else:
-                    body = json.dumps(response.json())
-                    blob_write(
-                        'application/json', self.full_folder_name_value, 
-                        self.endpoint_name + '-' + self.date_string + '-page-' 
-                        + str(page).rjust(3, '0') + '.json', body)
-                    success_response = 'Success'
+                self.total_pages_key_name, parse_json(response.content))
+            # A resumed load continues after the pages already written.
+            start_page = max(
+                int(first_page_number), 
+                self.resume_checkpoint().get('page', 0))
+            success_response = self.get_and_write_pages(
+                range(start_page, num_pages), headers)
             return success_response
 
     # Process paged endpoints with username/password authentication and 
     # json response.
-    @debug_log
+    @instrumented
     def json_user_pass_paged_count(self):
         self.additional_url_dict['page'] = self.first_page_number
         response = self.requests_get(
@@ -263,123 +1158,174 @@ class ApiCall:
         if isinstance(response, str): # returned string indicates error
             return response
         else:
-            response = response.json() 
-            num_pages = int(response[self.total_pages_key_name])
+            # The first page is always parsed to read the page count.
+            parsed = parse_json(response.content)
+            num_pages = int(parsed[self.total_pages_key_name])
             page = self.first_page_number
-            body = json.dumps(response)
-            blob_write(
-                'application/json', self.full_folder_name_value, 
-                self.endpoint_name + '-' + self.date_string + '-page-' 
-                + str(page).rjust(3, '0') + '.json', body)
-            for page in range(int(self.first_page_number), num_pages):
-                self.additional_url_dict['page'] = str(page)
-                response = self.requests_get(
-                    additional_url_dict = self.additional_url_dict)
-                if isinstance(response, str):
-                    return response            
-                else:
-                    body = json.dumps(response.json())                
-                    blob_write(
-                        'application/json', self.full_folder_name_value, 
-                        self.endpoint_name + '-' + self.date_string + '-page-' 
-                        + str(page).rjust(3, '0') + '.json', body)
-                    success_response = 'Success'
+            # A resumed load continues after the pages already written.
+            start_page = self.resume_checkpoint().get('page', 0)
+            if start_page <= int(page):
+                self.write_json_page(response.content, page, parsed)
+                self.page_written(int(page))
+                start_page = int(page) + 1
+            # The first page is already written, continue with the next one.
+            success_response = self.get_and_write_pages(
+                range(start_page, num_pages))
             return success_response  
 
     # Process non-paged endpoints with username/password authentication and 
     # json response.
-    @debug_log
+    @instrumented
     def json_user_pass_not_paged(self):
-        response = self.requests_get(additional_url_dict = self.additional_url_dict)
+        if self.request_batch is not None:
+            content = self.request_batch.content_for(self)
+            if isinstance(content, str): # returned string indicates error
+                return content
+            self.write_json_page(content)
+            return 'Success'
+        if self.response_cache:
+            content = self.get_unless_unchanged(self.additional_url_dict)
+            if isinstance(content, str): # error, or 'Unchanged'
+                return content
+            self.write_json_page(content)
+            self.save_response_cache()
+            return 'Success'
+        if self.raw_passthrough:
+            streamed = self.requests_get(
+                additional_url_dict = self.additional_url_dict, 
+                consumer = self.stream_to_blob(
+                    'application/json', self.file_name()))
+            if isinstance(streamed, str): # returned string indicates error
+                return streamed
+            return 'Success'
+        response = self.requests_get(
+            additional_url_dict = self.additional_url_dict)
         if isinstance(response, str): # returned string indicates error
             return response
-        else:
-            response = response.json() 
-            body = json.dumps(response)
-            blob_write(
-                'application/json', self.full_folder_name_value, 
-                self.endpoint_name + '-' + self.date_string 
-                + '.json', body)
-            success_response = 'Success'
-        return success_response
+        self.write_json_page(response.content)
+        return 'Success'
 
     # Process non-paged endpoints with api key authentication and json response.
-    @debug_log
+    @instrumented
     def json_api_key_not_paged(self):
         self.additional_url_dict['registrationkey'] = self.password
-        response = self.requests_get(additional_url_dict = self.additional_url_dict)
-        if isinstance(response, str): # returned string indicates error
-            return response
-        else:
-            response = response.json() 
-            body = json.dumps(response)
-            blob_write(
-                'application/json', self.full_folder_name_value, 
-                self.endpoint_name + '-' + self.date_string 
-                + '.json', body)
-            success_response = 'Success'
-        return success_response  
+        return self.json_user_pass_not_paged()
 
-    # Process paged endpoints with username/password authentication with 
-    # a "next" url returned, and json response.
-    @debug_log
-    def json_user_pass_paged_next(self):
-        next_page_exists = True
-        page = 1
-        response = self.requests_get(additional_url_dict = self.additional_url_dict)
+    # Request one page of a "next" link paged endpoint and write it to blob 
+    # storage. Returns ('Success', next link or None); a returned string 
+    # indicates an error.
+    @instrumented
+    def get_and_write_next_page(self, page):
+        if self.raw_passthrough:
+            return self.requests_get(
+                additional_url_dict = self.additional_url_dict, 
+                consumer = self.stream_to_blob(
+                    'application/json', self.file_name(page), 
+                    find_next_link = True))
+        response = self.requests_get(
+            additional_url_dict = self.additional_url_dict)
         if isinstance(response, str): # returned string indicates error
             return response
-        else:
-            response = response.json()
-            try:
-                next_page = response['d']['__next']
-            except KeyError:
-                next_page_exists = False
-            body = json.dumps(response)
-            blob_write(
-                'application/json', self.full_folder_name_value, self.endpoint_name 
-                + '-' + self.date_string + '-page-' + str(page).rjust(3, '0') 
-                + '.json', body)
-            while next_page_exists == True:
-                page += 1
+        parsed = self.write_json_page(response.content, page)
+        return 'Success', self.next_page_url(response.content, parsed)
+
+    # Fetch the pages of a "next" link paged endpoint, starting with page at 
+    # the url next_page, while a background thread writes the pages already 
+    # fetched in order. The upload queue holds up to prefetch_pages pages; 
+    # the fetcher waits while it is full. Returns 'Success' or, as a string, 
+    # the request error; write errors are raised.
+    @instrumented
+    def get_and_write_next_pages(self, page, next_page):
+        uploads = queue.Queue(maxsize = self.prefetch_pages)
+        upload_errors = []
+
+        def upload():
+            while True:
+                item = uploads.get()
+                if item is None:
+                    return
+                if upload_errors: # drain the queue after a failed write
+                    continue
+                content, page, parsed, next_page = item
+                try:
+                    self.write_json_page(content, page, parsed)
+                    self.page_written(page, next_page = next_page)
+                except Exception as err:
+                    upload_errors.append(err)
+
+        uploader = threading.Thread(target = upload, daemon = True)
+        uploader.start()
+        success_response = 'Success'
+        try:
+            while next_page is not None and not upload_errors:
                 self.full_url = next_page
                 response = self.requests_get(
                     additional_url_dict = self.additional_url_dict)
-                if isinstance(response, str):
-                    return response
-                else:
-                    response = response.json()
-                    body = json.dumps(response)
-                    blob_write(
-                        'application/json', self.full_folder_name_value, 
-                        self.endpoint_name + '-' + self.date_string + '-page-' 
-                        + str(page).rjust(3, '0') + '.json', body)
-                    success_response = 'Success'
-                    try:
-                        next_page = response['d']['__next']
-                    except KeyError:
-                        next_page_exists = False   
-            return success_response
+                if isinstance(response, str): # string indicates error
+                    success_response = response
+                    break
+                content = response.content
+                parsed = None if self.raw_passthrough \
+                    else parse_json(content)
+                next_page = self.next_page_url(content, parsed)
+                uploads.put((content, page, parsed, next_page))
+                page += 1
+        finally:
+            uploads.put(None)
+            uploader.join()
+        if upload_errors:
+            raise upload_errors[0]
+        return success_response
+
+    # Process paged endpoints with username/password authentication with 
+    # a "next" url returned, and json response.
+    @instrumented
+    def json_user_pass_paged_next(self):
+        # A resumed load continues with the page after the last one written.
+        state = self.resume_checkpoint()
+        page = state.get('page', 1)
+        next_page = state.get('next_page', self.full_url)
+        if self.prefetch_pages > 0:
+            return self.get_and_write_next_pages(page, next_page)
+        success_response = 'Success'
+        while next_page is not None:
+            self.full_url = next_page
+            written = self.get_and_write_next_page(page)
+            if isinstance(written, str): # returned string indicates error
+                return written
+            success_response, next_page = written
+            self.page_written(page, next_page = next_page)
+            page += 1
+        return success_response
         
     # Process non-paged endpoints with username/password authentication and 
-    # xml response. 
-    # TODO: refactor to avoid writing response locally before to blob
-    # I tried a number of methods uncessessfully to write response directly to 
-    # blob storage.
-    @debug_log
+    # xml response. The response is streamed to blob storage unchanged; it 
+    # is no longer parsed and written to a local file first. With ndjson or 
+    # parquet output the records of the parsed response are written instead.
+    @instrumented
     def xml_user_pass_not_paged(self):
+        if self.response_cache:
+            content = self.get_unless_unchanged()
+            if isinstance(content, str): # error, or 'Unchanged'
+                return content
+            if self.part_writer is not None:
+                self.write_xml_records(content)
+            else:
+                self.counters.add('pages')
+                self.counters.add('bytes', len(content))
+                self.write_blob(
+                    'application/xml', self.file_name(extension = '.xml'), 
+                    content)
+            self.save_response_cache()
+            return 'Success'
+        if self.part_writer is None:
+            streamed = self.requests_get(consumer = self.stream_to_blob(
+                'application/xml', self.file_name(extension = '.xml')))
+            if isinstance(streamed, str): # returned string indicates error
+                return streamed
+            return 'Success'
         response = self.requests_get()
         if isinstance(response, str): # returned string indicates error
             return response
-        else:
-            tree = ET.ElementTree(ET.fromstring(response.content))
-            tree.write('files/' + self.endpoint_name + '-' + self.date_string + '.xml')
-            with open(
-                'files/' + self.endpoint_name + '-' 
-                + self.date_string + '.xml', 'rb') as body:
-                blob_write(
-                    'application/xml', self.full_folder_name_value, 
-                    self.endpoint_name + '-' + self.date_string 
-                    + '.xml', body)
-                success_response = 'Success'
-        return success_response
\ No newline at end of file
+        self.write_xml_records(response.content)
+        return 'Success'
@@ -0,0 +1,687 @@
+"""Request APIs (asyncio)
+
+This script is the asyncio counterpart of request_api.py. AsyncApiCall
+supports the same api_type and auth_type configurations as ApiCall, but uses
+an aiohttp client and async blob uploads, so a single process can keep many
+requests and uploads in flight without a thread per request.
+
+Current configurations include:
+
+  * json_token_paged_count
+  * json_user_pass_paged_next
+  * json_user_pass_paged_count
+  * json_user_pass_not_paged
+  * json_api_key_not_paged
+  * xml_user_pass_not_paged
+
+The config file row is read by ApiCall.configure(), so both engines accept
+the same config files. Unlike ApiCall, the api is not called when the object
+is created:
+
+    step = AsyncApiCall(aip_config_row, full_folder_name, access_token,
+        password)
+    success_response = await step.run()
+
+Python Module Requirements:
+
+ * asyncio
+ * aiohttp
+ * collections
+ * json
+ * urllib.parse
+
+Custom Module Requirements:
+
+ * request_api.py
+ * rate_limits.py
+ * blob_functions.py
+ * output_writers.py
+ * instrumentation.py
+"""
+
+import asyncio
+import collections # window of in-flight pages
+import json
+from urllib.parse import urlparse
+
+import aiohttp
+
+from request_api import ApiCall, NextLinkScanner, recursive_lookup, \
+    split_batch_response, SESSION_POOL_SIZE, REQUEST_TIMEOUT, \
+    STREAM_CHUNK_SIZE, cached_access_token, store_access_token, \
+    invalidate_access_token, parse_json, UNAUTHORIZED
+from rate_limits import is_throttled
+from instrumentation import instrumented, span, StepCounters
+from blob_functions import blob_write_async, blob_write_stream_async
+from output_writers import extract_records
+
+# Max open connections for the shared aiohttp session, overall and per host.
+CONNECTION_LIMIT = 200
+CONNECTION_LIMIT_PER_HOST = SESSION_POOL_SIZE
+
+client_session = None
+async_access_token_locks = {} # token cache key: asyncio.Lock
+
+# Get (or create) the aiohttp session shared by every AsyncApiCall running
+# on the event loop.
+def get_client_session():
+    global client_session
+    if client_session is None or client_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT, limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            ssl=False)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+        client_session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout)
+    return client_session
+
+# Close the shared aiohttp session. Call before the event loop ends.
+async def close_client_session():
+    global client_session
+    if client_session is not None and not client_session.closed:
+        await client_session.close()
+    client_session = None
+    async_access_token_locks.clear()
+
+# Lock for a token cache key, so only one task on the event loop posts for a
+# token. Access tokens themselves are cached by request_api.
+def get_async_access_token_lock(key):
+    return async_access_token_locks.setdefault(key, asyncio.Lock())
+
+# Consumer for send_with_retries() that returns the parsed json body. The 
+# body is parsed in a worker thread to keep the event loop free.
+async def read_json(response):
+    response.raise_for_status()
+    return await asyncio.to_thread(parse_json, await response.read())
+
+class AsyncApiCall(ApiCall):
+    def __init__(
+            self, aip_config_row, full_folder_name, access_token, password,
+            date_last_run = None, request_batch = None, checkpoint = None):
+        self.counters = StepCounters() # pages, records, bytes, retries
+        self.configure(
+            aip_config_row, full_folder_name, access_token, password,
+            date_last_run, request_batch, checkpoint)
+        self.success_response = None
+
+    # Call the api and load the response(s) to blob storage.
+    async def run(self):
+        success_response = await self.api_by_response_type()
+        self.success_response = await asyncio.to_thread(
+            self.close_output, success_response)
+        return self.success_response
+
+    # Determines which function to use based on criteria defined in the config
+    # file.
+    async def api_by_response_type(self):
+        if self.api_type == 'json_token_paged_count':
+            success_response = await self.json_token_paged_count()
+        elif self.api_type == 'json_user_pass_paged_next':
+            success_response = await self.json_user_pass_paged_next()
+        elif self.api_type == 'json_user_pass_paged_count':
+            success_response = await self.json_user_pass_paged_count()
+        elif self.api_type == 'json_user_pass_not_paged':
+            success_response = await self.json_user_pass_not_paged()
+        elif self.api_type == 'json_api_key_not_paged':
+            success_response = await self.json_api_key_not_paged()
+        elif self.api_type == 'xml_user_pass_not_paged':
+            success_response = await self.xml_user_pass_not_paged()
+        else:
+            print('api type is unknown')
+            success_response = 'UnknownApiType'
+        return success_response
+
+    # Post to get api access token.
+    async def requests_post(self):
+        try:
+            data = json.loads(self.access_token)
+            response = await self.send_with_retries(
+                'POST', self.token_url, read_json, data=data,
+                allow_redirects=False)
+            return response['access_token'], response.get('expires_in')
+        except aiohttp.ClientResponseError:
+            success_response = 'HTTPError'
+        except aiohttp.ClientConnectionError:
+            success_response = 'ConnectionError'
+        except asyncio.TimeoutError:
+            success_response = 'Timeout'
+        except aiohttp.ClientError:
+            success_response = 'RequestException'
+        return success_response
+
+    # Async version of ApiCall.get_access_token(), sharing the same token
+    # cache. Tasks waiting on the same token share a single post.
+    async def get_access_token(self, expired_token = None):
+        key = self.token_key()
+        if expired_token is not None:
+            invalidate_access_token(key, expired_token)
+        token = cached_access_token(key)
+        if token is None:
+            async with get_async_access_token_lock(key):
+                token = cached_access_token(key)
+                if token is None:
+                    with span('token.request', host=urlparse(
+                            self.token_url).netloc) as token_request:
+                        response = await self.requests_post()
+                    if isinstance(response, str): # string indicates error
+                        token_request.set('status', response)
+                        return response
+                    token, expires_in = response
+                    store_access_token(key, token, expires_in)
+        return 'Success', token
+
+    # Async version of ApiCall.refresh_authorization().
+    async def refresh_authorization(self, headers):
+        authorization = headers.get('Authorization', '')
+        if self.auth_type != 'token' or not authorization.startswith('Bearer '):
+            return False
+        response = await self.get_access_token(
+            expired_token = authorization[len('Bearer '):])
+        if isinstance(response, str): # returned string indicates error
+            return False
+        headers['Authorization'] = 'Bearer ' + response[1]
+        return True
+
+    # Async version of ApiCall.send_with_retries(). The response is read by
+    # the consumer coroutine function while the request holds its slot, and
+    # the consumer's result is returned. A body that breaks off while the
+    # consumer reads it (ClientPayloadError) is requested again too.
+    async def send_with_retries(self, method, url, consumer, **request_kwargs):
+        limiter = self.host_limiter(url)
+        attempt = 0
+        while True:
+            await limiter.acquire_async()
+            status = None
+            pause = None
+            try:
+                with span(
+                        'http.request', host=urlparse(url).netloc,
+                        attempt=attempt) as request_span:
+                    async with get_client_session().request(
+                            method, url, **request_kwargs) as response:
+                        status = response.status
+                        request_span.set('status', status)
+                        if not self.retry_policy.should_retry(attempt, status):
+                            return await consumer(response)
+                        delay = self.retry_policy.delay(
+                            attempt, response.headers)
+                        pause = self.retry_policy.retry_after(
+                            response.headers)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError):
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+            finally:
+                limiter.release(is_throttled(status), pause)
+            self.counters.add('retries')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # Get api response body (bytes) given different authentication types and
+    # page types. A consumer coroutine function, when given, reads the open
+    # response instead and its result is returned. A returned string indicates
+    # an error.
+    @instrumented
+    async def requests_get(
+            self, additional_url_dict = {}, headers = {}, consumer = None,
+            conditional = False):
+        try:
+            request_arguments = self.request_arguments(
+                additional_url_dict, headers)
+            if request_arguments is None:
+                print('auth type is unknown')
+                return 'Success'
+            url, request_kwargs = request_arguments
+            if conditional:
+                request_kwargs['headers'] = {
+                    **request_kwargs.get('headers', {}),
+                    **self.conditional_headers(
+                        url, request_kwargs.get('params'))}
+            # aiohttp only accepts str query values and its own auth type.
+            if 'params' in request_kwargs:
+                request_kwargs['params'] = {
+                    key: str(value)
+                    for key, value in request_kwargs['params'].items()}
+            if 'auth' in request_kwargs:
+                request_kwargs['auth'] = aiohttp.BasicAuth(
+                    *request_kwargs['auth'])
+            # Expired or revoked token: refresh it and retry once.
+            for attempt in range(2):
+
+                async def read(response):
+                    if response.status == 401 and attempt == 0:
+                        return UNAUTHORIZED
+                    response.raise_for_status()
+                    if consumer is None:
+                        return await response.read()
+                    return await consumer(response)
+
+                result = await self.send_with_retries(
+                    'GET', url, read, **request_kwargs)
+                if result is not UNAUTHORIZED:
+                    return result
+                if not await self.refresh_authorization(headers):
+                    print('An Http Error occurred: 401 Unauthorized')
+                    return 'HTTPError'
+                if 'headers' in request_kwargs:
+                    request_kwargs['headers'].update(headers)
+        except aiohttp.ClientResponseError as errh:
+            print("An Http Error occurred:" + repr(errh))
+            success_response = 'HTTPError'
+        except aiohttp.ClientConnectionError:
+            success_response = 'ConnectionError'
+        except asyncio.TimeoutError:
+            success_response = 'Timeout'
+        except aiohttp.ClientError:
+            success_response = 'RequestException'
+        return success_response
+
+    # Write a response body held in memory to the endpoint's folder.
+    async def write_blob_async(self, content_type, file_name, body):
+        await blob_write_async(
+            content_type, self.full_folder_name_value, file_name, body,
+            self.compression)
+
+    # Async version of ApiCall.write_json_page(). Parsing, serializing and 
+    # part writer calls take the CPU or block, so they run in a worker thread.
+    async def write_json_page_async(self, content, page = None, parsed = None):
+        if parsed is None and not self.raw_passthrough:
+            parsed = await asyncio.to_thread(parse_json, content)
+        self.counters.add('pages')
+        self.counters.add('bytes', len(content))
+        if self.part_writer is not None:
+            await asyncio.to_thread(self.write_page_records, parsed)
+        elif self.raw_passthrough:
+            await self.write_blob_async(
+                'application/json', self.file_name(page), content)
+        else:
+            await self.write_blob_async(
+                'application/json', self.file_name(page), 
+                await asyncio.to_thread(self.page_body, parsed))
+        return parsed
+
+    # Count the records of a parsed page and serialize it for its blob.
+    def page_body(self, parsed):
+        self.count_records(parsed)
+        return json.dumps(parsed)
+
+    # Hand the records of a parsed page to the part writer.
+    def write_page_records(self, parsed):
+        records = extract_records(
+            parsed, self.records_path, self.part_writer.include_parent_fields)
+        self.counters.add('records', len(records))
+        self.part_writer.write_records(records)
+
+    # Consumer for requests_get() that streams the response straight to blob
+    # storage in STREAM_CHUNK_SIZE chunks. With find_next_link the "__next"
+    # link is picked up from the chunks on the way through. The consumer
+    # returns ('Success', next link or None).
+    def stream_to_blob(self, content_type, file_name, find_next_link = False):
+        async def consumer(response):
+            scanner = NextLinkScanner()
+            self.counters.add('pages')
+
+            async def chunks():
+                async for chunk in response.content.iter_chunked(
+                        STREAM_CHUNK_SIZE):
+                    if find_next_link:
+                        scanner.scan(chunk)
+                    self.counters.add('bytes', len(chunk))
+                    yield chunk
+
+            await blob_write_stream_async(
+                content_type, self.full_folder_name_value, file_name,
+                chunks(), self.compression)
+            return 'Success', scanner.next_page
+        return consumer
+
+    # Request a single page of a paged endpoint and write it to blob storage.
+    async def get_and_write_page(self, page, headers = {}):
+        additional_url_dict = dict(self.additional_url_dict)
+        additional_url_dict['page'] = str(page)
+        if self.raw_passthrough:
+            response = await self.requests_get(
+                additional_url_dict, headers, self.stream_to_blob(
+                    'application/json', self.file_name(page)))
+            if isinstance(response, str): # returned string indicates error
+                return response
+            return 'Success'
+        response = await self.requests_get(additional_url_dict, headers)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        await self.write_json_page_async(response, page)
+        return 'Success'
+
+    # Request a single page of a paged endpoint. Returns the response content
+    # or, as a string, the error.
+    async def get_page_content(self, page, headers = {}):
+        additional_url_dict = dict(self.additional_url_dict)
+        additional_url_dict['page'] = str(page)
+        return await self.requests_get(additional_url_dict, headers)
+
+    # Fetch pages concurrently, page_workers at a time, writing each page as
+    # it arrives. Once a page fails the pages not yet started are skipped.
+    # Returns the error of the lowest failed page number.
+    async def get_and_write_pages(self, pages, headers = {}):
+        semaphore = asyncio.Semaphore(self.page_workers)
+        # Compacted output needs the records in page order: keep a window of
+        # page_window() pages, page_workers of them requested at a time, and
+        # write them in order.
+        if self.part_writer is not None:
+            window = collections.deque()
+
+            async def get_page_content(page):
+                async with semaphore:
+                    return await self.get_page_content(page, headers)
+
+            async def write_oldest_page():
+                page, task = window.popleft()
+                content = await task
+                if isinstance(content, str): # returned string indicates error
+                    return content
+                await self.write_json_page_async(content, page)
+                await self.page_written_async(page)
+                return 'Success'
+
+            try:
+                for page in pages:
+                    window.append((page, asyncio.ensure_future(
+                        get_page_content(page))))
+                    if len(window) >= self.page_window():
+                        success_response = await write_oldest_page()
+                        if success_response != 'Success':
+                            return success_response
+                while window:
+                    success_response = await write_oldest_page()
+                    if success_response != 'Success':
+                        return success_response
+            finally:
+                for page, task in window:
+                    task.cancel()
+            return 'Success'
+
+        failed = asyncio.Event()
+        # The checkpoint advances over the pages written without a gap.
+        pages = list(pages)
+        written = set()
+        next_in_order = [0] # index in pages of the first page not written
+
+        async def get_and_write(page):
+            async with semaphore:
+                if failed.is_set():
+                    return None
+                success_response = await self.get_and_write_page(
+                    page, headers)
+                if success_response != 'Success':
+                    failed.set()
+                    return success_response
+                written.add(page)
+                while next_in_order[0] < len(pages) \
+                        and pages[next_in_order[0]] in written:
+                    page_in_order = pages[next_in_order[0]]
+                    next_in_order[0] += 1
+                    await self.page_written_async(page_in_order)
+                return success_response
+
+        success_responses = await asyncio.gather(
+            *(get_and_write(page) for page in pages))
+        for success_response in success_responses:
+            if success_response is not None and success_response != 'Success':
+                return success_response
+        return 'Success'
+
+    # Process paged endpoints with token authentication and json response.
+    async def json_token_paged_count(self):
+        access_token_response = await self.get_access_token()
+        if isinstance(access_token_response, str): # string indicates error
+            return access_token_response
+        headers = {'Authorization': 'Bearer ' + access_token_response[1]}
+        response = await self.requests_get(self.additional_url_dict, headers)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        num_pages = recursive_lookup(
+            self.total_pages_key_name, 
+            await asyncio.to_thread(parse_json, response))
+        # A resumed load continues after the pages already written.
+        state = await asyncio.to_thread(self.resume_checkpoint)
+        start_page = max(int(self.first_page_number), state.get('page', 0))
+        return await self.get_and_write_pages(
+            range(start_page, num_pages), headers)
+
+    # Process paged endpoints with username/password authentication and
+    # json response.
+    async def json_user_pass_paged_count(self):
+        self.additional_url_dict['page'] = self.first_page_number
+        response = await self.requests_get(
+            additional_url_dict = self.additional_url_dict)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        # The first page is always parsed to read the page count.
+        parsed = await asyncio.to_thread(parse_json, response)
+        num_pages = int(parsed[self.total_pages_key_name])
+        # A resumed load continues after the pages already written.
+        state = await asyncio.to_thread(self.resume_checkpoint)
+        start_page = state.get('page', 0)
+        if start_page <= int(self.first_page_number):
+            await self.write_json_page_async(
+                response, self.first_page_number, parsed)
+            await self.page_written_async(int(self.first_page_number))
+            start_page = int(self.first_page_number) + 1
+        # The first page is already written, continue with the next one.
+        return await self.get_and_write_pages(range(start_page, num_pages))
+
+    # Process non-paged endpoints with username/password authentication and
+    # json response.
+    async def json_user_pass_not_paged(self):
+        if self.request_batch is not None:
+            content = await self.batch_content()
+            if isinstance(content, str): # returned string indicates error
+                return content
+            await self.write_json_page_async(content)
+            return 'Success'
+        if self.response_cache:
+            content = await self.get_unless_unchanged(self.additional_url_dict)
+            if isinstance(content, str): # error, or 'Unchanged'
+                return content
+            await self.write_json_page_async(content)
+            await asyncio.to_thread(self.save_response_cache)
+            return 'Success'
+        if self.raw_passthrough:
+            response = await self.requests_get(
+                self.additional_url_dict, consumer = self.stream_to_blob(
+                    'application/json', self.file_name()))
+            if isinstance(response, str): # returned string indicates error
+                return response
+            return 'Success'
+        response = await self.requests_get(
+            additional_url_dict = self.additional_url_dict)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        await self.write_json_page_async(response)
+        return 'Success'
+
+    # Async version of ApiCall.page_written(); the checkpoint is saved in a
+    # worker thread.
+    async def page_written_async(self, page, **state):
+        if self.checkpoint is not None \
+                and self.checkpoint.advance(page + 1, **state) \
+                and self.part_writer is None:
+            await asyncio.to_thread(self.checkpoint.save)
+
+    # Async version of ApiCall.request_batch_responses().
+    async def request_batch_responses(self, endpoint_urls):
+        request_arguments = self.request_arguments()
+        if request_arguments is None:
+            return 'UnknownAuthType'
+        url, request_kwargs = request_arguments
+        body = dict(self.additional_url_dict)
+        body[self.coalesce_id_param] = list(endpoint_urls)
+        auth = request_kwargs.get('auth')
+        try:
+            parsed = await self.send_with_retries(
+                'POST', self.base_url, read_json, json=body,
+                auth=aiohttp.BasicAuth(*auth) if auth else None)
+        except aiohttp.ClientResponseError as errh:
+            print("An Http Error occurred:" + repr(errh))
+            return 'HTTPError'
+        except aiohttp.ClientConnectionError:
+            return 'ConnectionError'
+        except asyncio.TimeoutError:
+            return 'Timeout'
+        except aiohttp.ClientError:
+            return 'RequestException'
+        except ValueError: # body is not json
+            return 'JSONDecodeError'
+        return await asyncio.to_thread(self.split_batch_contents, parsed)
+
+    # Response content (bytes) of each id of a parsed batched response.
+    def split_batch_contents(self, parsed):
+        return {
+            endpoint_url: json.dumps(split).encode('utf-8')
+            for endpoint_url, split in split_batch_response(
+                parsed, self.coalesce_results_path,
+                self.coalesce_id_key).items()}
+
+    # Response content of this row from its RequestBatch. The first task to
+    # need it sends the batched request, the other rows' tasks wait for it.
+    async def batch_content(self):
+        request_batch = self.request_batch
+        if request_batch.async_lock is None:
+            request_batch.async_lock = asyncio.Lock()
+        async with request_batch.async_lock:
+            if request_batch.responses is None:
+                request_batch.responses = await self.request_batch_responses(
+                    request_batch.endpoint_urls)
+        return request_batch.take(self.endpoint_url)
+
+    # Async version of ApiCall.get_unless_unchanged().
+    async def get_unless_unchanged(self, additional_url_dict = {}):
+        await asyncio.to_thread(self.load_response_cache)
+
+        async def read(response):
+            return response.status, response.headers, await response.read()
+
+        response = await self.requests_get(
+            additional_url_dict, consumer = read, conditional = True)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        content = response[2]
+        if self.is_unchanged(*response):
+            await asyncio.to_thread(self.save_response_cache)
+            return 'Unchanged'
+        return content
+
+    # Process non-paged endpoints with api key authentication and json response.
+    async def json_api_key_not_paged(self):
+        self.additional_url_dict['registrationkey'] = self.password
+        return await self.json_user_pass_not_paged()
+
+    # Request one page of a "next" link paged endpoint and write it to blob
+    # storage. Returns ('Success', next link or None); a returned string
+    # indicates an error.
+    async def get_and_write_next_page(self, page):
+        if self.raw_passthrough:
+            return await self.requests_get(
+                self.additional_url_dict, consumer = self.stream_to_blob(
+                    'application/json', self.file_name(page),
+                    find_next_link = True))
+        response = await self.requests_get(
+            additional_url_dict = self.additional_url_dict)
+        if isinstance(response, str): # returned string indicates error
+            return response
+        parsed = await self.write_json_page_async(response, page)
+        return 'Success', self.next_page_url(response, parsed)
+
+    # Async version of ApiCall.get_and_write_next_pages(): an upload task
+    # writes the fetched pages in order while the next ones are requested.
+    async def get_and_write_next_pages(self, page, next_page):
+        uploads = asyncio.Queue(maxsize = self.prefetch_pages)
+        upload_errors = []
+
+        async def upload():
+            while True:
+                item = await uploads.get()
+                if item is None:
+                    return
+                if upload_errors: # drain the queue after a failed write
+                    continue
+                content, page, parsed, next_page = item
+                try:
+                    await self.write_json_page_async(content, page, parsed)
+                    await self.page_written_async(page, next_page = next_page)
+                except Exception as err:
+                    upload_errors.append(err)
+
+        uploader = asyncio.create_task(upload())
+        success_response = 'Success'
+        try:
+            while next_page is not None and not upload_errors:
+                self.full_url = next_page
+                content = await self.requests_get(
+                    additional_url_dict = self.additional_url_dict)
+                if isinstance(content, str): # string indicates error
+                    success_response = content
+                    break
+                parsed = None if self.raw_passthrough \
+                    else await asyncio.to_thread(parse_json, content)
+                next_page = self.next_page_url(content, parsed)
+                await uploads.put((content, page, parsed, next_page))
+                page += 1
+        finally:
+            await uploads.put(None)
+            await uploader
+        if upload_errors:
+            raise upload_errors[0]
+        return success_response
+
+    # Process paged endpoints with username/password authentication with
+    # a "next" url returned, and json response.
+    async def json_user_pass_paged_next(self):
+        # A resumed load continues with the page after the last one written.
+        state = await asyncio.to_thread(self.resume_checkpoint)
+        page = state.get('page', 1)
+        next_page = state.get('next_page', self.full_url)
+        if self.prefetch_pages > 0:
+            return await self.get_and_write_next_pages(page, next_page)
+        success_response = 'Success'
+        while next_page is not None:
+            self.full_url = next_page
+            written = await self.get_and_write_next_page(page)
+            if isinstance(written, str): # returned string indicates error
+                return written
+            success_response, next_page = written
+            await self.page_written_async(page, next_page = next_page)
+            page += 1
+        return success_response
+
+    # Process non-paged endpoints with username/password authentication and
+    # xml response. The response is streamed to blob storage unchanged, or
+    # its records are written with ndjson or parquet output.
+    async def xml_user_pass_not_paged(self):
+        if self.response_cache:
+            content = await self.get_unless_unchanged()
+            if isinstance(content, str): # error, or 'Unchanged'
+                return content
+            if self.part_writer is not None:
+                await asyncio.to_thread(self.write_xml_records, content)
+            else:
+                self.counters.add('pages')
+                self.counters.add('bytes', len(content))
+                await self.write_blob_async(
+                    'application/xml', self.file_name(extension = '.xml'),
+                    content)
+            await asyncio.to_thread(self.save_response_cache)
+            return 'Success'
+        if self.part_writer is not None:
+            response = await self.requests_get()
+            if isinstance(response, str): # returned string indicates error
+                return response
+            await asyncio.to_thread(self.write_xml_records, response)
+            return 'Success'
+        response = await self.requests_get(consumer = self.stream_to_blob(
+            'application/xml', self.file_name(extension = '.xml')))
+        if isinstance(response, str): # returned string indicates error
+            return response
+        return 'Success'
@@ -0,0 +1,252 @@
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+/***********************
+Shards (groups of config rows) of
+a distributed batch, leased by the
+workers loading them.
+
+Status is Pending, Leased or Done.
+A Leased shard whose
+LeaseExpiresDateTime has passed
+(its worker stopped heartbeating)
+can be claimed again. Result is a
+json object of each row's endpoint
+name to its success response; it
+stays null for shards skipped after
+a failure.
+***********************/
+CREATE TABLE [METADATA].[BatchShardLease](
+	[BatchID] [int] NOT NULL,
+	[ShardKey] [varchar](100) NOT NULL,
+	[ShardNumber] [int] NOT NULL,
+	[Status] [varchar](25) NOT NULL,
+	[Owner] [varchar](200) NULL,
+	[LeaseExpiresDateTime] [datetime2] NULL,
+	[Attempts] [int] NOT NULL,
+	[Result] [nvarchar](max) NULL,
+PRIMARY KEY CLUSTERED
+(
+	[BatchID] ASC,
+	[ShardKey] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+GO
+
+/***********************
+The worker that completes a
+distributed batch. The primary key
+lets only one worker in.
+***********************/
+CREATE TABLE [METADATA].[BatchShardFinish](
+	[BatchID] [int] NOT NULL,
+	[Owner] [varchar](200) NOT NULL,
+	[FinishDateTime] [datetime2] NOT NULL,
+PRIMARY KEY CLUSTERED
+(
+	[BatchID] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+GO
+
+
+/***********************
+Add the shards of a batch. @Shards
+is a json array of shard keys in
+the order they should be claimed.
+Shards already added are left as
+they are: every worker registers
+the shards before claiming, so one
+that joins before the batch starter
+registered them cannot finish the
+batch with no shards.
+***********************/
+CREATE procedure [METADATA].[s_BatchShardRegister]
+@BatchID int,
+@Shards nvarchar(max)
+
+as
+begin
+
+set nocount on
+
+insert into metadata.BatchShardLease
+(
+	BatchID,
+	ShardKey,
+	ShardNumber,
+	Status,
+	Owner,
+	LeaseExpiresDateTime,
+	Attempts,
+	Result
+)
+select
+	@BatchID,
+	shards.[value],
+	cast(shards.[key] as int),
+	'Pending',
+	null,
+	null,
+	0,
+	null
+from openjson(@Shards) as shards
+where not exists (
+	select 1 from metadata.BatchShardLease existing with (updlock, holdlock)
+	where existing.BatchID = @BatchID
+	and existing.ShardKey = shards.[value])
+
+end
+GO
+
+
+/***********************
+Lease the next pending shard, or a
+shard whose lease expired, to
+@Owner. Returns ShardKey and
+Attempts, or no row when nothing
+can be claimed. readpast lets
+concurrent workers claim different
+shards without waiting.
+***********************/
+CREATE procedure [METADATA].[s_BatchShardClaim]
+@BatchID int,
+@Owner varchar(200),
+@LeaseSeconds int
+
+as
+begin
+
+set nocount on
+
+;with next_shard as (
+	select top (1) *
+	from metadata.BatchShardLease with (updlock, readpast, rowlock)
+	where
+		BatchID = @BatchID
+		and (
+			Status = 'Pending'
+			or (Status = 'Leased' and LeaseExpiresDateTime < sysutcdatetime())
+		)
+	order by ShardNumber
+)
+update next_shard
+set
+	Status = 'Leased',
+	Owner = @Owner,
+	LeaseExpiresDateTime = dateadd(second, @LeaseSeconds, sysutcdatetime()),
+	Attempts = Attempts + 1
+output
+	inserted.ShardKey,
+	inserted.Attempts
+
+end
+GO
+
+
+/***********************
+Extend every lease @Owner holds on
+the batch
+***********************/
+CREATE procedure [METADATA].[s_BatchShardHeartbeat]
+@BatchID int,
+@Owner varchar(200),
+@LeaseSeconds int
+
+as
+begin
+
+set nocount on
+
+update metadata.BatchShardLease
+set LeaseExpiresDateTime = dateadd(second, @LeaseSeconds, sysutcdatetime())
+where
+	BatchID = @BatchID
+	and Owner = @Owner
+	and Status = 'Leased'
+
+end
+GO
+
+
+/***********************
+Mark a shard leased by @Owner as
+done with its result. With
+@CancelPending = 1 (fail-fast after
+a failed shard) the shards not yet
+claimed are marked done without a
+result. Returns Completed = 0 when
+@Owner no longer holds the lease.
+***********************/
+CREATE procedure [METADATA].[s_BatchShardComplete]
+@BatchID int,
+@ShardKey varchar(100),
+@Owner varchar(200),
+@Result nvarchar(max),
+@CancelPending bit
+
+as
+begin
+
+set nocount on
+
+declare @Completed int
+
+update metadata.BatchShardLease
+set
+	Status = 'Done',
+	LeaseExpiresDateTime = null,
+	Result = @Result
+where
+	BatchID = @BatchID
+	and ShardKey = @ShardKey
+	and Owner = @Owner
+	and Status = 'Leased'
+
+set @Completed = @@rowcount
+
+if @CancelPending = 1
+	update metadata.BatchShardLease
+	set Status = 'Done'
+	where
+		BatchID = @BatchID
+		and Status = 'Pending'
+
+select @Completed as Completed
+
+end
+GO
+
+
+/***********************
+Claim the completion of a batch
+once all its shards are done.
+Returns Finished = 1 to exactly one
+caller.
+***********************/
+CREATE procedure [METADATA].[s_BatchShardFinish]
+@BatchID int,
+@Owner varchar(200)
+
+as
+begin
+
+set nocount on
+
+insert into metadata.BatchShardFinish (BatchID, Owner, FinishDateTime)
+select @BatchID, @Owner, sysutcdatetime()
+where
+	not exists (
+		select 1 from metadata.BatchShardLease
+		where BatchID = @BatchID and Status != 'Done')
+	and not exists (
+		select 1 from metadata.BatchShardFinish with (updlock, holdlock)
+		where BatchID = @BatchID)
+
+select @@rowcount as Finished
+
+end
+GO
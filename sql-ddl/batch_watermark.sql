@@ -0,0 +1,182 @@
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+/***********************
+Latest successful load of each
+target, maintained by
+s_BatchWatermarkUpdate when a batch
+completes with 'Success'.
+
+LastStartDateTime is the step start
+of the latest successful batch.
+PriorStartDateTime is the same for
+the latest successful batch started
+on an earlier day, for lookups that
+do not include today.
+***********************/
+CREATE TABLE [METADATA].[BatchWatermark](
+	[TargetSystem] [varchar](50) NOT NULL,
+	[TargetSchema] [varchar](100) NOT NULL,
+	[TargetObject] [varchar](50) NOT NULL,
+	[LastBatchID] [int] NOT NULL,
+	[LastBatchStartDateTime] [datetime] NOT NULL,
+	[LastStartDateTime] [datetime] NOT NULL,
+	[PriorBatchStartDateTime] [datetime] NULL,
+	[PriorStartDateTime] [datetime] NULL,
+PRIMARY KEY CLUSTERED
+(
+	[TargetSystem] ASC,
+	[TargetSchema] ASC,
+	[TargetObject] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+GO
+
+
+CREATE procedure [METADATA].[s_BatchWatermarkUpdate]
+@BatchID int
+
+as
+begin
+
+set nocount on
+
+merge into metadata.BatchWatermark with (holdlock) as target
+using (
+	select
+		b.TargetSystem,
+		bs.TargetSchema,
+		bs.TargetObject,
+		b.BatchID,
+		b.StartDateTime as BatchStartDateTime,
+		max(bs.StartDateTime) as StartDateTime
+	from
+	metadata.batchlog b
+	inner join metadata.batchsteplog bs
+		on bs.BatchID = b.BatchID
+	where
+		b.BatchID = @BatchID
+		and b.Status = 'Success'
+		and bs.TargetSchema is not null
+		and bs.TargetObject is not null
+	group by
+		b.TargetSystem,
+		bs.TargetSchema,
+		bs.TargetObject,
+		b.BatchID,
+		b.StartDateTime
+) as source
+	on source.TargetSystem = target.TargetSystem
+	and source.TargetSchema = target.TargetSchema
+	and source.TargetObject = target.TargetObject
+when matched and source.BatchStartDateTime >= target.LastBatchStartDateTime then
+	update set
+		-- the latest batch moves to prior once a batch of a later day succeeds
+		target.PriorBatchStartDateTime = iif(
+			convert(date, target.LastBatchStartDateTime) < convert(date, source.BatchStartDateTime),
+			target.LastBatchStartDateTime, target.PriorBatchStartDateTime),
+		target.PriorStartDateTime = iif(
+			convert(date, target.LastBatchStartDateTime) < convert(date, source.BatchStartDateTime),
+			target.LastStartDateTime, target.PriorStartDateTime),
+		target.LastBatchID = source.BatchID,
+		target.LastBatchStartDateTime = source.BatchStartDateTime,
+		target.LastStartDateTime = source.StartDateTime
+when not matched by target then
+	insert
+	(
+		TargetSystem,
+		TargetSchema,
+		TargetObject,
+		LastBatchID,
+		LastBatchStartDateTime,
+		LastStartDateTime,
+		PriorBatchStartDateTime,
+		PriorStartDateTime
+	)
+	values
+	(
+		source.TargetSystem,
+		source.TargetSchema,
+		source.TargetObject,
+		source.BatchID,
+		source.BatchStartDateTime,
+		source.StartDateTime,
+		null,
+		null
+	);
+
+end
+GO
+
+
+/***********************
+Watermarks of many endpoints in one
+call. @Endpoints is a json array:
+
+[{"TargetSchema": "raw/source/x",
+  "TargetObject": "x"}, ...]
+
+Returns TargetSchema, TargetObject
+and the same date as
+f_GetBatchStepStartDateTimeFromLastSuccessfulBatch
+for each endpoint.
+***********************/
+CREATE procedure [METADATA].[s_GetBatchWatermarks]
+@TargetSystem varchar(50),
+@Endpoints nvarchar(max),
+@DoNotIncludeTodayFlag bit
+
+as
+begin
+
+set nocount on
+
+declare @StartDate date
+set @StartDate = iif(@DoNotIncludeTodayFlag = 1, convert(date, getdate()), dateadd(dd, 1, convert(date, getdate())))
+
+select
+	e.TargetSchema,
+	e.TargetObject,
+	isnull(
+		case
+			when w.LastBatchStartDateTime < @StartDate then w.LastStartDateTime
+			when w.PriorBatchStartDateTime < @StartDate then w.PriorStartDateTime
+		end,
+		'01/01/1900') as StartDateTime
+from openjson(@Endpoints) with (
+	TargetSchema varchar(100),
+	TargetObject varchar(50)
+) as e
+left join metadata.BatchWatermark w
+	on w.TargetSystem = @TargetSystem
+	and w.TargetSchema = e.TargetSchema
+	and w.TargetObject = e.TargetObject
+
+end
+GO
+
+
+/***********************
+One-time backfill of
+BatchWatermark from the existing
+log history
+***********************/
+declare @BatchID int
+declare backfill cursor local fast_forward for
+	select BatchID from metadata.BatchLog
+	where Status = 'Success'
+	order by StartDateTime
+
+open backfill
+fetch next from backfill into @BatchID
+while @@fetch_status = 0
+begin
+	exec METADATA.s_BatchWatermarkUpdate @BatchID
+	fetch next from backfill into @BatchID
+end
+close backfill
+deallocate backfill
+GO
@@ -4,34 +4,27 @@ GO
 SET QUOTED_IDENTIFIER ON
 GO
 
-create function [METADATA].[f_GetBatchStepStartDateTimeFromLastSuccessfulBatch](@TargetSystem varchar(50), @TargetSchema varchar(50), @TargetObject varchar(50), @DoNotIncludeTodayFlag bit)
+create function [METADATA].[f_GetBatchStepStartDateTimeFromLastSuccessfulBatch](@TargetSystem varchar(50), @TargetSchema varchar(100), @TargetObject varchar(50), @DoNotIncludeTodayFlag bit)
 returns datetime
 as begin
 
 	declare @StartDate date
 	set @StartDate = iif(@DoNotIncludeTodayFlag = 1, convert(date, getdate()), dateadd(dd, 1, convert(date, getdate())))
+	-- Read from the watermark maintained by s_BatchWatermarkUpdate (see
+	-- batch_watermark.sql) rather than scanning the log history.
 	declare @LatestDateTime datetime =
 	(
 	select
-		a.StartDateTime
+		case
+			when w.LastBatchStartDateTime < @StartDate then w.LastStartDateTime
+			when w.PriorBatchStartDateTime < @StartDate then w.PriorStartDateTime
+		end
 	from
-	(
-		select
-			bs.StartDateTime,
-			row_number()over(order by b.StartDateTime desc) as rnk
-		from
-		metadata.batchlog b
-		inner join metadata.batchsteplog bs
-			on bs.BatchID = b.BatchID
-		where
-			b.Status = 'Success'
-			and b.TargetSystem = @TargetSystem
-			and bs.TargetObject = @TargetObject
-			and bs.TargetSchema like '%' + @TargetSchema + '%'
-			and b.StartDateTime < @StartDate
-	) a 
+	metadata.BatchWatermark w
 	where
-		a.rnk = 1
+		w.TargetSystem = @TargetSystem
+		and w.TargetSchema = @TargetSchema
+		and w.TargetObject = @TargetObject
 	)
 
 	--Return the date
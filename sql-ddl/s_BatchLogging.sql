@@ -77,6 +77,13 @@ begin transaction @TransactionName
 			set @BatchID = isnull(@BatchID, SCOPE_IDENTITY())
 			exec METADATA.s_BatchStepLogging @BatchID, 'Main', @Status
 
+			/***********************
+			Advance the watermarks of
+			the batch's targets
+			***********************/
+			if @Status = 'Success'
+				exec METADATA.s_BatchWatermarkUpdate @BatchID
+
 			/***********************
 			Return new BatchID
 			***********************/
@@ -14,7 +14,9 @@ CREATE procedure [METADATA].[s_BatchStepLogging]
 @TargetUpdateStrategy varchar(50) = null,
 @TargetSchema varchar(100) = null,
 @TargetObject varchar(50) = null,
-@TargetFiles int = null
+@TargetFiles int = null,
+@TargetRows int = null, -- records written, null when not counted
+@EventDateTime datetime = null -- when the step event happened, default now
 
 as
 begin
@@ -47,7 +49,8 @@ begin transaction @TransactionName
 				update set
 					target.Status = @Status,
 					target.TargetFiles = @TargetFiles,
-					target.EndDateTime = dbo.getdate()
+					target.TargetRows = isnull(@TargetRows, target.TargetRows),
+					target.EndDateTime = isnull(@EventDateTime, dbo.getdate())
 			when not matched by target then
 				insert
 				(
@@ -76,9 +79,9 @@ begin transaction @TransactionName
 					@TargetSchema,
 					@TargetObject,
 					@TargetFiles,
-					0,
+					isnull(@TargetRows, 0),
 					@Status,
-					dbo.getdate(),
+					isnull(@EventDateTime, dbo.getdate()),
 					null
 				);
 	
@@ -88,15 +91,15 @@ begin transaction @TransactionName
 				and exists (select 1 from sys.objects where name = @TargetObject)
 				and @Status != 'Begin'
 			begin
-				declare @TargetRows table (RowNum int primary key identity, TargetRows int)
+				declare @CountedRows table (RowNum int primary key identity, TargetRows int)
 				declare @SQLStatement nvarchar(500)
 				set @SQLStatement = 'select count(*) as RecordCount from ' + @TargetSchema + '.' + @TargetObject + ' where DW_BatchID  = ' + cast(@BatchID as varchar)
 
-				insert into @TargetRows
+				insert into @CountedRows
 				exec sp_executesql @SQLStatement
 
 				update trgt
-				set trgt.TargetRows = isnull((select TargetRows from @TargetRows), 0)
+				set trgt.TargetRows = isnull((select TargetRows from @CountedRows), 0)
 				from
 				metadata.BatchStepLog trgt
 				where
@@ -0,0 +1,305 @@
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+
+/***********************
+Bulk version of s_BatchStepLogging. @Steps is a json array of step events,
+in the order they happened:
+
+[{"BatchID": 1000, "StepName": "Load File x", "Status": "Begin",
+  "SourceSchema": "API", "SourceObject": "raw/source",
+  "TargetUpdateStrategy": "full", "TargetSchema": "raw/source/x",
+  "TargetObject": "x", "TargetFiles": null, "TargetRows": null,
+  "EventDateTime": "2024-01-31 08:00:00.123"}, ...]
+
+Several events of one step (e.g. Begin then Success) collapse into a single
+upsert carrying the last event's status. TargetRows (records written) is
+kept as it is when the last event has none. StartDateTime and EndDateTime
+come from the events' EventDateTime (the first and last event of the step),
+not from when the records are written; events without one get the current
+time. Instead of the single global lock
+of s_BatchStepLogging, an exclusive lock is taken per BatchID, so callers
+logging different batches do not wait for each other. The global lock is
+held shared, which keeps s_BatchStepLogging callers out while steps are
+bulk logged.
+***********************/
+CREATE procedure [METADATA].[s_BatchStepLoggingBulk]
+@Steps nvarchar(max)
+
+as
+begin
+
+set nocount on
+
+declare @StepEvents table (
+	EventNumber int primary key,
+	BatchID int not null,
+	StepName varchar(100) not null,
+	Status varchar(25) not null,
+	SourceSchema varchar(100) null,
+	SourceObject varchar(50) null,
+	TargetUpdateStrategy varchar(50) null,
+	TargetSchema varchar(100) null,
+	TargetObject varchar(50) null,
+	TargetFiles int null,
+	TargetRows int null,
+	EventDateTime datetime not null
+)
+
+insert into @StepEvents
+select
+	cast(events.[key] as int),
+	step.BatchID,
+	step.StepName,
+	step.Status,
+	step.SourceSchema,
+	step.SourceObject,
+	step.TargetUpdateStrategy,
+	step.TargetSchema,
+	step.TargetObject,
+	step.TargetFiles,
+	step.TargetRows,
+	isnull(step.EventDateTime, dbo.getdate())
+from openjson(@Steps) as events
+cross apply openjson(events.[value]) with (
+	BatchID int,
+	StepName varchar(100),
+	Status varchar(25),
+	SourceSchema varchar(100),
+	SourceObject varchar(50),
+	TargetUpdateStrategy varchar(50),
+	TargetSchema varchar(100),
+	TargetObject varchar(50),
+	TargetFiles int,
+	TargetRows int,
+	EventDateTime datetime2
+) as step
+
+/***********************
+One row per step: the last event's
+status and file count, the first
+and last event times, the number
+of events and the first event
+number (for step numbering)
+***********************/
+declare @StepRows table (
+	BatchID int not null,
+	StepName varchar(100) not null,
+	Status varchar(25) not null,
+	SourceSchema varchar(100) null,
+	SourceObject varchar(50) null,
+	TargetUpdateStrategy varchar(50) null,
+	TargetSchema varchar(100) null,
+	TargetObject varchar(50) null,
+	TargetFiles int null,
+	TargetRows int null,
+	FirstEventDateTime datetime not null,
+	LastEventDateTime datetime not null,
+	EventCount int not null,
+	FirstEventNumber int not null,
+	primary key (BatchID, StepName)
+)
+
+insert into @StepRows
+select
+	BatchID,
+	StepName,
+	Status,
+	SourceSchema,
+	SourceObject,
+	TargetUpdateStrategy,
+	TargetSchema,
+	TargetObject,
+	TargetFiles,
+	TargetRows,
+	FirstEventDateTime,
+	LastEventDateTime,
+	EventCount,
+	FirstEventNumber
+from (
+	select
+		*,
+		row_number() over (
+			partition by BatchID, StepName order by EventNumber desc) as LastEvent,
+		min(EventDateTime) over (partition by BatchID, StepName) as FirstEventDateTime,
+		max(EventDateTime) over (partition by BatchID, StepName) as LastEventDateTime,
+		count(*) over (partition by BatchID, StepName) as EventCount,
+		min(EventNumber) over (partition by BatchID, StepName) as FirstEventNumber
+	from @StepEvents
+) as events
+where LastEvent = 1
+
+/***********************
+Insert / Update Records
+***********************/
+declare @TransactionName varchar(32) = 'BatchStepLogBulk'
+
+begin transaction @TransactionName
+
+	begin try
+
+		declare @LockResult int;
+	    exec @LockResult = sp_getapplock
+			@Resource = 'METADATA.s_BatchStepLogging',
+			@LockMode = 'Shared',
+			@LockOwner = 'Transaction',
+			@LockTimeout = 3600000 -- 60 minutes
+
+		if @LockResult < 0
+			throw 50001, 'Could not acquire METADATA.s_BatchStepLogging lock', 1;
+
+		-- Lock the batches in BatchID order so callers cannot deadlock.
+		declare @BatchID int
+		declare @BatchResource nvarchar(255)
+		declare batch_locks cursor local fast_forward for
+			select distinct BatchID from @StepRows order by BatchID
+
+		open batch_locks
+		fetch next from batch_locks into @BatchID
+		while @@fetch_status = 0
+		begin
+			set @BatchResource = concat('METADATA.s_BatchStepLogging_', @BatchID)
+			exec @LockResult = sp_getapplock
+				@Resource = @BatchResource,
+				@LockMode = 'Exclusive',
+				@LockOwner = 'Transaction',
+				@LockTimeout = 3600000 -- 60 minutes
+
+			if @LockResult < 0
+				throw 50002, 'Could not acquire batch step logging lock', 1;
+
+			fetch next from batch_locks into @BatchID
+		end
+		close batch_locks
+		deallocate batch_locks
+
+		merge into metadata.BatchStepLog with (holdlock) as target
+		using (
+			select
+				steps.*,
+				isnull(
+					(select max(cast(StepNumber as numeric))
+					from metadata.BatchStepLog
+					where BatchID = steps.BatchID), 0)
+				+ row_number() over (
+					partition by steps.BatchID
+					order by steps.FirstEventNumber) as NewStepNumber
+			from @StepRows as steps
+			where not exists (
+				select 1 from metadata.BatchStepLog as existing
+				where existing.BatchID = steps.BatchID
+				and existing.StepName = steps.StepName)
+			union all
+			select
+				steps.*,
+				null
+			from @StepRows as steps
+			where exists (
+				select 1 from metadata.BatchStepLog as existing
+				where existing.BatchID = steps.BatchID
+				and existing.StepName = steps.StepName)
+		) as source
+			on source.BatchID = target.BatchID
+			and source.StepName = target.StepName
+		when matched then
+			update set
+				target.Status = source.Status,
+				target.TargetFiles = source.TargetFiles,
+				target.TargetRows = isnull(source.TargetRows, target.TargetRows),
+				target.EndDateTime = source.LastEventDateTime
+		when not matched by target then
+			insert
+			(
+				BatchID,
+				StepNumber,
+				StepName,
+				SourceSchema,
+				SourceObject,
+				TargetUpdateStrategy,
+				TargetSchema,
+				TargetObject,
+				TargetFiles,
+				TargetRows,
+				Status,
+				StartDateTime,
+				EndDateTime
+			)
+			values
+			(
+				source.BatchID,
+				cast(source.NewStepNumber as varchar),
+				source.StepName,
+				source.SourceSchema,
+				source.SourceObject,
+				source.TargetUpdateStrategy,
+				source.TargetSchema,
+				source.TargetObject,
+				source.TargetFiles,
+				isnull(source.TargetRows, 0),
+				source.Status,
+				source.FirstEventDateTime,
+				-- a step begun and finished in the same call is complete
+				case when source.EventCount > 1 then source.LastEventDateTime end
+			);
+
+		/***********************
+		Count the target rows of
+		finished data warehouse steps
+		***********************/
+		declare @StepName varchar(100)
+		declare @TargetSchema varchar(100)
+		declare @TargetObject varchar(50)
+		declare @SQLStatement nvarchar(500)
+		declare @TargetRows table (RowNum int primary key identity, TargetRows int)
+
+		declare target_rows cursor local fast_forward for
+			select steps.BatchID, steps.StepName, steps.TargetSchema, steps.TargetObject
+			from @StepRows as steps
+			join metadata.BatchLog as batch
+				on batch.BatchID = steps.BatchID
+			where
+				batch.TargetSystem = 'Data Warehouse'
+				and steps.Status != 'Begin'
+				and exists (select 1 from sys.schemas where name = steps.TargetSchema)
+				and exists (select 1 from sys.objects where name = steps.TargetObject)
+
+		open target_rows
+		fetch next from target_rows into @BatchID, @StepName, @TargetSchema, @TargetObject
+		while @@fetch_status = 0
+		begin
+			delete from @TargetRows
+			set @SQLStatement = 'select count(*) as RecordCount from ' + @TargetSchema + '.' + @TargetObject + ' where DW_BatchID  = ' + cast(@BatchID as varchar)
+
+			insert into @TargetRows
+			exec sp_executesql @SQLStatement
+
+			update trgt
+			set trgt.TargetRows = isnull((select TargetRows from @TargetRows), 0)
+			from
+			metadata.BatchStepLog trgt
+			where
+				trgt.BatchID = @BatchID
+				and trgt.StepName = @StepName
+
+			fetch next from target_rows into @BatchID, @StepName, @TargetSchema, @TargetObject
+		end
+		close target_rows
+		deallocate target_rows
+
+		commit transaction @TransactionName
+
+	end try
+
+	begin catch
+
+		rollback transaction @TransactionName;
+
+		throw;
+
+	end catch
+
+end
+GO
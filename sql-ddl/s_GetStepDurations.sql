@@ -0,0 +1,76 @@
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+/***********************
+Finds the recent successful steps
+of an endpoint without scanning
+the whole step log
+***********************/
+CREATE NONCLUSTERED INDEX [IX_BatchStepLog_Target] ON [METADATA].[BatchStepLog]
+(
+	[TargetSchema] ASC,
+	[TargetObject] ASC,
+	[StartDateTime] DESC
+)
+INCLUDE ([BatchID], [Status], [EndDateTime]) ON [PRIMARY]
+GO
+
+
+/***********************
+Historical load durations of many
+endpoints in one call, for longest
+first scheduling. @Endpoints is a
+json array:
+
+[{"TargetSchema": "raw/source/x",
+  "TargetObject": "x"}, ...]
+
+Returns TargetSchema, TargetObject
+and the average duration in seconds
+of the endpoint's last @History
+successful steps. Endpoints without
+a successful step are not returned.
+***********************/
+CREATE procedure [METADATA].[s_GetStepDurations]
+@TargetSystem varchar(50),
+@Endpoints nvarchar(max),
+@History int = 5
+
+as
+begin
+
+set nocount on
+
+select
+	e.TargetSchema,
+	e.TargetObject,
+	avg(cast(datediff(second, s.StartDateTime, s.EndDateTime) as float)) as DurationSeconds
+from openjson(@Endpoints) with (
+	TargetSchema varchar(100),
+	TargetObject varchar(50)
+) as e
+cross apply (
+	select top (@History)
+		bs.StartDateTime,
+		bs.EndDateTime
+	from
+	metadata.batchsteplog bs
+	inner join metadata.batchlog b
+		on b.BatchID = bs.BatchID
+	where
+		b.TargetSystem = @TargetSystem
+		and bs.TargetSchema = e.TargetSchema
+		and bs.TargetObject = e.TargetObject
+		and bs.Status = 'Success'
+		and bs.EndDateTime is not null
+	order by bs.StartDateTime desc
+) as s
+group by
+	e.TargetSchema,
+	e.TargetObject
+
+end
+GO
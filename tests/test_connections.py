@@ -0,0 +1,102 @@
+"""Tests for the secret cache of connections.py, with a stand-in for the Key
+vault SecretClient.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import connections
+
+# Clock standing in for the time module, moved on by hand.
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+# SecretClient counting its requests by name. Fetches of a name in blocked
+# wait until its event is set.
+class FakeSecretClient:
+    def __init__(self):
+        self.requests = []
+        self.blocked = {}
+        self.lock = threading.Lock()
+
+    def get_secret(self, name):
+        with self.lock:
+            self.requests.append(name)
+            version = self.requests.count(name)
+        if name in self.blocked:
+            self.blocked[name].wait(10)
+        return types.SimpleNamespace(value=name + '-' + str(version))
+
+class GetSecretTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeSecretClient()
+        self.clock = FakeClock()
+        for patcher in [
+                mock.patch.object(connections, 'secret_cache', {}),
+                mock.patch.object(connections, 'secret_locks', {}),
+                mock.patch.object(connections, 'time', self.clock),
+                mock.patch.object(
+                    connections, 'get_secret_client', lambda: self.client)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_secret_is_cached_until_its_ttl_runs_out(self):
+        self.assertEqual(connections.get_secret('api-key'), 'api-key-1')
+        self.clock.now += connections.SECRET_TTL_SECONDS - 1
+        self.assertEqual(connections.get_secret('api-key'), 'api-key-1')
+        self.clock.now += 1
+        self.assertEqual(connections.get_secret('api-key'), 'api-key-2')
+        self.assertEqual(self.client.requests, ['api-key', 'api-key'])
+
+    def test_expired_secrets_are_evicted(self):
+        connections.get_secret('old')
+        self.clock.now += connections.SECRET_TTL_SECONDS
+        connections.get_secret('new')
+        self.assertEqual(sorted(connections.secret_cache), ['new'])
+
+    def test_concurrent_callers_share_one_request(self):
+        self.client.blocked['api-key'] = threading.Event()
+        values = []
+        threads = [
+            threading.Thread(
+                target=lambda: values.append(connections.get_secret('api-key')))
+            for number in range(5)]
+        for thread in threads:
+            thread.start()
+        # let the other callers queue up behind the first request
+        time.sleep(0.05)
+        self.client.blocked['api-key'].set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(values, ['api-key-1'] * 5)
+        self.assertEqual(self.client.requests, ['api-key'])
+
+    def test_slow_secret_does_not_block_other_names(self):
+        self.client.blocked['slow'] = threading.Event()
+        thread = threading.Thread(target=connections.get_secret, args=('slow',))
+        thread.start()
+        try:
+            # the slow fetch holds only its own lock
+            self.assertEqual(connections.get_secret('fast'), 'fast-1')
+        finally:
+            self.client.blocked['slow'].set()
+            thread.join(10)
+        self.assertEqual(connections.get_secret('slow'), 'slow-1')
+
+    def test_cached_local_secret_is_not_fetched(self):
+        connections.cache_secret('local', 'value')
+        self.clock.now += 10 * connections.SECRET_TTL_SECONDS
+        self.assertEqual(connections.get_secret('local'), 'value')
+        self.assertEqual(self.client.requests, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Tests for etl_orchestrator.py: how the threads engine hands config rows
+to its worker pool, the statuses of failed steps and the rows a resumed
+batch skips.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import threading
+import unittest
+
+from etl_orchestrator import load_rows, failure_status, completed_status, \
+    STATUS_MAX_LENGTH
+
+# Stand-in for a SourceBatch whose rows block until released, recording the
+# order they started in.
+class BlockingSource:
+    def __init__(self, base_urls):
+        self.config_data_list = [
+            {'base_url': base_url} for base_url in base_urls]
+        self.started = []
+        self.released = [threading.Event() for base_url in base_urls]
+        self.lock = threading.Lock()
+        self.start_count = threading.Semaphore(0)
+
+    def load_row(self, index, fail_fast, host_semaphore):
+        with self.lock:
+            self.started.append(index)
+        self.start_count.release()
+        self.released[index].wait(10)
+        return 'Success'
+
+    # Wait until count more rows started.
+    def wait_started(self, count):
+        for number in range(count):
+            if not self.start_count.acquire(timeout=10):
+                raise AssertionError('rows did not start: ' + str(self.started))
+
+class LoadRowsTest(unittest.TestCase):
+    def run_rows(self, source, max_workers, max_workers_per_host):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(
+            responses=load_rows(source, max_workers, max_workers_per_host, True)))
+        thread.start()
+        return thread, result
+
+    def test_busy_host_does_not_hold_back_other_hosts(self):
+        source = BlockingSource([
+            'https://a.example.com/1', 'https://a.example.com/2',
+            'https://b.example.com/1'])
+        thread, result = self.run_rows(source, 2, 1)
+        # row 1 waits for host a, so row 2 (host b) takes the second thread
+        source.wait_started(2)
+        self.assertEqual(sorted(source.started), [0, 2])
+        source.released[0].set()
+        source.wait_started(1)
+        self.assertEqual(source.started[2], 1)
+        for released in source.released:
+            released.set()
+        thread.join(10)
+        self.assertEqual(result['responses'], ['Success'] * 3)
+
+    def test_rows_start_in_config_order_without_host_cap(self):
+        source = BlockingSource(['https://a.example.com/' + str(number)
+            for number in range(4)])
+        thread, result = self.run_rows(source, 2, None)
+        source.wait_started(2)
+        self.assertEqual(sorted(source.started), [0, 1])
+        for released in source.released:
+            released.set()
+        thread.join(10)
+        self.assertEqual(sorted(source.started), [0, 1, 2, 3])
+        self.assertEqual(result['responses'], ['Success'] * 4)
+
+class FailureStatusTest(unittest.TestCase):
+    def test_status_fits_the_status_column(self):
+        self.assertEqual(failure_status('Timeout'), 'Failure: Timeout')
+        self.assertEqual(
+            failure_status('MissingFromBatch'), 'Failure: MissingFromBatch')
+        self.assertEqual(
+            failure_status('ServiceRequestError' * 2), 
+            'Failure: ServiceRequestEr')
+        self.assertEqual(len(failure_status('x' * 100)), STATUS_MAX_LENGTH)
+
+class CompletedStatusTest(unittest.TestCase):
+    def test_only_rows_loaded_by_the_resumed_batch_are_skipped(self):
+        resume_statuses = {
+            'Load File A': 'Success', 'Load File B': 'Failure: Timeout',
+            'Load File C': 'Unchanged', 'Load File D': 'Start'}
+        self.assertEqual([
+            completed_status({'endpoint_name': name}, resume_statuses)
+            for name in 'ABCDE'], ['Success', None, 'Unchanged', None, None])
+        # a batch that is not resumed loads every row
+        self.assertIsNone(completed_status({'endpoint_name': 'A'}, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for etl_scheduler.py: the order rows of many sources are started in,
+with the step durations of the logging database replaced by fixed values.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import collections
+import unittest
+from unittest import mock
+
+import etl_scheduler
+from etl_scheduler import ScheduledRow, next_row, scheduled_rows, run_rows
+
+# Stand-in for a SourceBatch recording the order its rows were loaded in.
+class RecordingSource:
+    target_system = 'api'
+
+    def __init__(self, name, base_urls, started):
+        self.name = name
+        self.config_data_list = [
+            {'endpoint_name': name + str(index), 'base_url': base_url}
+            for index, base_url in enumerate(base_urls)]
+        self.started = started
+
+    def endpoints(self):
+        return [config['endpoint_name'] for config in self.config_data_list]
+
+    def load_row(self, index, fail_fast, host_semaphore):
+        self.started.append(self.name + str(index))
+        return 'Success'
+
+    def __repr__(self):
+        return self.name
+
+class NextRowTest(unittest.TestCase):
+    def setUp(self):
+        self.running_by_source = collections.Counter()
+        self.running_by_host = collections.Counter()
+        self.source_caps = {'a': 2, 'b': 2}
+
+    def next_row(self, pending, max_workers_per_host = None):
+        return next_row(
+            pending, self.running_by_source, self.running_by_host,
+            self.source_caps, max_workers_per_host)
+
+    def test_longest_row_of_the_least_busy_source(self):
+        pending = [
+            ScheduledRow('a', 0, 'host-a', 90),
+            ScheduledRow('b', 0, 'host-b', 60),
+            ScheduledRow('b', 1, 'host-b', 30)]
+        self.assertEqual(self.next_row(pending), pending[0])
+        self.running_by_source['a'] += 1
+        # a already has a row running, so b's longest row goes first
+        self.assertEqual(self.next_row(pending), pending[1])
+
+    def test_caps_hold_rows_back(self):
+        pending = [
+            ScheduledRow('a', 0, 'host-a', 90),
+            ScheduledRow('b', 0, 'host-a', 60),
+            ScheduledRow('b', 1, 'host-b', 30)]
+        self.running_by_source['a'] = 2 # at its source cap
+        self.running_by_host['host-a'] = 1
+        self.assertEqual(self.next_row(pending, 1), pending[2])
+        self.running_by_host['host-b'] = 1
+        self.assertIsNone(self.next_row(pending, 1))
+
+class ScheduledRowsTest(unittest.TestCase):
+    def test_rows_without_history_get_the_source_average(self):
+        source = RecordingSource('a', ['https://a.example.com/'] * 3, [])
+        durations = {'a0': 10, 'a1': None, 'a2': 30}
+        with mock.patch.object(
+                etl_scheduler, 'get_step_durations',
+                lambda target_system, endpoints: durations):
+            rows = scheduled_rows(source)
+        self.assertEqual(
+            [(row.index, row.host, row.duration) for row in rows],
+            [(0, 'a.example.com', 10), (1, 'a.example.com', 20),
+                (2, 'a.example.com', 30)])
+
+class RunRowsTest(unittest.TestCase):
+    def test_rows_of_all_sources_start_longest_first(self):
+        started = []
+        sources = [
+            RecordingSource('a', ['https://a.example.com/'] * 2, started),
+            RecordingSource('b', ['https://b.example.com/'] * 2, started)]
+        durations = {'a0': 5, 'a1': 50, 'b0': 20, 'b1': 80}
+        with mock.patch.object(
+                etl_scheduler, 'get_step_durations',
+                lambda target_system, endpoints: durations):
+            success_responses = run_rows(
+                sources, {source: 1 for source in sources}, 1, None, True)
+        self.assertEqual(started, ['b1', 'a1', 'b0', 'a0'])
+        self.assertEqual(
+            success_responses,
+            {source: ['Success', 'Success'] for source in sources})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""Tests for the SQLite lease store of lease_store.py, with worker processes
+sharing one SQLite file the way worker mode does on one machine.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from lease_store import SqliteLeaseStore
+
+BATCH_ID = 1000
+SHARD_COUNT = 40
+WORKER_COUNT = 4
+
+# Worker process: claim and complete shards until none is left, then try
+# to claim the completion of the batch. Reports ('shard', owner, shard key,
+# attempts) for each claim and ('finish', owner, won) at the end.
+def claim_all(path, owner, start, reports):
+    store = SqliteLeaseStore(path)
+    store.register_shards(BATCH_ID, shard_keys())
+    start.wait(10)
+    while True:
+        claim = store.claim(BATCH_ID, owner, 60)
+        if claim is None:
+            break
+        shard_key, attempts = claim
+        reports.put(('shard', owner, shard_key, attempts))
+        store.complete(BATCH_ID, shard_key, owner, {shard_key: owner})
+    reports.put(('finish', owner, store.claim_finish(BATCH_ID, owner)))
+
+# Worker process that claims one shard and dies without completing it: its
+# lease runs out after lease_seconds.
+def claim_and_die(path, owner, lease_seconds):
+    store = SqliteLeaseStore(path)
+    store.register_shards(BATCH_ID, shard_keys())
+    store.claim(BATCH_ID, owner, lease_seconds)
+
+# Worker process trying to claim the completion of the batch once.
+def claim_finish(path, owner, reports):
+    reports.put((owner, SqliteLeaseStore(path).claim_finish(BATCH_ID, owner)))
+
+def shard_keys():
+    return ['shard-' + str(number) for number in range(SHARD_COUNT)]
+
+class SqliteLeaseStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'leases.db')
+        # forked workers start quicker than spawned ones, where available
+        self.context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods() 
+            else None)
+
+    # Start target in one process per args tuple.
+    def run_processes(self, target, *args_list):
+        processes = [
+            self.context.Process(target=target, args=args)
+            for args in args_list]
+        for process in processes:
+            process.start()
+        return processes
+
+    # Wait for processes to end, failing when one of them failed.
+    def join(self, processes):
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_each_shard_is_claimed_exactly_once(self):
+        reports = self.context.Queue()
+        start = self.context.Event()
+        owners = ['worker-' + str(number) for number in range(WORKER_COUNT)]
+        processes = self.run_processes(
+            claim_all, *[(self.path, owner, start, reports) for owner in owners])
+        start.set()
+        claims = []
+        finishes = []
+        while len(finishes) < WORKER_COUNT:
+            report = reports.get(timeout=60)
+            if report[0] == 'shard':
+                claims.append(report[1:])
+            else:
+                finishes.append(report[1:])
+        self.join(processes)
+        self.assertEqual(
+            sorted(shard_key for owner, shard_key, attempts in claims),
+            sorted(shard_keys()))
+        self.assertEqual(
+            {attempts for owner, shard_key, attempts in claims}, {1})
+        # the worker that completed the last shard finishes the batch
+        self.assertEqual([won for owner, won in finishes].count(True), 1)
+        store = SqliteLeaseStore(self.path)
+        self.assertEqual(store.unfinished_count(BATCH_ID), 0)
+        self.assertEqual(
+            store.results(BATCH_ID),
+            {shard_key: owner for owner, shard_key, attempts in claims})
+
+    def test_expired_lease_is_claimed_again(self):
+        self.join(self.run_processes(
+            claim_and_die, (self.path, 'dead-worker', 1)))
+        store = SqliteLeaseStore(self.path)
+        # the lease still runs, so the next shard is claimed
+        self.assertEqual(store.claim(BATCH_ID, 'worker', 60), ('shard-1', 1))
+        time.sleep(1.1)
+        self.assertEqual(store.claim(BATCH_ID, 'worker', 60), ('shard-0', 2))
+        # the dead worker's lease is gone: it cannot complete the shard
+        self.assertFalse(
+            store.complete(BATCH_ID, 'shard-0', 'dead-worker', {'a': 'x'}))
+        self.assertTrue(
+            store.complete(BATCH_ID, 'shard-0', 'worker', {'a': 'Success'}))
+        self.assertEqual(store.results(BATCH_ID), {'a': 'Success'})
+
+    def test_finish_is_claimed_once(self):
+        store = SqliteLeaseStore(self.path)
+        store.register_shards(BATCH_ID, ['only-shard'])
+        self.assertFalse(store.claim_finish(BATCH_ID, 'early-worker'))
+        store.claim(BATCH_ID, 'worker', 60)
+        store.complete(BATCH_ID, 'only-shard', 'worker', {})
+        reports = self.context.Queue()
+        owners = ['worker-' + str(number) for number in range(WORKER_COUNT)]
+        processes = self.run_processes(
+            claim_finish, *[(self.path, owner, reports) for owner in owners])
+        wins = [reports.get(timeout=60)[1] for owner in owners]
+        self.join(processes)
+        self.assertEqual(wins.count(True), 1)
+        # asking again, even as the winner, does not finish the batch twice
+        self.assertFalse(store.claim_finish(BATCH_ID, 'worker-0'))
+        self.assertFalse(store.claim_finish(BATCH_ID, 'worker'))
+
+if __name__ == '__main__':
+    unittest.main()
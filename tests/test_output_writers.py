@@ -0,0 +1,123 @@
+"""Tests for output_writers.py: ndjson and parquet part files, written to an
+in-memory stand-in for blob storage.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import io
+import json
+import unittest
+from unittest import mock
+
+import output_writers
+from output_writers import NdjsonPartWriter, ParquetPartWriter, \
+    SchemaDriftError
+
+# In-memory BlobBlockWriter: keeps the parts committed, by file name.
+class MemoryBlockWriter(io.BytesIO):
+    committed = {}
+
+    def __init__(
+            self, content_type, container_name, file_name,
+            block_size = None, compression = None):
+        super().__init__()
+        self.file_name = file_name
+
+    def close(self, commit = True):
+        # io calls close() again when the writer is garbage collected
+        if commit and not self.closed:
+            MemoryBlockWriter.committed[self.file_name] = self.getvalue()
+        super().close()
+
+class PartWriterTest(unittest.TestCase):
+    def setUp(self):
+        MemoryBlockWriter.committed = {}
+        patcher = mock.patch.object(
+            output_writers, 'BlobBlockWriter', MemoryBlockWriter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+class NdjsonPartWriterTest(PartWriterTest):
+    def test_parts_roll_over_at_part_size_on_record_boundaries(self):
+        writer = NdjsonPartWriter('raw/source/endpoint', 'endpoint-20260101', 30)
+        records = [{'id': number, 'name': 'x' * 5} for number in range(6)]
+        writer.write_records(records[:4])
+        writer.write_records(records[4:])
+        self.assertEqual(writer.close(), 3)
+        parts = MemoryBlockWriter.committed
+        self.assertEqual(sorted(parts), [
+            'endpoint-20260101-part-0001.ndjson',
+            'endpoint-20260101-part-0002.ndjson',
+            'endpoint-20260101-part-0003.ndjson'])
+        lines = []
+        for file_name in sorted(parts):
+            self.assertTrue(parts[file_name].endswith(b'\n'))
+            lines.extend(parts[file_name].splitlines())
+        self.assertEqual([json.loads(line) for line in lines], records)
+        # every part but the last reached the part size
+        self.assertTrue(all(
+            len(parts[file_name]) >= 30 for file_name in sorted(parts)[:-1]))
+
+    def test_failed_load_drops_the_open_part(self):
+        writer = NdjsonPartWriter('raw/source/endpoint', 'endpoint', 30)
+        writer.write_records([{'id': number} for number in range(5)])
+        self.assertEqual(writer.close(commit = False), 2)
+        self.assertEqual(list(MemoryBlockWriter.committed), [
+            'endpoint-part-0001.ndjson'])
+
+@unittest.skipIf(output_writers.pa is None, 'needs the pyarrow module')
+class ParquetPartWriterTest(PartWriterTest):
+    # Write each list of records as a row group of its own; returns the
+    # tables of the committed parts.
+    def write_pages(self, *pages):
+        writer = ParquetPartWriter('raw/source/endpoint', 'endpoint', 2 ** 20)
+        for records in pages:
+            writer.write_records(records)
+            writer.write_row_group()
+        writer.close()
+        return [
+            output_writers.pq.read_table(output_writers.pa.BufferReader(
+                MemoryBlockWriter.committed[file_name]))
+            for file_name in sorted(MemoryBlockWriter.committed)]
+
+    def test_later_pages_are_written_in_the_first_schema(self):
+        tables = self.write_pages(
+            [{'id': 1, 'price': 1.5, 'name': 'a'}],
+            [{'id': 2.0, 'price': 2, 'name': 3}])
+        self.assertEqual(len(tables), 1)
+        self.assertEqual(
+            [(field.name, str(field.type)) for field in tables[0].schema],
+            [('id', 'int64'), ('price', 'double'), ('name', 'string')])
+        self.assertEqual(tables[0].to_pylist(), [
+            {'id': 1, 'price': 1.5, 'name': 'a'},
+            {'id': 2, 'price': 2.0, 'name': '3'}])
+
+    def test_nulls_and_missing_fields(self):
+        tables = self.write_pages(
+            [{'id': 1, 'note': None}, {'id': None, 'note': None}],
+            [{'note': 5}, {'id': 3}])
+        self.assertEqual(str(tables[0].schema.field('note').type), 'string')
+        self.assertEqual(str(tables[0].schema.field('id').type), 'int64')
+        self.assertEqual(tables[0].to_pylist(), [
+            {'id': 1, 'note': None}, {'id': None, 'note': None},
+            {'id': None, 'note': '5'}, {'id': 3, 'note': None}])
+
+    def test_mixed_first_rows_make_a_string_column(self):
+        tables = self.write_pages([{'code': 1}, {'code': 'A1'}], [{'code': 2}])
+        self.assertEqual(
+            tables[0].column('code').to_pylist(), ['1', 'A1', '2'])
+
+    def test_new_field_fails_the_load(self):
+        with self.assertRaisesRegex(SchemaDriftError, 'field extra'):
+            self.write_pages([{'id': 1}], [{'id': 2, 'extra': 'x'}])
+
+    def test_drifting_type_fails_the_load(self):
+        for first, later in [
+                (1, 2.5), (1, 'abc'), (1, True), (1.5, 'abc'), (True, 1)]:
+            with self.subTest(first=first, later=later):
+                MemoryBlockWriter.committed = {}
+                with self.assertRaisesRegex(SchemaDriftError, 'column value'):
+                    self.write_pages([{'value': first}], [{'value': later}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Tests for the background batch step log writer of process_logging.py, with
+the SQL writes replaced by in-memory stand-ins.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import process_logging
+from process_logging import StepLogWriter
+
+# Stand-in for log_batch_steps() keeping the batches written. The first
+# write waits for release, so records queued meanwhile pile up; batches
+# listed in failing raise instead.
+class BatchLog:
+    def __init__(self, failing = ()):
+        self.batches = []
+        self.failing = failing
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, steps):
+        if not self.batches:
+            self.started.set()
+            self.release.wait(10)
+        self.batches.append(list(steps))
+        if len(self.batches) - 1 in self.failing:
+            raise RuntimeError('batch ' + str(len(self.batches) - 1))
+
+class StepLogWriterTest(unittest.TestCase):
+    def start_writer(self, batch_log):
+        patcher = mock.patch.object(
+            process_logging, 'log_batch_steps', batch_log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return StepLogWriter()
+
+    def test_records_are_written_in_order_in_batches(self):
+        batch_log = BatchLog()
+        writer = self.start_writer(batch_log)
+        writer.put(['step', 0])
+        batch_log.started.wait(10)
+        for number in range(1, 6):
+            writer.put(['step', number])
+        batch_log.release.set()
+        writer.stop()
+        self.assertEqual(
+            [step for batch in batch_log.batches for step in batch],
+            [['step', number] for number in range(6)])
+        # the records queued during the first write went in one batch
+        self.assertEqual(len(batch_log.batches), 2)
+
+    def test_flush_waits_for_the_records_queued_before_it(self):
+        batch_log = BatchLog()
+        batch_log.release.set()
+        writer = self.start_writer(batch_log)
+        for number in range(3):
+            writer.put(['step', number])
+        writer.flush()
+        self.assertEqual(
+            [step for batch in batch_log.batches for step in batch],
+            [['step', number] for number in range(3)])
+        writer.stop()
+
+    def test_failed_write_is_raised_by_stop(self):
+        batch_log = BatchLog(failing=(0,))
+        writer = self.start_writer(batch_log)
+        writer.put(['step', 0])
+        batch_log.started.wait(10)
+        writer.put(['step', 1])
+        batch_log.release.set()
+        with mock.patch('builtins.print'):
+            with self.assertRaisesRegex(RuntimeError, 'batch 0'):
+                writer.stop()
+        # records after the failed batch are still written
+        self.assertEqual(batch_log.batches, [[['step', 0]], [['step', 1]]])
+
+class LogBatchStepTest(unittest.TestCase):
+    def test_records_are_queued_only_while_the_writer_runs(self):
+        batch_log = BatchLog()
+        batch_log.release.set()
+        written = []
+        with mock.patch.object(process_logging, 'log_batch_steps', batch_log), \
+                mock.patch.object(
+                    process_logging, 'write_batch_step', written.append):
+            process_logging.start_step_log_writer()
+            try:
+                process_logging.log_batch_step(
+                    1, 'Begin', 'Start', 'api', 'source', 'full', 'raw',
+                    'endpoint', 0)
+                process_logging.flush_step_log_writer()
+            finally:
+                process_logging.stop_step_log_writer()
+            process_logging.log_batch_step(
+                1, 'End', 'Success', 'api', 'source', 'full', 'raw',
+                'endpoint', 1, 10)
+        self.assertEqual(
+            [step[:3] for batch in batch_log.batches for step in batch],
+            [[1, 'Begin', 'Start']])
+        self.assertEqual([step[:3] for step in written], [[1, 'End', 'Success']])
+
+if __name__ == '__main__':
+    unittest.main()
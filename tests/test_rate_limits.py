@@ -0,0 +1,133 @@
+"""Tests for rate_limits.py: the retry policy and the token bucket and
+adaptive concurrency limit of HostLimiter.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import unittest
+from unittest import mock
+
+from rate_limits import RetryPolicy, HostLimiter, retry_after_seconds, \
+    RETRY_AFTER_MAX_SECONDS
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_retries_retry_statuses_and_connection_errors(self):
+        policy = RetryPolicy(attempts = 3)
+        self.assertTrue(policy.should_retry(0, 503))
+        self.assertTrue(policy.should_retry(2, 429))
+        self.assertTrue(policy.should_retry(0)) # connection error, timeout
+        self.assertFalse(policy.should_retry(0, 404))
+        self.assertFalse(policy.should_retry(0, 200))
+
+    def test_stops_after_the_last_attempt(self):
+        policy = RetryPolicy(attempts = 3)
+        self.assertFalse(policy.should_retry(3, 503))
+        self.assertFalse(policy.should_retry(3))
+        self.assertFalse(RetryPolicy(attempts = 0).should_retry(0, 503))
+
+    def test_backoff_is_exponential_with_full_jitter_and_capped(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 10)
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual(policy.delay(0), 1)
+            self.assertEqual(policy.delay(2), 4)
+            self.assertEqual(policy.delay(5), 10)
+        for attempt in range(8):
+            self.assertTrue(0 <= policy.delay(attempt) <= 10)
+
+    def test_retry_after_overrides_backoff(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 60)
+        self.assertEqual(policy.delay(0, {'Retry-After': '30'}), 30)
+        self.assertEqual(policy.delay(5, {'Retry-After': '0'}), 0)
+
+    def test_retry_after_is_capped_at_max_backoff(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 10)
+        self.assertEqual(policy.delay(0, {'Retry-After': '30'}), 10)
+        self.assertEqual(policy.retry_after({'Retry-After': '30'}), 10)
+        self.assertIsNone(policy.retry_after({}))
+        self.assertEqual(
+            retry_after_seconds({'Retry-After': '100000'}),
+            RETRY_AFTER_MAX_SECONDS)
+
+    def test_retry_after_that_is_not_finite_is_ignored(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 10)
+        for value in ('nan', 'inf', '-inf', 'NaN', 'Infinity'):
+            with self.subTest(value=value):
+                self.assertIsNone(retry_after_seconds({'Retry-After': value}))
+                self.assertTrue(
+                    0 <= policy.delay(0, {'Retry-After': value}) <= 1)
+
+    def test_retry_after_http_date_and_bad_values(self):
+        self.assertEqual(
+            retry_after_seconds({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+            0) # in the past
+        self.assertIsNone(retry_after_seconds({'Retry-After': 'soon'}))
+        self.assertIsNone(retry_after_seconds({}))
+        self.assertIsNone(retry_after_seconds(None))
+
+class HostLimiterTest(unittest.TestCase):
+    # Take count slots of limiter, failing when one is not free right away.
+    def acquire(self, limiter, count):
+        for number in range(count):
+            with limiter.condition:
+                self.assertEqual(limiter.try_acquire(), 0)
+
+    def test_limits_requests_in_flight(self):
+        limiter = HostLimiter(max_concurrency = 2)
+        self.acquire(limiter, 2)
+        with limiter.condition:
+            self.assertIsNone(limiter.try_acquire())
+        limiter.release()
+        self.acquire(limiter, 1)
+
+    def test_throttling_halves_the_limit(self):
+        limiter = HostLimiter(max_concurrency = 8)
+        self.acquire(limiter, 3)
+        limiter.release(throttled = True)
+        self.assertEqual(limiter.limit, 4)
+        limiter.release(throttled = True)
+        self.assertEqual(limiter.limit, 2)
+        limiter.release(throttled = True)
+        self.assertEqual(limiter.limit, 1)
+        self.acquire(limiter, 1)
+        limiter.release(throttled = True)
+        self.assertEqual(limiter.limit, 1) # never below one
+
+    def test_good_responses_raise_the_limit_by_one(self):
+        limiter = HostLimiter(max_concurrency = 4)
+        self.acquire(limiter, 1)
+        limiter.release(throttled = True)
+        self.assertEqual(limiter.limit, 2)
+        # the limit grows after as many good responses as the limit
+        self.acquire(limiter, 2)
+        limiter.release()
+        self.assertEqual(limiter.limit, 2)
+        limiter.release()
+        self.assertEqual(limiter.limit, 3)
+        for number in range(3 + 4):
+            self.acquire(limiter, 1)
+            limiter.release()
+        self.assertEqual(limiter.limit, 4) # never above max_concurrency
+
+    def test_token_bucket_allows_bursts_then_waits(self):
+        limiter = HostLimiter(rate_limit = 10, burst = 2)
+        with mock.patch('time.monotonic', return_value=100.0):
+            limiter.updated = 100.0
+            self.acquire(limiter, 2)
+            with limiter.condition:
+                self.assertAlmostEqual(limiter.try_acquire(), 0.1)
+        with mock.patch('time.monotonic', return_value=100.2):
+            self.acquire(limiter, 1)
+
+    def test_retry_after_pauses_the_host(self):
+        limiter = HostLimiter()
+        self.acquire(limiter, 1)
+        with mock.patch('time.monotonic', return_value=100.0):
+            limiter.release(throttled = True, pause = 5)
+        with mock.patch('time.monotonic', return_value=101.0):
+            with limiter.condition:
+                self.assertAlmostEqual(limiter.try_acquire(), 4)
+        with mock.patch('time.monotonic', return_value=105.0):
+            self.acquire(limiter, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,507 @@
+"""Tests for the request_api.py helpers that need no api, blob storage or
+SQL server: delta load parameters, BLS request coalescing and splitting,
+page checkpoints and resumed loads, the next link scanner of streamed
+pages, the retry of streamed responses that break off, the in-order page
+window of compacted output and the shared access token cache.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+from datetime import date, datetime
+import json
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import requests
+
+import request_api
+from request_api import ApiCall, RequestBatch, PageCheckpoint, \
+    NextLinkScanner, delta_url_params, split_batch_response, \
+    coalesce_requests, NO_WATERMARK, CHECKPOINT_INTERVAL, NEXT_LINK_WINDOW
+from instrumentation import StepCounters
+from rate_limits import RetryPolicy, HostLimiter
+
+# Config file row of a BLS timeseries endpoint, with the columns
+# coalesce_requests() groups rows by.
+def bls_config_row(endpoint_url, **columns):
+    config = {
+        'endpoint_name': endpoint_url,
+        'endpoint_url': endpoint_url,
+        'base_url': 'https://api.bls.gov/publicAPI/v2/timeseries/data/',
+        'api_type': 'json_api_key_not_paged',
+        'auth_type': 'api-key',
+        'user': None,
+        'keyvault_secret_password_name': 'bls-api-key',
+        'additional_url_string': '{}',
+        'target_update_strategy': 'full',
+        'coalesce_batch_size': 2}
+    config.update(columns)
+    return config
+
+class DeltaUrlParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'target_update_strategy': 'delta',
+            'delta_start_param': 'startdate'}
+
+    def test_start_date_from_the_watermark(self):
+        self.assertEqual(
+            delta_url_params(self.config, datetime(2026, 3, 14, 6, 30)),
+            {'startdate': '2026-03-14'})
+
+    def test_lookback_days_and_date_format(self):
+        self.config['delta_lookback_days'] = '2'
+        self.config['delta_date_format'] = '%Y%m%d'
+        self.assertEqual(
+            delta_url_params(self.config, date(2026, 3, 1)),
+            {'startdate': '20260227'})
+
+    def test_end_param_is_today(self):
+        self.config['delta_end_param'] = 'enddate'
+        params = delta_url_params(self.config, datetime(2026, 3, 14))
+        self.assertEqual(
+            params['enddate'], datetime.now().strftime('%Y-%m-%d'))
+
+    def test_no_watermark_is_a_full_load(self):
+        # the logging database returns 1900-01-01 for endpoints that never
+        # loaded successfully
+        self.assertEqual(delta_url_params(self.config, datetime(1900, 1, 1)), {})
+        self.assertEqual(delta_url_params(self.config, date(1900, 1, 1)), {})
+        self.assertEqual(delta_url_params(self.config, None), {})
+        self.assertNotEqual(
+            delta_url_params(self.config, datetime(1900, 1, 3)), {})
+        self.assertEqual(NO_WATERMARK, datetime(1900, 1, 2))
+
+    def test_full_loads_and_rows_without_delta_columns(self):
+        self.config['target_update_strategy'] = 'full'
+        self.assertEqual(delta_url_params(self.config, datetime(2026, 3, 14)), {})
+        self.assertEqual(
+            delta_url_params(
+                {'target_update_strategy': 'delta', 'delta_start_param': 'none'},
+                datetime(2026, 3, 14)),
+            {})
+        self.assertEqual(
+            delta_url_params(
+                {'target_update_strategy': 'delta', 'delta_start_param': float('nan')},
+                datetime(2026, 3, 14)),
+            {})
+
+class SplitBatchResponseTest(unittest.TestCase):
+    def test_each_series_gets_a_response_of_its_own(self):
+        response = {
+            'status': 'REQUEST_SUCCEEDED',
+            'Results': {'series': [
+                {'seriesID': 'CUUR0000SA0', 'data': [{'value': '1'}]},
+                {'seriesID': 'LNS14000000', 'data': [{'value': '2'}]}]}}
+        split = split_batch_response(response, 'Results.series', 'seriesID')
+        self.assertEqual(sorted(split), ['CUUR0000SA0', 'LNS14000000'])
+        self.assertEqual(split['LNS14000000'], {
+            'status': 'REQUEST_SUCCEEDED',
+            'Results': {'series': [
+                {'seriesID': 'LNS14000000', 'data': [{'value': '2'}]}]}})
+        # the batched response itself is left as it was
+        self.assertEqual(len(response['Results']['series']), 2)
+
+    def test_missing_results_path(self):
+        self.assertEqual(
+            split_batch_response(
+                {'status': 'REQUEST_NOT_PROCESSED', 'Results': {}},
+                'Results.series', 'seriesID'),
+            {})
+        self.assertEqual(
+            split_batch_response([], 'Results.series', 'seriesID'), {})
+
+class RequestBatchTest(unittest.TestCase):
+    def test_each_row_takes_its_own_response_once(self):
+        batch = RequestBatch(['A', 'B'])
+        batch.responses = {'A': b'a', 'B': b'b'}
+        self.assertEqual(batch.take('A'), b'a')
+        self.assertEqual(batch.take('A'), 'MissingFromBatch')
+        self.assertEqual(batch.take('B'), b'b')
+
+    def test_error_of_the_batched_request_goes_to_every_row(self):
+        batch = RequestBatch(['A', 'B'])
+        batch.responses = 'Timeout'
+        self.assertEqual([batch.take('A'), batch.take('B')], ['Timeout'] * 2)
+
+class CoalesceRequestsTest(unittest.TestCase):
+    def test_rows_are_batched_up_to_the_batch_size(self):
+        config_data_list = [
+            bls_config_row('A'), bls_config_row('B'), bls_config_row('C')]
+        batches = coalesce_requests(config_data_list, [None] * 3)
+        self.assertIs(batches[0], batches[1])
+        self.assertEqual(batches[0].endpoint_urls, ['A', 'B'])
+        self.assertIsNone(batches[2]) # a batch of one is requested alone
+
+    def test_only_matching_rows_share_a_request(self):
+        config_data_list = [
+            bls_config_row('A'),
+            bls_config_row('B', user='someone else'),
+            bls_config_row('C', coalesce_batch_size=1),
+            bls_config_row('D', api_type='json_user_pass_paged_count'),
+            bls_config_row('E')]
+        batches = coalesce_requests(config_data_list, [None] * 5)
+        self.assertEqual(batches[0].endpoint_urls, ['A', 'E'])
+        self.assertIs(batches[4], batches[0])
+        self.assertEqual(batches[1:4], [None, None, None])
+
+    def test_rows_with_other_delta_params_are_not_batched(self):
+        delta = {
+            'target_update_strategy': 'delta',
+            'delta_start_param': 'startyear',
+            'delta_date_format': '%Y'}
+        config_data_list = [
+            bls_config_row('A', **delta), bls_config_row('B', **delta),
+            bls_config_row('C', **delta)]
+        batches = coalesce_requests(config_data_list, [
+            datetime(2025, 6, 1), datetime(2024, 6, 1), datetime(2025, 1, 1)])
+        self.assertEqual(batches[0].endpoint_urls, ['A', 'C'])
+        self.assertIsNone(batches[1])
+
+# Blob storage of checkpoints, by (container name, file name).
+class MemoryBlobs(dict):
+    def write(self, content_type, container_name, file_name, body):
+        self[container_name, file_name] = body
+
+    def read(self, container_name, file_name):
+        return self.get((container_name, file_name))
+
+    def delete(self, container_name, file_name):
+        del self[container_name, file_name]
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.blobs = MemoryBlobs()
+        for name, function in [
+                ('blob_write', self.blobs.write), 
+                ('blob_read', self.blobs.read), 
+                ('blob_delete', self.blobs.delete)]:
+            patcher = mock.patch.object(request_api, name, function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def checkpoint(self, batch_id = 7, resume = True):
+        return PageCheckpoint(
+            'raw/source/endpoint', 'endpoint', batch_id, '20260101', resume)
+
+class PageCheckpointTest(CheckpointTest):
+    def test_saved_every_interval_of_pages(self):
+        checkpoint = self.checkpoint()
+        saved = []
+        for page in range(1, 2 * CHECKPOINT_INTERVAL + 1):
+            if checkpoint.advance(page):
+                checkpoint.save()
+                saved.append(page)
+        self.assertEqual(saved, [CHECKPOINT_INTERVAL, 2 * CHECKPOINT_INTERVAL])
+        self.assertEqual(
+            json.loads(self.blobs['raw/source/endpoint', 
+                '_checkpoint-endpoint.json'])['page'], 
+            2 * CHECKPOINT_INTERVAL)
+
+    def test_resumed_run_of_the_same_batch_loads_the_state(self):
+        checkpoint = self.checkpoint()
+        checkpoint.advance(12, next_page='https://a/13')
+        checkpoint.save()
+        self.assertEqual(self.checkpoint().load(), {
+            'page': 12, 'next_page': 'https://a/13', 'batch_id': 7,
+            'date_string': '20260101'})
+        # a checkpoint of another batch, or a run that is not resumed, 
+        # starts afresh
+        self.assertEqual(self.checkpoint(batch_id=8).load(), {})
+        self.assertEqual(self.checkpoint(resume=False).load(), {})
+
+    def test_clear_removes_the_saved_checkpoint(self):
+        checkpoint = self.checkpoint()
+        checkpoint.clear() # never saved: nothing to remove
+        checkpoint.advance(3)
+        checkpoint.save()
+        checkpoint.clear()
+        self.assertEqual(self.blobs, {})
+
+class ResumePagesTest(CheckpointTest):
+    # Run json_user_pass_paged_count over 10 pages, resuming from page when
+    # given; returns the pages written first and the pages left to
+    # get_and_write_pages.
+    def load(self, page = None):
+        if page is not None:
+            checkpoint = self.checkpoint()
+            checkpoint.advance(page)
+            checkpoint.save()
+        call = ApiCall.__new__(ApiCall)
+        call.additional_url_dict = {}
+        call.first_page_number = 1
+        call.total_pages_key_name = 'pages'
+        call.checkpoint = self.checkpoint()
+        call.part_writer = None
+        written = []
+        remaining = []
+        call.requests_get = lambda additional_url_dict: types.SimpleNamespace(
+            content=b'{"pages": 10}')
+        call.write_json_page = lambda content, page, parsed: written.append(page)
+        call.get_and_write_pages = lambda pages: remaining.append(pages) \
+            or 'Success'
+        self.assertEqual(call.json_user_pass_paged_count(), 'Success')
+        return written, remaining[0]
+
+    def test_fresh_load_writes_the_first_page(self):
+        self.assertEqual(self.load(), ([1], range(2, 10)))
+
+    def test_resumed_load_skips_the_pages_already_written(self):
+        self.assertEqual(self.load(page=6), ([], range(6, 10)))
+
+    def test_part_numbers_carry_on_after_the_saved_parts(self):
+        checkpoint = self.checkpoint()
+        checkpoint.advance(4, part_count=3)
+        checkpoint.save()
+        call = ApiCall.__new__(ApiCall)
+        call.checkpoint = self.checkpoint()
+        call.part_writer = types.SimpleNamespace(part_count=0)
+        self.assertEqual(call.resume_checkpoint()['page'], 4)
+        self.assertEqual(call.part_writer.part_count, 3)
+
+class NextLinkScannerTest(unittest.TestCase):
+    # Scan a page in chunks of size bytes; returns the link found.
+    def scan(self, page, size):
+        scanner = NextLinkScanner()
+        for start in range(0, len(page), size):
+            scanner.scan(page[start:start + size])
+        return scanner.next_page
+
+    def test_link_split_across_chunks(self):
+        link = 'https://api.example.com/odata/Items?$skiptoken=\'A/1\''
+        page = json.dumps({'d': {
+            'results': [{'id': number} for number in range(50)],
+            '__next': link}}).encode()
+        for size in (1, 7, 16, 100, len(page)):
+            self.assertEqual(self.scan(page, size), link)
+
+    def test_last_link_of_the_page_wins(self):
+        page = b'{"d": {"inner": {"__next": "https://a/1"}, ' \
+            b'"__next": "https://a/2"}}'
+        self.assertEqual(self.scan(page, 5), 'https://a/2')
+
+    def test_escaped_link_and_no_link(self):
+        page = b'{"d": {"__next": "https://a/items?filter=\\"x\\""}}'
+        self.assertEqual(self.scan(page, 3), 'https://a/items?filter="x"')
+        self.assertIsNone(self.scan(b'{"d": {"results": []}}', 4))
+
+    def test_tail_is_bounded(self):
+        scanner = NextLinkScanner()
+        for number in range(4):
+            scanner.scan(b' ' * NEXT_LINK_WINDOW)
+        self.assertEqual(len(scanner.tail), NEXT_LINK_WINDOW)
+
+# requests response whose streamed body breaks off after its chunks when
+# broken.
+class FakeResponse:
+    def __init__(self, status_code, chunks, broken = False):
+        self.status_code = status_code
+        self.headers = {}
+        self.chunks = chunks
+        self.broken = broken
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.broken:
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code))
+
+    def close(self):
+        self.closed = True
+
+class StreamToBlobTest(unittest.TestCase):
+    def test_stream_that_breaks_off_is_requested_again(self):
+        call = ApiCall.__new__(ApiCall)
+        call.counters = StepCounters()
+        call.retry_policy = RetryPolicy(3, 0, 0)
+        call.host_limiter = lambda url: HostLimiter()
+        call.auth_type = 'api-key'
+        call.use_params = False
+        call.full_url = 'https://api.example.com/items'
+        call.full_folder_name_value = 'raw/source/endpoint'
+        call.compression = None
+        responses = [
+            FakeResponse(200, [b'{"d": {"__ne'], broken=True),
+            FakeResponse(200, [b'{"d": {"__ne', b'xt": "https://n/2"}}'])]
+        session = mock.Mock()
+        session.get.side_effect = lambda url, **kwargs: responses.pop(0)
+        uploads = []
+
+        def blob_write_stream(
+                content_type, container_name, file_name, chunks, compression):
+            uploads.append(b''.join(chunks))
+
+        with mock.patch.object(request_api, 'get_session', lambda url: session), \
+                mock.patch.object(
+                    request_api, 'blob_write_stream', blob_write_stream):
+            result = call.requests_get(consumer=call.stream_to_blob(
+                'application/json', 'endpoint.json', find_next_link=True))
+        self.assertEqual(result, ('Success', 'https://n/2'))
+        # the broken attempt raised inside the upload, so it never committed
+        self.assertEqual(uploads, [b'{"d": {"__next": "https://n/2"}}'])
+        self.assertEqual(call.counters.get('retries'), 1)
+
+class MapPagesTest(unittest.TestCase):
+    def test_pages_come_back_in_order_within_the_window(self):
+        call = ApiCall.__new__(ApiCall)
+        call.page_workers = 2
+        drawn = []
+
+        # pages are drawn lazily, so drawn shows how far ahead map_pages got
+        def pages():
+            for page in range(1, 11):
+                drawn.append(page)
+                yield page
+
+        # later pages come back first
+        def get_page(page):
+            time.sleep((10 - page) * 0.002)
+            return 'content ' + str(page)
+
+        results = []
+        for page, content in call.map_pages(get_page, pages()):
+            self.assertLessEqual(len(drawn) - page, call.page_window() - 1)
+            results.append((page, content))
+        self.assertEqual(
+            results, [(page, 'content ' + str(page)) for page in range(1, 11)])
+
+    def test_pages_not_started_are_cancelled_when_the_consumer_stops(self):
+        call = ApiCall.__new__(ApiCall)
+        call.page_workers = 1
+        fetched = []
+
+        def get_page(page):
+            fetched.append(page)
+            return page
+
+        for page, content in call.map_pages(get_page, range(1, 11)):
+            break
+        self.assertEqual(page, 1)
+        self.assertLessEqual(len(fetched), call.page_window())
+
+# ApiCall of a token endpoint whose token posts (requests_post) are counted
+# and, while blocked is set, wait for it to be cleared.
+def token_call():
+    call = ApiCall.__new__(ApiCall)
+    call.counters = StepCounters()
+    call.retry_policy = RetryPolicy(3, 0, 0)
+    call.host_limiter = lambda url: HostLimiter()
+    call.auth_type = 'token'
+    call.use_params = True
+    call.full_url = 'https://api.example.com/items'
+    call.token_url = 'https://login.example.com/token'
+    call.access_token = '{"client_id": "etl"}'
+    call.token_posts = 0
+    call.blocked = threading.Event()
+    call.released = threading.Event()
+
+    def requests_post():
+        call.token_posts += 1
+        if call.blocked.is_set():
+            call.released.wait(10)
+        return 'token-' + str(call.token_posts), 3600
+
+    call.requests_post = requests_post
+    return call
+
+class AccessTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        self.now = 1000.0
+        for patcher in [
+                mock.patch.object(request_api, 'access_tokens', {}),
+                mock.patch.object(request_api, 'access_token_locks', {}),
+                mock.patch.object(request_api, 'time', self.clock)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_callers_share_one_token_request(self):
+        call = token_call()
+        call.blocked.set()
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda: responses.append(call.get_access_token()))
+            for number in range(5)]
+        for thread in threads:
+            thread.start()
+        # let the other callers queue up behind the first request
+        time.sleep(0.05)
+        call.released.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(responses, [('Success', 'token-1')] * 5)
+        self.assertEqual(call.token_posts, 1)
+
+    def test_token_is_refreshed_before_it_expires(self):
+        call = token_call()
+        self.assertEqual(call.get_access_token(), ('Success', 'token-1'))
+        self.now += 3600 - request_api.TOKEN_REFRESH_MARGIN - 1
+        self.assertEqual(call.get_access_token(), ('Success', 'token-1'))
+        self.now += 1
+        self.assertEqual(call.get_access_token(), ('Success', 'token-2'))
+
+    def test_only_the_rejected_token_is_dropped(self):
+        call = token_call()
+        call.get_access_token()
+        # a token another caller already replaced is not requested again
+        self.assertEqual(
+            call.get_access_token(expired_token='token-0'),
+            ('Success', 'token-1'))
+        self.assertEqual(
+            call.get_access_token(expired_token='token-1'),
+            ('Success', 'token-2'))
+        self.assertEqual(call.token_posts, 2)
+
+    def test_token_request_error_is_returned(self):
+        call = token_call()
+        call.requests_post = lambda: 'HTTPError'
+        self.assertEqual(call.get_access_token(), 'HTTPError')
+        self.assertEqual(request_api.access_tokens, {})
+
+class RefreshOnUnauthorizedTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+                mock.patch.object(request_api, 'access_tokens', {}),
+                mock.patch.object(request_api, 'access_token_locks', {})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Run requests_get with the token the api will reject cached; returns 
+    # its result, the Authorization header of each request and the headers.
+    def requests_get(self, status_codes):
+        call = token_call()
+        call.get_access_token()
+        headers = {'Authorization': 'Bearer token-1'}
+        sent = []
+
+        def get(url, **kwargs):
+            sent.append(kwargs['headers']['Authorization'])
+            return FakeResponse(status_codes[len(sent) - 1], [])
+
+        session = types.SimpleNamespace(get=get)
+        with mock.patch.object(request_api, 'get_session', lambda url: session):
+            result = call.requests_get(headers=headers)
+        return result, sent, headers
+
+    def test_401_refreshes_the_token_and_retries(self):
+        result, sent, headers = self.requests_get([401, 200])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(sent, ['Bearer token-1', 'Bearer token-2'])
+        # later pages sent with the same headers use the new token
+        self.assertEqual(headers['Authorization'], 'Bearer token-2')
+
+    def test_token_is_refreshed_only_once(self):
+        result, sent, headers = self.requests_get([401, 401, 200])
+        self.assertEqual(result, 'HTTPError')
+        self.assertEqual(sent, ['Bearer token-1', 'Bearer token-2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Tests for request_api_async.py that need no api, blob storage or SQL
+server: pages are parsed and serialized off the event loop, and responses
+that break off are requested again.
+
+Syntax: python -m unittest discover tests (from the repository root)
+"""
+
+import asyncio
+import json
+import threading
+import unittest
+from unittest import mock
+
+import aiohttp
+
+import request_api_async
+from request_api_async import AsyncApiCall
+from instrumentation import StepCounters
+from rate_limits import RetryPolicy, HostLimiter
+
+# AsyncApiCall of a non-paged json endpoint, without a config row.
+def api_call(**attributes):
+    call = AsyncApiCall.__new__(AsyncApiCall)
+    call.counters = StepCounters()
+    call.raw_passthrough = False
+    call.part_writer = None
+    call.records_path = 'd.results'
+    call.endpoint_name = 'endpoint'
+    call.date_string = '20260101'
+    call.full_folder_name_value = 'raw/source/endpoint'
+    call.compression = None
+    for name, value in attributes.items():
+        setattr(call, name, value)
+    return call
+
+class WriteJsonPageTest(unittest.TestCase):
+    def test_page_is_parsed_and_serialized_off_the_event_loop(self):
+        call = api_call()
+        threads = []
+        written = []
+
+        def parse_json(content):
+            threads.append(threading.current_thread())
+            return json.loads(content)
+
+        json_dumps = json.dumps
+
+        def dumps(value):
+            threads.append(threading.current_thread())
+            return json_dumps(value)
+
+        async def write_blob_async(content_type, file_name, body):
+            written.append((file_name, body))
+
+        call.write_blob_async = write_blob_async
+        with mock.patch.object(request_api_async, 'parse_json', parse_json), \
+                mock.patch.object(request_api_async.json, 'dumps', dumps):
+            asyncio.run(call.write_json_page_async(
+                b'{"d": {"results": [1, 2, 3]}}', 1))
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(
+            written, [('endpoint-20260101-page-001.json', 
+                '{"d": {"results": [1, 2, 3]}}')])
+        self.assertEqual(
+            call.counters.to_dict(), {'pages': 1, 'bytes': 29, 'records': 3})
+
+    def test_part_writer_records_are_extracted_off_the_event_loop(self):
+        threads = []
+        records = []
+
+        class PartWriter:
+            include_parent_fields = False
+
+            def write_records(self, page_records):
+                threads.append(threading.current_thread())
+                records.extend(page_records)
+
+        call = api_call(part_writer=PartWriter())
+        asyncio.run(call.write_json_page_async(
+            b'{"d": {"results": [{"id": 1}, {"id": 2}]}}', 2))
+        self.assertEqual(records, [{'id': 1}, {'id': 2}])
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(call.counters.get('records'), 2)
+
+# aiohttp response whose body breaks off after part of it when broken.
+class FakeResponse:
+    def __init__(self, status, body, broken = False):
+        self.status = status
+        self.headers = {}
+        self.body = body
+        self.broken = broken
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    async def read(self):
+        if self.broken:
+            raise aiohttp.ClientPayloadError('Response payload is not completed')
+        return self.body
+
+# aiohttp session handing out the given responses in turn.
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def request(self, method, url, **request_kwargs):
+        self.requests += 1
+        return self.responses.pop(0)
+
+class SendWithRetriesTest(unittest.TestCase):
+    def requests_get(self, responses, attempts):
+        call = api_call(
+            retry_policy=RetryPolicy(attempts, 0, 0), auth_type='api-key',
+            use_params=False, full_url='https://api.example.com/items')
+        call.host_limiter = lambda url: HostLimiter()
+        session = FakeSession(responses)
+        with mock.patch.object(
+                request_api_async, 'get_client_session', lambda: session):
+            return asyncio.run(call.requests_get()), session, call
+
+    def test_body_that_breaks_off_is_requested_again(self):
+        content, session, call = self.requests_get([
+            FakeResponse(200, b'{"d": ', broken=True),
+            FakeResponse(200, b'{"d": []}')], 3)
+        self.assertEqual(content, b'{"d": []}')
+        self.assertEqual(session.requests, 2)
+        self.assertEqual(call.counters.get('retries'), 1)
+
+    def test_broken_body_fails_once_retries_run_out(self):
+        content, session, call = self.requests_get([
+            FakeResponse(200, b'', broken=True),
+            FakeResponse(200, b'', broken=True)], 1)
+        self.assertEqual(content, 'RequestException')
+        self.assertEqual(session.requests, 2)
+
+if __name__ == '__main__':
+    unittest.main()